@@ -1,135 +1,558 @@
 import discord
 from discord.ext import tasks, commands
 import asyncio
-import sqlite3
+import collections
+import contextlib
 import datetime
 import aiohttp
+import hashlib
 import io
+import json
+import logging
+import math
 import os
+import signal
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 from dotenv import load_dotenv
+from botlog import new_correlation_id, setup_logging
+from cluster import Cluster, gateway_info
+from dedupe import DuplicateIndex
+from imaging import dhash, recompress
+from metrics import LoopLagMonitor, MetricsServer, Registry
+from outbound import OutboundScheduler
+from recompute import Recompute
+from remote import BackendServer, RemoteBackend, awaited
+from snapshot import Snapshots
+import transfer
+from storage import (
+    ChannelRegistry, CommandSyncs, Database, MemoryStreakStore, StreakStore, day_date, day_number, streak_cutoff
+)
 load_dotenv()
+
+log = logging.getLogger('sfbot')
+
+# Logging: LOG_SAMPLE_RATES keeps a fraction of records per level or event,
+# e.g. "debug=0.1,image.received=0.01"
+LOG_LEVEL = os.getenv('LOG_LEVEL', 'INFO')
+LOG_FORMAT = os.getenv('LOG_FORMAT', 'text')  # 'text' or 'json'
+LOG_SAMPLE_RATES = os.getenv('LOG_SAMPLE_RATES', '')
+
+# Storage settings
+DATABASE_PATH = os.getenv('DATABASE_PATH', 'streaks.db')
+# 'sqlite' commits every streak update within WRITE_BATCH_MS. 'memory' keeps all
+# users in memory and writes changes every CHECKPOINT_SECONDS instead: posts are
+# counted without touching the database, but a crash loses up to that much.
+STORAGE_ENGINE = os.getenv('STORAGE_ENGINE', 'sqlite')
+CHECKPOINT_SECONDS = int(os.getenv('CHECKPOINT_SECONDS', '30'))
+DB_READERS = int(os.getenv('DB_READERS', '2'))
+# Streak updates are committed in groups of up to WRITE_BATCH_SIZE, at most WRITE_BATCH_MS apart
+WRITE_BATCH_SIZE = int(os.getenv('WRITE_BATCH_SIZE', '200'))
+WRITE_BATCH_MS = int(os.getenv('WRITE_BATCH_MS', '50'))
+# Per-user stats served to /streak, /score and /user_stats are cached in memory
+STATS_CACHE_SIZE = int(os.getenv('STATS_CACHE_SIZE', '10000'))
+STATS_CACHE_TTL = int(os.getenv('STATS_CACHE_TTL', '300'))
+
+# Image download settings
+MAX_IMAGE_BYTES = int(os.getenv('MAX_IMAGE_BYTES', str(25 * 1024 * 1024)))
+DOWNLOAD_CHUNK_SIZE = 64 * 1024
+HTTP_POOL_SIZE = int(os.getenv('HTTP_POOL_SIZE', '20'))
+# Attachments downloaded and processed at once, overall and per guild
+DOWNLOAD_CONCURRENCY = int(os.getenv('DOWNLOAD_CONCURRENCY', '8'))
+GUILD_DOWNLOAD_CONCURRENCY = int(os.getenv('GUILD_DOWNLOAD_CONCURRENCY', '3'))
+# Discord's limit on files per message
+MAX_IMAGES_PER_POST = 10
+
+# Images are downscaled and re-encoded in IMAGE_WORKERS processes before re-upload
+IMAGE_WORKERS = int(os.getenv('IMAGE_WORKERS', '2'))
+IMAGE_MAX_DIMENSION = int(os.getenv('IMAGE_MAX_DIMENSION', '2048'))
+IMAGE_FORMAT = os.getenv('IMAGE_FORMAT', 'webp')  # 'webp' or 'jpeg'
+IMAGE_QUALITY = int(os.getenv('IMAGE_QUALITY', '85'))
+
+# Reposts within DUPLICATE_WINDOW_DAYS whose perceptual hash differs by at most
+# DUPLICATE_THRESHOLD bits (out of 64) don't earn points
+DUPLICATE_THRESHOLD = int(os.getenv('DUPLICATE_THRESHOLD', '6'))
+DUPLICATE_WINDOW_DAYS = int(os.getenv('DUPLICATE_WINDOW_DAYS', '30'))
+# Flat images like solid colours and plain gradients hash to (nearly) all 0 or
+# all 1 bits and would all match each other, so hashes with fewer than
+# DUPLICATE_MIN_BITS bits set or clear aren't checked
+DUPLICATE_MIN_BITS = int(os.getenv('DUPLICATE_MIN_BITS', '4'))
+
+# Re-posts within OUTBOUND_MERGE_MS of each other in a channel are merged into one
+# message (up to 10 images); 0 sends every re-post on its own
+OUTBOUND_MERGE_MS = int(os.getenv('OUTBOUND_MERGE_MS', '0'))
+
+# Leaderboard settings
+LEADERBOARD_PAGE_SIZE = 10
+RANK_NEIGHBOURS = 2  # users shown above and below in /rank
+HISTORY_MAX_DAYS = 90  # furthest back /history and /guild_activity look
+
+# Image channels registered before the registry existed, adopted on first start
+DEFAULT_IMAGE_CHANNELS = [
+    int(channel_id) for channel_id in os.getenv('DEFAULT_IMAGE_CHANNELS', '1433779537786961982').split(',')
+    if channel_id.strip()
+]
+# Lapsed streaks are written back shortly after local midnight, in batches
+STREAK_EXPIRY_TIME = datetime.time(hour=0, minute=0, second=30)
+STREAK_EXPIRY_BATCH = int(os.getenv('STREAK_EXPIRY_BATCH', '500'))
+
+# How often to pick up image channel changes made by other bot processes
+CHANNEL_REFRESH_SECONDS = int(os.getenv('CHANNEL_REFRESH_SECONDS', '30'))
+
+# Compressed snapshots of the database are written to SNAPSHOT_DIR every
+# SNAPSHOT_HOURS (0 turns them off). The newest SNAPSHOT_KEEP are kept, plus one
+# a day for SNAPSHOT_KEEP_DAYS. Restore one with SF-CLI.py restore.
+SNAPSHOT_DIR = os.getenv('SNAPSHOT_DIR', 'snapshots')
+SNAPSHOT_HOURS = float(os.getenv('SNAPSHOT_HOURS', '6'))
+SNAPSHOT_KEEP = int(os.getenv('SNAPSHOT_KEEP', '8'))
+SNAPSHOT_KEEP_DAYS = int(os.getenv('SNAPSHOT_KEEP_DAYS', '7'))
+SNAPSHOT_PAGES = int(os.getenv('SNAPSHOT_PAGES', '256'))  # pages copied per backup step
+
+# How often !recompute edits its progress message
+RECOMPUTE_PROGRESS_SECONDS = 10
+
+# Guilds whose slash commands are synced at the same time
+COMMAND_SYNC_CONCURRENCY = int(os.getenv('COMMAND_SYNC_CONCURRENCY', '2'))
+
+# Gateway cache policy. Message authors, and the Members slash commands take as
+# options, arrive in the event payloads, so by default only guilds, channels and
+# roles are cached and the bot's memory doesn't grow with the size of its guilds.
+# MEMBER_CACHE is 'none', 'joined' (members seen since connecting) or 'all'
+# (those plus members in voice channels). Anything but 'none' also turns on the
+# privileged members intent, whose join/leave/update events are otherwise never
+# sent. Each cached member takes about 0.8 KB, so ~80 MB per 100k members.
+MEMBER_CACHE = os.getenv('MEMBER_CACHE', 'none')
+# CHUNK_GUILDS_AT_STARTUP=1 downloads every guild's full member list on connect
+# (needs a MEMBER_CACHE). on_ready then waits for Discord to send every member,
+# 1,000 per gateway event: seconds per 100k members, repeated on every restart.
+CHUNK_GUILDS_AT_STARTUP = os.getenv('CHUNK_GUILDS_AT_STARTUP', '0') == '1'
+# Recent messages kept for edit and delete events, which the bot doesn't use.
+# Each takes about 1.1 KB; 0 turns the cache off (discord.py keeps 1000).
+MESSAGE_CACHE_SIZE = int(os.getenv('MESSAGE_CACHE_SIZE', '0'))
+
+# Sharding. One process runs SHARD_COUNT shards, by default as many as Discord
+# recommends. `python SF-BOT.py --cluster` instead runs them in CLUSTER_WORKERS
+# worker processes (default: one per CPU), each with its own run of shards. The
+# launcher keeps the database and serves it to the workers over CLUSTER_SOCKET,
+# so there is still only one writer. It restarts workers that exit, and kills
+# and restarts ones that miss heartbeats for CLUSTER_HEARTBEAT_TIMEOUT seconds.
+SHARD_COUNT = int(os.getenv('SHARD_COUNT') or 0) or None
+CLUSTER_WORKERS = int(os.getenv('CLUSTER_WORKERS') or 0) or os.cpu_count()
+CLUSTER_SOCKET = os.getenv('CLUSTER_SOCKET', 'sfbot.sock')
+CLUSTER_HEARTBEAT_SECONDS = 10
+CLUSTER_HEARTBEAT_TIMEOUT = int(os.getenv('CLUSTER_HEARTBEAT_TIMEOUT', '60'))
+# Whether this process is the launcher, which holds the database but doesn't connect to Discord
+CLUSTER_LAUNCHER = '--cluster' in sys.argv[1:]
+# Set by the launcher for each worker
+CLUSTER_WORKER = int(os.getenv('CLUSTER_WORKER')) if os.getenv('CLUSTER_WORKER') else None
+SHARD_IDS = [int(shard_id) for shard_id in os.getenv('SHARD_IDS', '').split(',') if shard_id] or None
+
+# Prometheus metrics are served at http://METRICS_HOST:METRICS_PORT/metrics when METRICS_PORT is set.
+# In a cluster the launcher serves them there along with /health, a JSON report on
+# every worker and shard, and worker N serves its own on METRICS_PORT + N + 1.
+METRICS_HOST = os.getenv('METRICS_HOST', '127.0.0.1')
+METRICS_PORT = int(os.getenv('METRICS_PORT') or 0)
+if METRICS_PORT and CLUSTER_WORKER is not None:
+    METRICS_PORT += CLUSTER_WORKER + 1
+
+# Metrics
+metrics = Registry()
+STAGE_SECONDS = metrics.histogram(
+    'sfbot_image_stage_seconds', 'Time spent in each stage of handling an image post', ['stage']
+)
+COMMAND_SECONDS = metrics.histogram(
+    'sfbot_command_seconds', 'Time from receiving a slash command to finishing it', ['command', 'status']
+)
+DB_STATEMENT_SECONDS = metrics.histogram(
+    'sfbot_db_statement_seconds', 'Time spent running each database statement', ['statement']
+)
+IMAGES_PROCESSED = metrics.counter('sfbot_images_processed_total', 'Images reposted with a streak caption')
+IMAGES_FAILED = metrics.counter('sfbot_images_failed_total', 'Images or posts that could not be handled', ['reason'])
+IMAGES_IGNORED = metrics.counter('sfbot_images_ignored_total', 'Images deliberately left out of a re-post', ['reason'])
+LOOP_LAG = metrics.gauge('sfbot_event_loop_lag_seconds', 'How late the event loop last woke up from a sleep')
+metrics.gauge('sfbot_outbound_queue_depth', 'Deletes and re-posts waiting to be sent',
+              function=lambda: streak_bot.outbound.depth)
+SHARD_LATENCY = metrics.gauge('sfbot_shard_latency_seconds', 'Gateway heartbeat latency of each shard', ['shard'])
+SHARD_CONNECTED = metrics.gauge('sfbot_shard_connected', 'Whether each shard is connected', ['shard'])
+SHARD_GUILDS = metrics.gauge('sfbot_shard_guilds', 'Guilds on each shard', ['shard'])
+SHARD_EVENTS = metrics.counter(
+    'sfbot_shard_events_total', 'Shard gateway connects, disconnects and resumes', ['shard', 'event']
+)
+# A cluster worker has no database of its own; the launcher reports these
+if CLUSTER_WORKER is None:
+    metrics.gauge('sfbot_write_queue_depth', 'Database writes waiting to be committed',
+                  function=lambda: streak_bot.store.writes.depth)
+    metrics.gauge('sfbot_stats_cache_entries', 'Users held in the stats cache',
+                  function=lambda: streak_bot.store.stats().get('cache', {}).get('size', 0))
+    metrics.gauge('sfbot_unsaved_changes', 'Users and posts the memory engine has not checkpointed yet',
+                  function=lambda: streak_bot.store.stats().get('dirty', 0))
+    metrics.gauge('sfbot_snapshot_seconds', 'How long the last database snapshot took',
+                  function=lambda: streak_bot.snapshots.last['seconds'] if streak_bot.snapshots.last else 0)
+    metrics.gauge('sfbot_snapshot_bytes', 'Compressed size of the last database snapshot',
+                  function=lambda: streak_bot.snapshots.last['bytes'] if streak_bot.snapshots.last else 0)
+BACKEND_CALL_SECONDS = metrics.histogram(
+    'sfbot_backend_call_seconds', 'Time the cluster launcher took to answer each call from a worker', ['call']
+)
+WORKER_RESTARTS = metrics.counter('sfbot_worker_restarts_total', 'Cluster workers restarted by the launcher', ['worker'])
+
 # Bot setup
-intents = discord.Intents.default()
-intents.messages = True
+# Only the events the bot handles: guilds and their channels, and guild messages
+# with their content. Typing, presence, reaction, voice, emoji and the rest are
+# never sent, which saves the traffic and the objects discord.py builds for them.
+intents = discord.Intents.none()
+intents.guilds = True
+intents.guild_messages = True
 intents.message_content = True
-intents.members = True
-
-bot = commands.Bot(command_prefix='!', intents=intents)
-
-# Database setup with migration
-def init_db():
-    conn = sqlite3.connect('streaks.db')
-    c = conn.cursor()
-    
-    # Create table if it doesn't exist
-    c.execute('''
-        CREATE TABLE IF NOT EXISTS user_streaks (
-            user_id INTEGER PRIMARY KEY,
-            streak_days INTEGER DEFAULT 0,
-            last_post_date TEXT,
-            username TEXT,
-            score INTEGER DEFAULT 0
-        )
-    ''')
-    
-    # Check if score column exists, if not add it
-    try:
-        c.execute('SELECT score FROM user_streaks LIMIT 1')
-    except sqlite3.OperationalError:
-        print("Adding score column to database...")
-        c.execute('ALTER TABLE user_streaks ADD COLUMN score INTEGER DEFAULT 0')
-        print("Score column added successfully!")
-    
-    conn.commit()
-    conn.close()
+if MEMBER_CACHE == 'none':
+    member_cache_flags = discord.MemberCacheFlags.none()
+elif MEMBER_CACHE == 'joined':
+    member_cache_flags = discord.MemberCacheFlags.none()
+    member_cache_flags.joined = True
+    intents.members = True
+elif MEMBER_CACHE == 'all':
+    member_cache_flags = discord.MemberCacheFlags.all()
+    intents.members = True
+    intents.voice_states = True
+else:
+    raise ValueError(f"MEMBER_CACHE must be 'none', 'joined' or 'all', not {MEMBER_CACHE!r}")
+if CHUNK_GUILDS_AT_STARTUP and MEMBER_CACHE == 'none':
+    raise ValueError("CHUNK_GUILDS_AT_STARTUP needs MEMBER_CACHE set to 'joined' or 'all'")
+
+class SFCommandTree(discord.app_commands.CommandTree):
+    async def interaction_check(self, interaction):
+        # Runs in the task that invokes the command, so its log lines share the interaction ID
+        new_correlation_id(interaction.id)
+        interaction.extras['started'] = time.perf_counter()
+        return True
+
+class SFBot(commands.AutoShardedBot):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.metrics_server = None
+        self.loop_lag = LoopLagMonitor(LOOP_LAG)
+
+    async def setup_hook(self):
+        await streak_bot.start()
+        refresh_image_channels.start()
+        prune_image_hashes.start()
+        report_shards.start()
+        # Railway and the cluster launcher both stop the bot with SIGTERM; close so
+        # queued writes and re-posts still go out. Windows loops can't take signal handlers.
+        with contextlib.suppress(NotImplementedError):
+            asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, lambda: asyncio.ensure_future(self.close()))
+        if streak_bot.backend is None and SNAPSHOT_HOURS:
+            # Cluster workers leave snapshots to the launcher, which owns the database
+            take_snapshots.start()
+        if METRICS_PORT:
+            self.loop_lag.start()
+            self.metrics_server = MetricsServer(metrics, METRICS_HOST, METRICS_PORT)
+            await self.metrics_server.start()
+            log.info("Serving metrics on %s:%d", METRICS_HOST, METRICS_PORT, extra={'event': 'metrics.started'})
+
+    async def before_identify_hook(self, shard_id, *, initial=False):
+        if streak_bot.backend is None:
+            await super().before_identify_hook(shard_id, initial=initial)
+        else:
+            # Other workers' shards identify too, so the launcher spaces them all out
+            await streak_bot.backend.call('cluster.identify', shard_id)
 
-init_db()
+    async def close(self):
+        # Let queued deletes and re-posts go out while the connection is still up
+        await streak_bot.outbound.close()
+        await super().close()
+        if self.metrics_server:
+            await self.metrics_server.stop()
+        await self.loop_lag.stop()
+        await streak_bot.close()
+
+bot = SFBot(
+    command_prefix='!',
+    shard_count=SHARD_COUNT,
+    shard_ids=SHARD_IDS,
+    intents=intents,
+    member_cache_flags=member_cache_flags,
+    chunk_guilds_at_startup=CHUNK_GUILDS_AT_STARTUP,
+    max_messages=MESSAGE_CACHE_SIZE or None,
+    tree_cls=SFCommandTree,
+)
+
+class StageTimings:
+    """Running count, total and worst time for each stage of image handling"""
+    def __init__(self, histogram=None):
+        self.stages = {}
+        self.histogram = histogram
+
+    def record(self, stage, seconds):
+        count, total, worst = self.stages.get(stage, (0, 0.0, 0.0))
+        self.stages[stage] = (count + 1, total + seconds, max(worst, seconds))
+        if self.histogram is not None:
+            self.histogram.observe(seconds, stage)
+
+    @contextlib.contextmanager
+    def measure(self, stage):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(stage, time.perf_counter() - start)
 
 class StreakBot:
     def __init__(self):
-        # Set your image channel IDs here
-        self.image_channels = [
-            1433779537786961982,  # Your image channel ID
-        ]
-        print(f"Image channels set to: {self.image_channels}")
-    
+        # A cluster worker uses the database, store and snapshots of the launcher
+        self.backend = RemoteBackend(CLUSTER_SOCKET) if CLUSTER_WORKER is not None else None
+        if self.backend is not None:
+            self.db = self.backend.proxy('db')
+            self.store = self.backend.proxy('store')
+            self.snapshots = self.backend.proxy('snapshots')
+        else:
+            self._create_storage()
+        # Image channels per guild, managed with !set_image / !remove_image
+        self.image_channels = ChannelRegistry(self.db)
+        self.command_syncs = CommandSyncs(self.db)
+        self.duplicates = DuplicateIndex(
+            self.db, self.store.writes, threshold=DUPLICATE_THRESHOLD, window_days=DUPLICATE_WINDOW_DAYS,
+            owns=self.owns_guild if SHARD_IDS else None
+        )
+        self.http = None
+        self.image_pool = None
+        # Bounds on attachments being downloaded and processed at once
+        self.download_slots = asyncio.Semaphore(DOWNLOAD_CONCURRENCY)
+        self.guild_download_slots = {}
+        # Deletes and re-posts go through one queue per channel
+        self.outbound = OutboundScheduler(merge_window=OUTBOUND_MERGE_MS / 1000)
+        self.timings = StageTimings(STAGE_SECONDS)
+        # Background !recompute job, if one is running
+        self.recompute = None
+        self.recompute_task = None
+
+    def _create_storage(self):
+        self.db = Database(DATABASE_PATH, readers=DB_READERS)
+        self.db.observe = lambda statement, seconds: DB_STATEMENT_SECONDS.observe(seconds, statement)
+        if STORAGE_ENGINE == 'memory':
+            self.store = MemoryStreakStore(
+                self.db,
+                batch_size=WRITE_BATCH_SIZE,
+                batch_delay=WRITE_BATCH_MS / 1000,
+                checkpoint_interval=CHECKPOINT_SECONDS,
+            )
+        elif STORAGE_ENGINE == 'sqlite':
+            self.store = StreakStore(
+                self.db,
+                batch_size=WRITE_BATCH_SIZE,
+                batch_delay=WRITE_BATCH_MS / 1000,
+                cache_size=STATS_CACHE_SIZE,
+                cache_ttl=STATS_CACHE_TTL,
+            )
+        else:
+            raise ValueError(f"STORAGE_ENGINE must be 'sqlite' or 'memory', not {STORAGE_ENGINE!r}")
+        self.snapshots = Snapshots(
+            DATABASE_PATH, SNAPSHOT_DIR, keep=SNAPSHOT_KEEP, keep_days=SNAPSHOT_KEEP_DAYS, pages=SNAPSHOT_PAGES
+        )
+
+    def owns_guild(self, guild_id):
+        """Whether the guild is on one of this process's shards"""
+        return (guild_id >> 22) % SHARD_COUNT in SHARD_IDS
+
+    async def open_storage(self):
+        """Open the database and store, or connect to the cluster launcher that holds them"""
+        if self.backend is None:
+            await self.db.open()
+            await self.store.start()
+            return
+        await self.backend.connect()
+        # Losing the launcher means losing storage; it starts a fresh worker if it's still there
+        self.backend.on_disconnect = lambda: asyncio.ensure_future(bot.close())
+        # Tell the other workers about image channel changes instead of waiting for their refresh
+        self.image_channels.on_change = lambda: self.backend.publish('image_channels')
+        self.backend.subscribe('image_channels', self.image_channels.load)
+
+    async def close_storage(self):
+        if self.backend is not None:
+            await self.backend.close()
+            return
+        # Flush queued streak updates before the connection goes away
+        await self.store.close()
+        await self.db.close()
+
+    async def start(self):
+        """Open long-lived resources (called once from setup_hook)"""
+        await self.open_storage()
+        await self.image_channels.load()
+        log.info("Image channels set to: %s", sorted(self.image_channels.channels), extra={'event': 'channels.loaded'})
+        await self.duplicates.load()
+        # One keep-alive session for every attachment download
+        connector = aiohttp.TCPConnector(limit=HTTP_POOL_SIZE, ttl_dns_cache=300)
+        self.http = aiohttp.ClientSession(
+            connector=connector,
+            timeout=aiohttp.ClientTimeout(total=30, sock_connect=10),
+        )
+        self.image_pool = ProcessPoolExecutor(max_workers=IMAGE_WORKERS)
+
+    async def close(self):
+        """Release long-lived resources on shutdown"""
+        if self.recompute_task:
+            # It resumes from its checkpoint next time
+            self.recompute_task.cancel()
+            await asyncio.gather(self.recompute_task, return_exceptions=True)
+        if self.http:
+            await self.http.close()
+        if self.image_pool:
+            self.image_pool.shutdown(wait=False, cancel_futures=True)
+        await self.close_storage()
+
+    async def adopt_default_channels(self):
+        """Register DEFAULT_IMAGE_CHANNELS the first time the bot runs with the registry"""
+        if self.image_channels.version:
+            return
+        for channel_id in DEFAULT_IMAGE_CHANNELS:
+            channel = bot.get_channel(channel_id)
+            if channel and channel.guild:
+                await self.image_channels.add(channel.guild.id, channel_id)
+                log.info("Registered default image channel %s for %s", channel_id, channel.guild.name,
+                         extra={'event': 'channels.adopted'})
+
     def is_image_channel(self, channel_id):
         """Check if the channel is an image-only channel"""
-        result = channel_id in self.image_channels
-        return result
-
-    def get_user_data(self, user_id):
-        conn = sqlite3.connect('streaks.db')
-        c = conn.cursor()
-        c.execute('SELECT streak_days, last_post_date, score FROM user_streaks WHERE user_id = ?', (user_id,))
-        result = c.fetchone()
-        conn.close()
-        return result
-
-    def update_user_streak_and_score(self, user_id, username):
-        conn = sqlite3.connect('streaks.db')
-        c = conn.cursor()
+        return channel_id in self.image_channels
+
+    async def get_user_data(self, user_id):
+        """Return UserStats (streak_days, last_post_date, score, last_post_day) or None"""
+        return await self.store.get_user_stats(user_id)
+
+    async def update_user_streak_and_score(self, user_id, username, message_id=None, guild_id=None, images=1):
         today = datetime.datetime.now().strftime('%Y-%m-%d')
-        
-        # Get current streak and score
-        c.execute('SELECT streak_days, last_post_date, score FROM user_streaks WHERE user_id = ?', (user_id,))
-        result = c.fetchone()
-        
-        if result:
-            streak_days, last_post_date, current_score = result
-            if last_post_date:
-                last_date = datetime.datetime.strptime(last_post_date, '%Y-%m-%d').date()
-                current_date = datetime.datetime.now().date()
-                
-                # Check if user posted yesterday (maintains streak)
-                if (current_date - last_date).days == 1:
-                    streak_days += 1
-                elif (current_date - last_date).days > 1:
-                    streak_days = 1  # Reset streak if missed a day
-                # If same day, don't increase streak
-            else:
-                streak_days = 1
-            
-            # Update score by +3
-            new_score = current_score + 3
-        else:
-            streak_days = 1
-            new_score = 3  # Start with 3 points for first image
-        
-        # Update or insert user record
-        c.execute('''
-            INSERT OR REPLACE INTO user_streaks (user_id, streak_days, last_post_date, username, score)
-            VALUES (?, ?, ?, ?, ?)
-        ''', (user_id, streak_days, today, username, new_score))
-        
-        conn.commit()
-        conn.close()
-        return streak_days, new_score
+        return await self.store.record_post(user_id, username, today, message_id, guild_id, images)
 
-    async def download_image(self, url):
-        """Download image from URL"""
+    async def download_image(self, url, max_bytes=MAX_IMAGE_BYTES):
+        """Download image from URL, giving up once it grows past max_bytes"""
         try:
-            print(f"Downloading image from: {url}")
-            timeout = aiohttp.ClientTimeout(total=30)
-            async with aiohttp.ClientSession(timeout=timeout) as session:
-                async with session.get(url) as response:
-                    if response.status == 200:
-                        image_data = await response.read()
-                        print(f"Successfully downloaded image, size: {len(image_data)} bytes")
-                        return image_data
-                    else:
-                        print(f"Failed to download image. Status: {response.status}")
+            log.debug("Downloading image", extra={'event': 'image.download.start', 'url': url})
+            async with self.http.get(url) as response:
+                if response.status != 200:
+                    log.warning("Failed to download image", extra={'event': 'image.download.failed', 'status': response.status})
+                    return None
+
+                # Refuse oversize files before reading any of the body
+                if response.content_length is not None and response.content_length > max_bytes:
+                    log.info("Image too large, skipping download",
+                             extra={'event': 'image.download.too_large', 'bytes': response.content_length})
+                    return None
+
+                buffer = bytearray()
+                async for chunk in response.content.iter_chunked(DOWNLOAD_CHUNK_SIZE):
+                    buffer.extend(chunk)
+                    if len(buffer) > max_bytes:
+                        log.info("Image exceeded the size limit while streaming, aborting download",
+                                 extra={'event': 'image.download.too_large', 'limit': max_bytes})
                         return None
+
+                log.debug("Downloaded image", extra={'event': 'image.download.done', 'bytes': len(buffer)})
+                return bytes(buffer)
         except Exception as e:
-            print(f"Error downloading image: {e}")
+            log.warning("Error downloading image: %s", e, extra={'event': 'image.download.failed'})
             return None
 
+    def _guild_download_slots(self, guild_id):
+        slots = self.guild_download_slots.get(guild_id)
+        if slots is None:
+            slots = self.guild_download_slots[guild_id] = asyncio.Semaphore(GUILD_DOWNLOAD_CONCURRENCY)
+        return slots
+
+    async def prepare_image(self, attachment, guild_id, user_id):
+        """Download, dedupe and recompress one attachment.
+
+        Returns ('ok', (image_bytes, filename, image_hash)), ('duplicate',
+        posted_at) or (reason, None) for an image that was skipped. The hash,
+        if any, is held in the duplicate index for the caller to save or
+        discard. Holds a per-guild and then
+        a global slot throughout, so a flood of posts in one guild can't take
+        every socket, and only a bounded number of raw images is in memory.
+        """
+        # Discord tells us the size up front, so skip oversize files without downloading
+        if attachment.size > MAX_IMAGE_BYTES:
+            log.info("Attachment over the size limit, ignoring",
+                     extra={'event': 'image.too_large', 'bytes': attachment.size})
+            IMAGES_IGNORED.inc('too_large')
+            return 'too_large', None
+
+        async with self._guild_download_slots(guild_id), self.download_slots:
+            with self.timings.measure('download'):
+                image_data = await self.download_image(attachment.url)
+            if not image_data:
+                log.warning("Image download failed, skipping it", extra={'event': 'image.failed'})
+                IMAGES_FAILED.inc('download')
+                return 'failed', None
+
+            # Reposts of a recent image don't earn points, so stop before deleting anything
+            with self.timings.measure('hash'):
+                image_hash = await self.hash_image(image_data)
+            if image_hash is not None:
+                duplicate = self.duplicates.check_and_add(guild_id, image_hash, user_id)
+                if duplicate:
+                    distance, original_user, posted_at = duplicate
+                    log.info("Duplicate image, ignoring",
+                             extra={'event': 'image.duplicate', 'distance': distance, 'original_user': original_user})
+                    IMAGES_IGNORED.inc('duplicate')
+                    return 'duplicate', posted_at
+
+            # Shrink the image and strip its metadata before re-uploading it
+            try:
+                with self.timings.measure('process'):
+                    image_data, filename = await self.process_image(image_data, attachment.filename)
+            except BaseException:
+                if image_hash is not None:
+                    self.duplicates.discard(guild_id, image_hash)
+                raise
+            return 'ok', (image_data, filename, image_hash)
+
+    async def hash_image(self, image_data):
+        """Perceptual hash of an image from the worker pool, or None if it can't be
+        decoded or is too flat to tell apart from other images"""
+        loop = asyncio.get_running_loop()
+        try:
+            image_hash = await loop.run_in_executor(self.image_pool, dhash, image_data)
+            if DUPLICATE_MIN_BITS <= image_hash.bit_count() <= 64 - DUPLICATE_MIN_BITS:
+                return image_hash
+            log.info("Image too flat to check for duplicates", extra={'event': 'image.hash.flat'})
+        except BrokenProcessPool:
+            log.error("Image worker pool broke, restarting it", extra={'event': 'image.pool.broken'})
+            self.image_pool = ProcessPoolExecutor(max_workers=IMAGE_WORKERS)
+        except Exception as e:
+            log.warning("Could not hash image: %s", e, extra={'event': 'image.hash.failed'})
+        return None
+
+    async def process_image(self, image_data, filename):
+        """Recompress an image in the worker pool; return (image_bytes, filename)"""
+        loop = asyncio.get_running_loop()
+        try:
+            data, extension, timings = await loop.run_in_executor(
+                self.image_pool, recompress, image_data, IMAGE_MAX_DIMENSION, IMAGE_FORMAT, IMAGE_QUALITY
+            )
+        except BrokenProcessPool:
+            # A worker died (e.g. out of memory); start a fresh pool for the next image
+            log.error("Image worker pool broke, restarting it and sending the original image",
+                      extra={'event': 'image.pool.broken'})
+            self.image_pool = ProcessPoolExecutor(max_workers=IMAGE_WORKERS)
+            return image_data, filename
+        except Exception as e:
+            log.warning("Could not recompress image, sending the original: %s", e,
+                        extra={'event': 'image.process.failed'})
+            return image_data, filename
+
+        for stage, seconds in timings.items():
+            self.timings.record(f"process.{stage}", seconds)
+        log.debug("Recompressed image",
+                  extra={'event': 'image.process.done', 'bytes_in': len(image_data), 'bytes_out': len(data)})
+        return data, f"streak_image.{extension}"
+
 streak_bot = StreakBot()
 
 @bot.event
 async def on_ready():
-    print(f'{bot.user} has logged in!')
-    print(f'Bot is in {len(bot.guilds)} guilds')
+    log.info("%s has logged in! Bot is in %d guilds", bot.user, len(bot.guilds), extra={'event': 'bot.ready'})
     
     # Set bot status
     await bot.change_presence(
@@ -139,19 +562,73 @@ async def on_ready():
         )
     )
     
-    # Sync slash commands to specific guild for faster updates
-    for guild in bot.guilds:
-        try:
-            bot.tree.copy_global_to(guild=guild)
-            synced = await bot.tree.sync(guild=guild)
-            print(f"Synced {len(synced)} commands to {guild.name}")
-        except Exception as e:
-            print(f"Failed to sync commands to {guild.name}: {e}")
+    # on_ready fires again after every reconnect, so only sync guilds whose commands changed
+    await sync_commands(bot.guilds)
     
-    reset_streaks.start()
+    await streak_bot.adopt_default_channels()
+    # In a cluster the launcher expires streaks, as it holds the store
+    if streak_bot.backend is None and not reset_streaks.is_running():
+        reset_streaks.start()
+
+@bot.event
+async def on_shard_ready(shard_id):
+    log.info("Shard %d is ready", shard_id, extra={'event': 'shard.ready', 'shard': shard_id})
+
+@bot.event
+async def on_shard_connect(shard_id):
+    SHARD_EVENTS.inc(shard_id, 'connect')
+
+@bot.event
+async def on_shard_disconnect(shard_id):
+    SHARD_EVENTS.inc(shard_id, 'disconnect')
+    log.info("Shard %d disconnected", shard_id, extra={'event': 'shard.disconnected', 'shard': shard_id})
+
+@bot.event
+async def on_shard_resumed(shard_id):
+    SHARD_EVENTS.inc(shard_id, 'resume')
+
+@bot.event
+async def on_guild_join(guild):
+    await sync_commands([guild])
+
+def command_tree_hash():
+    """Hash of the slash commands as Discord sees them"""
+    payload = sorted((command.to_dict(bot.tree) for command in bot.tree.get_commands()), key=lambda c: c['name'])
+    return hashlib.sha256(json.dumps(payload, sort_keys=True).encode()).hexdigest()
+
+async def sync_guild_commands(guild, tree_hash):
+    """Sync slash commands to one guild and remember what was synced"""
+    bot.tree.copy_global_to(guild=guild)
+    synced = await bot.tree.sync(guild=guild)
+    await streak_bot.command_syncs.save(guild.id, tree_hash)
+    return synced
+
+async def sync_commands(guilds):
+    """Sync slash commands to guilds with a stale command tree, a few at a time"""
+    tree_hash = command_tree_hash()
+    synced_hashes = await streak_bot.command_syncs.load()
+    stale = [guild for guild in guilds if synced_hashes.get(guild.id) != tree_hash]
+    if not stale:
+        log.info("Slash commands are up to date in all %d guilds", len(guilds), extra={'event': 'commands.up_to_date'})
+        return
+    
+    semaphore = asyncio.Semaphore(COMMAND_SYNC_CONCURRENCY)
+    
+    async def sync_one(guild):
+        async with semaphore:
+            try:
+                synced = await sync_guild_commands(guild, tree_hash)
+                log.info("Synced %d commands to %s", len(synced), guild.name, extra={'event': 'commands.synced'})
+            except Exception as e:
+                log.warning("Failed to sync commands to %s: %s", guild.name, e, extra={'event': 'commands.sync_failed'})
+    
+    await asyncio.gather(*(sync_one(guild) for guild in stale))
 
 @bot.event
 async def on_message(message):
+    # Every log line about this message, commands included, carries its ID
+    new_correlation_id(message.id)
+    
     # Process commands FIRST (in ALL channels)
     await bot.process_commands(message)
     
@@ -159,73 +636,99 @@ async def on_message(message):
     if message.author.bot:
         return
     
-    print(f"Message received in channel {message.channel.id} ({message.channel.name})")
-    
     # Check if message is in an image channel
     if not streak_bot.is_image_channel(message.channel.id):
-        print(f"Channel {message.channel.id} is NOT an image channel, ignoring images...")
         return
     
-    print(f"Message received in channel {message.channel.id} ({message.channel.name})")
+    log.debug("Message received in image channel %s", message.channel.id, extra={'event': 'image.received'})
     
-    # Check if message is in an image channel
-    if not streak_bot.is_image_channel(message.channel.id):
-        print(f"Channel {message.channel.id} is NOT an image channel, ignoring images...")
+    # Check if message has image attachments
+    image_attachments = [att for att in message.attachments
+                         if att.content_type and att.content_type.startswith('image/')]
+    if not image_attachments:
         return
     
-    print(f"Channel {message.channel.id} IS an image channel, processing images...")
-    
-    # Check if message has an image attachment
-    if message.attachments:
-        image_attachments = [att for att in message.attachments 
-                           if att.content_type and att.content_type.startswith('image/')]
+    # Hashes of the images being re-posted, held until they have gone out
+    held = []
+    try:
+        log.debug("Processing %d images from %s", len(image_attachments), message.author.display_name,
+                  extra={'event': 'image.processing'})
         
-        if image_attachments:
-            try:
-                print(f"Processing image from {message.author.display_name} in image channel {message.channel.name}...")
-                
-                # Get user info and image URL
-                user_id = message.author.id
-                username = message.author.display_name
-                image_url = image_attachments[0].url
-                
-                # DOWNLOAD THE IMAGE FIRST (before deleting the message)
-                print("Downloading image before deletion...")
-                image_data = await streak_bot.download_image(image_url)
-                
-                if not image_data:
-                    print("Image download failed, aborting...")
-                    return
-                
-                # NOW delete the original message
-                await message.delete()
-                print("Original message deleted")
-                
-                # Update streak and score (+3 points)
-                streak_days, new_score = streak_bot.update_user_streak_and_score(user_id, username)
-                print(f"User streak: {streak_days} days, Score: {new_score} points")
-                
-                # Create caption with mention, streak, and score
-                fire_emoji = "🔥" if streak_days >= 3 else "⭐" if streak_days >= 2 else "📸"
-                caption = f"📸 {message.author.mention}'s streak: {streak_days} {fire_emoji} | Score: {new_score} 🏆"
-                
-                # Create file from image data
-                file = discord.File(io.BytesIO(image_data), filename="streak_image.png")
-                
-                # Send the image with caption
-                await message.channel.send(content=caption, file=file)
-                print(f"Successfully sent image with caption for {username}")
-                
-            except Exception as e:
-                error_msg = f"❌ Error processing image: {str(e)}"
-                await message.channel.send(error_msg)
-                print(f"Unexpected error: {e}")
-                import traceback
-                traceback.print_exc()
-        else:
-            print("No image attachments found in message")
-    else:
-        print("No attachments found in message")
+        # Get user info
+        user_id = message.author.id
+        username = message.author.display_name
+        
+        # Scoring: a post earns +3 points and one streak day however many images it has.
+        # Reposted images are dropped from it, and a post of nothing but reposts earns nothing.
+        image_attachments = image_attachments[:MAX_IMAGES_PER_POST]
+        
+        # DOWNLOAD THE IMAGES FIRST (before deleting the message), all at once
+        # Every download is waited for even if one fails, so no image's hash is left held
+        results = await asyncio.gather(*(
+            streak_bot.prepare_image(attachment, message.guild.id, user_id) for attachment in image_attachments
+        ), return_exceptions=True)
+        errors = [result for result in results if isinstance(result, BaseException)]
+        results = [result for result in results if not isinstance(result, BaseException)]
+        images = [value for status, value in results if status == 'ok']
+        reposted_at = [value for status, value in results if status == 'duplicate']
+        held = [image_hash for _, _, image_hash in images if image_hash is not None]
+        if errors:
+            raise errors[0]
+        
+        if not images:
+            if reposted_at:
+                if len(image_attachments) == 1:
+                    text = f"♻️ This image was already posted <t:{reposted_at[0]}:R>, so it doesn't earn points. Post something new!"
+                else:
+                    text = "♻️ These images were already posted, so they don't earn points. Post something new!"
+                await message.reply(text, delete_after=15)
+            return
+        
+        # NOW delete the original message
+        with streak_bot.timings.measure('delete'):
+            await streak_bot.outbound.delete(message)
+        
+        # Update streak and score (+3 points)
+        with streak_bot.timings.measure('db'):
+            streak_days, new_score = await streak_bot.update_user_streak_and_score(
+                user_id, username, message.id, message.guild.id, len(images)
+            )
+        
+        # Create caption with mention, streak, and score
+        fire_emoji = "🔥" if streak_days >= 3 else "⭐" if streak_days >= 2 else "📸"
+        caption = f"📸 {message.author.mention}'s streak: {streak_days} {fire_emoji} | Score: {new_score} 🏆"
+        if reposted_at:
+            caption += f" | ♻️ {len(reposted_at)} reposted image(s) left out"
+        
+        # Create files from image data, numbered so they keep their order
+        files = []
+        for number, (image_data, filename, _) in enumerate(images, 1):
+            if len(images) > 1:
+                stem, _, extension = filename.rpartition('.')
+                filename = f"{stem}_{number}.{extension}"
+            files.append(discord.File(io.BytesIO(image_data), filename=filename))
+        
+        # Send the images with caption
+        with streak_bot.timings.measure('send'):
+            repost = await streak_bot.outbound.send(message.channel, user_id, caption, files)
+        # Only now do the images count as posted; if anything before failed, the user can post them again
+        for image_hash in held:
+            streak_bot.duplicates.save(message.guild.id, image_hash)
+        held = []
+        # So !recompute knows whether its history scan will find this post
+        await streak_bot.store.record_repost(message.id, repost.id)
+        log.info("Posted %d images for %s", len(files), username,
+                 extra={'event': 'image.posted', 'streak': streak_days, 'score': new_score, 'images': len(files)})
+        IMAGES_PROCESSED.inc(amount=len(files))
+        
+    except Exception as e:
+        IMAGES_FAILED.inc('error')
+        error_msg = f"❌ Error processing image: {str(e)}"
+        await message.channel.send(error_msg)
+        log.exception("Unexpected error processing image", extra={'event': 'image.failed'})
+    finally:
+        for image_hash in held:
+            streak_bot.duplicates.discard(message.guild.id, image_hash)
 
 # Channel check for slash commands - BLOCK commands in image channels
 def not_image_channel():
@@ -243,11 +746,10 @@ async def sync(ctx):
     
     try:
         # Sync to specific guild for immediate effect
-        bot.tree.copy_global_to(guild=ctx.guild)
-        synced = await bot.tree.sync(guild=ctx.guild)
+        synced = await sync_guild_commands(ctx.guild, command_tree_hash())
         
         await ctx.send(f"✅ Synced {len(synced)} slash command(s)! They should be available immediately.")
-        print(f"Manually synced {len(synced)} slash commands to {ctx.guild.name}")
+        log.info("Manually synced %d slash commands to %s", len(synced), ctx.guild.name, extra={'event': 'commands.synced'})
         
     except Exception as e:
         await ctx.send(f"❌ Failed to sync slash commands: {e}")
@@ -260,10 +762,10 @@ async def set_image(ctx):
         return
     
     channel_id = ctx.channel.id
-    if channel_id not in streak_bot.image_channels:
-        streak_bot.image_channels.append(channel_id)
+    if await streak_bot.image_channels.add(ctx.guild.id, channel_id):
         await ctx.send(f"✅ Set {ctx.channel.mention} as an image channel! Bot will now process images here.")
-        print(f"Added channel {channel_id} to image channels. Current image channels: {streak_bot.image_channels}")
+        log.info("Added channel %s to image channels. Current image channels: %s",
+                 channel_id, sorted(streak_bot.image_channels.for_guild(ctx.guild.id)), extra={'event': 'channels.added'})
     else:
         await ctx.send(f"✅ {ctx.channel.mention} is already an image channel!")
 
@@ -276,9 +778,10 @@ async def list_image_channels(ctx):
         await ctx.send("❌ You need administrator permissions to use this command.")
         return
     
-    if streak_bot.image_channels:
+    guild_channels = sorted(streak_bot.image_channels.for_guild(ctx.guild.id))
+    if guild_channels:
         channel_mentions = []
-        for channel_id in streak_bot.image_channels:
+        for channel_id in guild_channels:
             channel = bot.get_channel(channel_id)
             if channel:
                 channel_mentions.append(f"{channel.mention} (ID: {channel_id})")
@@ -313,7 +816,7 @@ async def debug_channels(ctx):
     
     # Image channels info
     image_info = []
-    for channel_id in streak_bot.image_channels:
+    for channel_id in sorted(streak_bot.image_channels.for_guild(ctx.guild.id)):
         channel = bot.get_channel(channel_id)
         if channel:
             image_info.append(f"✅ {channel.name} (ID: {channel_id})")
@@ -333,9 +836,10 @@ async def debug_image_channels(ctx):
     embed = discord.Embed(title="🔍 Image Channels Debug", color=0xFF6B6B)
     
     # Show current image channels
+    guild_channels = sorted(streak_bot.image_channels.for_guild(ctx.guild.id))
     embed.add_field(
         name="Current Image Channels",
-        value=str(streak_bot.image_channels) if streak_bot.image_channels else "Empty list!",
+        value=str(guild_channels) if guild_channels else "Empty list!",
         inline=False
     )
     
@@ -355,7 +859,7 @@ async def debug_image_channels(ctx):
     )
     
     await ctx.send(embed=embed)
-    print(f"Image channels debug: {streak_bot.image_channels}")
+    log.debug("Image channels debug: %s", guild_channels, extra={'event': 'channels.debug'})
 
 @bot.command()
 async def remove_image(ctx):  # REMOVED @not_image_channel()
@@ -365,12 +869,269 @@ async def remove_image(ctx):  # REMOVED @not_image_channel()
         return
     
     channel_id = ctx.channel.id
-    if channel_id in streak_bot.image_channels:
-        streak_bot.image_channels.remove(channel_id)
+    if await streak_bot.image_channels.remove(channel_id):
         await ctx.send(f"✅ Removed {ctx.channel.mention} from image channels! Bot will no longer process images here.")
-        print(f"Removed channel {channel_id} from image channels. Current image channels: {streak_bot.image_channels}")
+        log.info("Removed channel %s from image channels. Current image channels: %s",
+                 channel_id, sorted(streak_bot.image_channels.for_guild(ctx.guild.id)), extra={'event': 'channels.removed'})
     else:
         await ctx.send(f"❌ {ctx.channel.mention} is not an image channel!")
+
+@bot.command()
+async def db_stats(ctx):
+    """Show write queue depth and batch sizes (Admin only)"""
+    if not ctx.author.guild_permissions.administrator:
+        await ctx.send("❌ You need administrator permissions to use this command.")
+        return
+
+    # In a cluster worker these come back from the launcher as futures
+    stats = await awaited(streak_bot.store.writes.stats())
+    embed = discord.Embed(title="🗄️ Database Write Queue", color=0x7289DA)
+    embed.add_field(name="Queue Depth", value=str(stats['queue_depth']), inline=True)
+    embed.add_field(name="Writes Committed", value=str(stats['writes']), inline=True)
+    embed.add_field(name="Failed Writes", value=str(stats['failures']), inline=True)
+    embed.add_field(name="Batches", value=str(stats['batches']), inline=True)
+    embed.add_field(name="Avg Batch Size", value=f"{stats['avg_batch']:.1f}", inline=True)
+    embed.add_field(name="Last / Largest Batch", value=f"{stats['last_batch']} / {stats['largest_batch']}", inline=True)
+
+    store = await awaited(streak_bot.store.stats())
+    if store['engine'] == 'memory':
+        embed.add_field(
+            name="Memory Engine",
+            value=f"{store['users']} users | {store['dirty']} unsaved changes | "
+                  f"{store['checkpoints']} checkpoints ({store['checkpoint_failures']} failed) | last "
+                  f"{store['last_checkpoint_rows']} rows in {store['last_checkpoint_seconds'] * 1000:.0f} ms",
+            inline=False
+        )
+    else:
+        cache = store['cache']
+        embed.add_field(
+            name="Stats Cache",
+            value=f"{cache['size']} users | {cache['hits']} hits / {cache['misses']} misses "
+                  f"({cache['hit_rate']:.0%}) | {cache['evictions']} evictions",
+            inline=False
+        )
+
+    snapshots = await awaited(streak_bot.snapshots.stats())
+    last = snapshots['last']
+    value = f"{snapshots['count']} kept, {snapshots['total_bytes'] / 1e6:.1f} MB"
+    if last:
+        value += (f" | last at {last['taken_at']}: {last['seconds']:.1f}s "
+                  f"({last['backup_seconds']:.1f}s copying), {last['raw_bytes'] / 1e6:.1f} MB → "
+                  f"{last['bytes'] / 1e6:.1f} MB")
+    if snapshots['failures']:
+        value += f" | {snapshots['failures']} failed"
+    embed.add_field(name="Snapshots", value=value, inline=False)
+
+    await ctx.send(embed=embed)
+
+@bot.command()
+async def pipeline_stats(ctx):
+    """Show how long each image handling stage takes (Admin only)"""
+    if not ctx.author.guild_permissions.administrator:
+        await ctx.send("❌ You need administrator permissions to use this command.")
+        return
+
+    embed = discord.Embed(title="⏱️ Image Pipeline Timings", color=0x7289DA)
+    for stage, (count, total, worst) in sorted(streak_bot.timings.stages.items()):
+        embed.add_field(
+            name=stage,
+            value=f"avg {total / count * 1000:.1f} ms | max {worst * 1000:.1f} ms | {count} runs",
+            inline=False
+        )
+    if not streak_bot.timings.stages:
+        embed.description = "No images processed yet!"
+
+    outbound = streak_bot.outbound.stats()
+    embed.add_field(
+        name="Outbound Queue",
+        value=f"{outbound['queue_depth']} waiting in {outbound['channels']} channels | "
+              f"{outbound['messages_sent']} sent ({outbound['merged_sends']} merged) | "
+              f"{outbound['bulk_deletes']} bulk / {outbound['single_deletes']} single deletes",
+        inline=False
+    )
+
+    await ctx.send(embed=embed)
+
+@bot.command(name='export')
+async def export_data(ctx, table: str = 'user_streaks', fmt: str = 'csv'):
+    """Upload a table as gzipped CSV or JSONL (Admin only)"""
+    if not ctx.author.guild_permissions.administrator:
+        await ctx.send("❌ You need administrator permissions to use this command.")
+        return
+    if table not in transfer.TABLES or fmt not in transfer.FORMATS:
+        await ctx.send(f"❌ Usage: `!export [{'|'.join(transfer.TABLES)}] [{'|'.join(transfer.FORMATS)}]`")
+        return
+
+    # Flush queued streak updates so the export includes them
+    await streak_bot.store.flush()
+    start = time.perf_counter()
+    with tempfile.TemporaryDirectory() as directory:
+        # A path rather than a file, so a cluster worker can have the launcher write it
+        path = os.path.join(directory, f'{table}.{fmt}.gz')
+        count = await streak_bot.db.read(transfer.export_file, table, fmt, path, name=f'export {table}')
+        size = os.path.getsize(path)
+        if size > ctx.guild.filesize_limit:
+            await ctx.send(f"❌ The export is {size / 1e6:.1f} MB, over this server's upload limit. "
+                           f"Run `python SF-CLI.py export {table} {table}.{fmt}.gz` on the bot's host instead.")
+            return
+        await ctx.send(
+            f"✅ Exported {count} rows from `{table}` in {time.perf_counter() - start:.1f}s",
+            file=discord.File(path, filename=f'{table}.{fmt}.gz')
+        )
+    log.info("Exported %s rows from %s", count, table, extra={'event': 'transfer.export', 'table': table, 'rows': count})
+
+@bot.command(name='import')
+async def import_data(ctx, table: str = 'user_streaks', on_conflict: str = 'replace'):
+    """Load an attached CSV or JSONL file (optionally .gz) into a table (Admin only)"""
+    if not ctx.author.guild_permissions.administrator:
+        await ctx.send("❌ You need administrator permissions to use this command.")
+        return
+    if table not in transfer.TABLES or on_conflict not in transfer.CONFLICT_MODES or not ctx.message.attachments:
+        await ctx.send(f"❌ Usage: `!import [{'|'.join(transfer.TABLES)}] [{'|'.join(transfer.CONFLICT_MODES)}]` "
+                       f"with a .csv, .jsonl, .csv.gz or .jsonl.gz file attached")
+        return
+
+    attachment = ctx.message.attachments[0]
+    try:
+        fmt = transfer.detect_format(attachment.filename)
+    except ValueError as e:
+        await ctx.send(f"❌ {e}")
+        return
+
+    await ctx.send(f"⏳ Importing `{attachment.filename}` into `{table}`...")
+    if table == 'user_streaks':
+        # Save what the store holds first; changes made during the import go on top of the imported rows
+        await streak_bot.store.begin_bulk()
+    start = time.perf_counter()
+    suffix = '.gz' if attachment.filename.lower().endswith('.gz') else ''
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, 'import.' + fmt + suffix)
+        try:
+            # Stream to disk rather than holding the whole file in memory
+            async with streak_bot.http.get(attachment.url) as response:
+                response.raise_for_status()
+                with open(path, 'wb') as f:
+                    async for chunk in response.content.iter_chunked(DOWNLOAD_CHUNK_SIZE):
+                        f.write(chunk)
+            with transfer.open_text(path, 'r') as source:
+                read, written = await transfer.import_table(streak_bot.db, table, source, fmt, on_conflict)
+        except ValueError as e:
+            await ctx.send(f"❌ Import stopped: {e}. Chunks before the bad row were kept.")
+            return
+        except Exception as e:
+            log.exception("Import into %s failed", table, extra={'event': 'transfer.import_failed', 'table': table})
+            await ctx.send(f"❌ Import failed: {e}")
+            return
+        finally:
+            if table == 'user_streaks':
+                # The leaderboard and stats cache were built from the old rows
+                await streak_bot.store.reload()
+
+    await ctx.send(f"✅ Imported {written} of {read} rows into `{table}` in {time.perf_counter() - start:.1f}s")
+    log.info("Imported %s of %s rows into %s", written, read, table,
+             extra={'event': 'transfer.import', 'table': table, 'rows': written})
+
+@bot.command()
+async def snapshot(ctx):
+    """Take a database snapshot now (Admin only)"""
+    if not ctx.author.guild_permissions.administrator:
+        await ctx.send("❌ You need administrator permissions to use this command.")
+        return
+
+    try:
+        await streak_bot.store.flush()
+        last = await streak_bot.snapshots.create()
+    except Exception as e:
+        log.exception("Snapshot failed", extra={'event': 'snapshot.failed'})
+        await ctx.send(f"❌ Snapshot failed: {e}")
+        return
+    await ctx.send(f"✅ Saved `{os.path.basename(last['path'])}` in {last['seconds']:.1f}s "
+                   f"({last['raw_bytes'] / 1e6:.1f} MB → {last['bytes'] / 1e6:.1f} MB)")
+
+def recompute_summary(status):
+    if status['phase'] == 'scanning':
+        where = f"scanning channel {status['channels_done'] + 1} of {status['channels']}"
+    else:
+        where = status['phase']
+    return (f"{where} | {status['messages_scanned']} messages, {status['posts_found']} posts found | "
+            f"{status['users_written']} users written | {status['elapsed']:.0f}s")
+
+async def run_recompute(ctx, channels):
+    job = streak_bot.recompute
+    message = await ctx.send("⏳ Recompute started...")
+    last_update = time.monotonic()
+
+    def progress(status):
+        nonlocal last_update
+        # Editing is rate limited, so only every few seconds
+        if time.monotonic() - last_update >= RECOMPUTE_PROGRESS_SECONDS:
+            last_update = time.monotonic()
+            asyncio.ensure_future(message.edit(content=f"⏳ Recompute: {recompute_summary(status)}"))
+
+    try:
+        await streak_bot.store.begin_bulk()
+        today = datetime.date.today()
+        try:
+            users = await job.run(channels, today, progress)
+        finally:
+            # The leaderboard and stats cache were built from the old rows
+            await streak_bot.store.reload()
+        await message.edit(content=f"✅ Recompute finished: {users} users rebuilt from "
+                                   f"{job.messages_scanned} messages ({job.posts_found} posts)")
+    except asyncio.CancelledError:
+        await message.edit(content="⏸️ Recompute stopped. Run `!recompute` to resume it.")
+        raise
+    except Exception as e:
+        log.exception("Recompute failed", extra={'event': 'recompute.failed'})
+        await message.edit(content=f"❌ Recompute failed: {e}. Run `!recompute` to resume it.")
+
+@bot.command()
+async def recompute(ctx, action: str = 'start'):
+    """Rebuild streaks and scores from the image channels' history (Admin only).
+
+    !recompute starts or resumes the job, !recompute status shows how far it
+    has got, !recompute stop pauses it and !recompute restart starts over.
+    """
+    if not ctx.author.guild_permissions.administrator:
+        await ctx.send("❌ You need administrator permissions to use this command.")
+        return
+
+    if streak_bot.recompute is None:
+        streak_bot.recompute = Recompute(streak_bot.db, bot.user.id)
+    job = streak_bot.recompute
+    running = streak_bot.recompute_task is not None and not streak_bot.recompute_task.done()
+
+    if action == 'status':
+        if running:
+            await ctx.send(f"⏳ Recompute: {recompute_summary(job.status())}")
+        elif await job.load():
+            await ctx.send("⏸️ A recompute is paused. Run `!recompute` to resume it.")
+        else:
+            await ctx.send("No recompute is running.")
+    elif action == 'stop':
+        if not running:
+            await ctx.send("❌ No recompute is running.")
+            return
+        streak_bot.recompute_task.cancel()
+    elif action in ('start', 'restart'):
+        if running:
+            await ctx.send("❌ A recompute is already running. Use `!recompute status` to check on it.")
+            return
+        if action == 'restart':
+            await job.discard()
+        channels = []
+        for channel_id in streak_bot.image_channels.channels:
+            channel = bot.get_channel(channel_id)
+            if channel is None and streak_bot.backend is not None:
+                # Channels on other workers' shards aren't cached here, but their history can still be read
+                with contextlib.suppress(discord.HTTPException):
+                    channel = await bot.fetch_channel(channel_id)
+            if channel:
+                channels.append(channel)
+        streak_bot.recompute_task = asyncio.create_task(run_recompute(ctx, channels))
+    else:
+        await ctx.send("❌ Usage: `!recompute [start|status|stop|restart]`")
+
 # Slash Commands - BLOCKED in image channels
 
 @bot.tree.command(name="streak", description="Check your current streak days")
@@ -378,10 +1139,10 @@ async def remove_image(ctx):  # REMOVED @not_image_channel()
 async def streak_slash(interaction: discord.Interaction):
     """Check your current streak days"""
     try:
-        user_data = streak_bot.get_user_data(interaction.user.id)
+        user_data = await streak_bot.get_user_data(interaction.user.id)
         
         if user_data:
-            streak_days, last_post_date, score = user_data
+            streak_days, last_post_date, score, last_post_day = user_data
             embed = discord.Embed(
                 title="🔥 Your Streak",
                 color=0xFF6B6B
@@ -399,11 +1160,10 @@ async def streak_slash(interaction: discord.Interaction):
             embed.add_field(name="Last Post", value=last_post_date, inline=True)
             embed.add_field(name="Total Score", value=f"{score} points", inline=True)
             
-            last_post_datetime = datetime.datetime.strptime(last_post_date, '%Y-%m-%d').date()
             today = datetime.datetime.now().date()
             
             if streak_days > 0:
-                if last_post_datetime == today:
+                if last_post_day == today:
                     embed.add_field(
                         name="Status", 
                         value="✅ You've posted today! Keep the streak alive!", 
@@ -440,10 +1200,10 @@ async def streak_slash(interaction: discord.Interaction):
 async def score_slash(interaction: discord.Interaction):
     """Check your current score and stats"""
     try:
-        user_data = streak_bot.get_user_data(interaction.user.id)
+        user_data = await streak_bot.get_user_data(interaction.user.id)
         
         if user_data:
-            streak_days, last_post_date, score = user_data
+            streak_days, last_post_date, score, last_post_day = user_data
             embed = discord.Embed(
                 title="🏆 Your Stats",
                 color=0x7289DA
@@ -462,11 +1222,10 @@ async def score_slash(interaction: discord.Interaction):
             points_needed = next_milestone - score
             embed.add_field(name="Next Milestone", value=f"{next_milestone} points ({points_needed} more)", inline=True)
             
-            last_post_datetime = datetime.datetime.strptime(last_post_date, '%Y-%m-%d').date()
             today = datetime.datetime.now().date()
             
             if streak_days > 0:
-                if last_post_datetime == today:
+                if last_post_day == today:
                     embed.add_field(
                         name="Daily Status", 
                         value="✅ Daily post completed! +3 points earned!", 
@@ -489,43 +1248,94 @@ async def score_slash(interaction: discord.Interaction):
     except Exception as e:
         await interaction.response.send_message("Error retrieving your stats.")
 
+def leaderboard_field(ranking, rank, username, score, streak_days):
+    """Embed field (name, value) for one leaderboard row"""
+    medal = "🥇" if rank == 1 else "🥈" if rank == 2 else "🥉" if rank == 3 else f"{rank}."
+    if ranking == 'score':
+        return f"{medal} {username}", f"**{score} points** | {streak_days} day streak"
+    
+    # Different fire emojis based on streak length
+    if streak_days >= 7:
+        fire = "🔥🔥🔥"
+    elif streak_days >= 3:
+        fire = "🔥🔥"
+    else:
+        fire = "🔥"
+    return f"{medal} {username}", f"**{streak_days} days** {fire} | {score} points"
+
+def build_leaderboard_embed(ranking, page):
+    """Embed for one page of the score or streak leaderboard"""
+    start, rows, _ = page
+    if ranking == 'score':
+        embed = discord.Embed(title="🏆 Score Leaderboard", color=0xFFD700)
+        what = "total score"
+    else:
+        embed = discord.Embed(title="🔥 Streak Leaderboard", color=0xFF6B6B)
+        what = "current streak"
+    
+    if start == 1:
+        embed.description = f"Top {LEADERBOARD_PAGE_SIZE} users by {what}"
+    else:
+        embed.description = f"Ranks {start}-{start + len(rows) - 1} by {what}"
+    
+    for rank, (_, _, username, score, streak_days, _) in enumerate(rows, start):
+        name, value = leaderboard_field(ranking, rank, username, score, streak_days)
+        embed.add_field(name=name, value=value, inline=False)
+    return embed
+
+class LeaderboardView(discord.ui.View):
+    """Previous/Next buttons that page through a leaderboard.
+
+    Pages are fetched by keyset (the key of the first or last row on screen)
+    rather than by offset, so deep pages cost the same as the first one.
+    """
+    def __init__(self, ranking, page):
+        super().__init__(timeout=300)
+        self.ranking = ranking
+        self._show(page)
+    
+    def _show(self, page):
+        start, rows, has_more = page
+        self.first_key = rows[0][0]
+        self.last_key = rows[-1][0]
+        self.previous_page.disabled = start <= 1
+        self.next_page.disabled = not has_more
+    
+    async def _turn(self, interaction, **cursor):
+        page = await streak_bot.store.leaderboard_page(self.ranking, limit=LEADERBOARD_PAGE_SIZE, **cursor)
+        if not page[1]:
+            await interaction.response.defer()
+            return
+        self._show(page)
+        await interaction.response.edit_message(embed=build_leaderboard_embed(self.ranking, page), view=self)
+    
+    @discord.ui.button(label="◀ Previous", style=discord.ButtonStyle.secondary)
+    async def previous_page(self, interaction: discord.Interaction, button: discord.ui.Button):
+        await self._turn(interaction, before=self.first_key)
+    
+    @discord.ui.button(label="Next ▶", style=discord.ButtonStyle.secondary)
+    async def next_page(self, interaction: discord.Interaction, button: discord.ui.Button):
+        await self._turn(interaction, after=self.last_key)
+
+async def send_leaderboard(interaction, ranking):
+    page = await streak_bot.store.leaderboard_page(ranking, limit=LEADERBOARD_PAGE_SIZE)
+    embed = build_leaderboard_embed(ranking, page)
+    
+    if not page[1]:
+        if ranking == 'score':
+            embed.description = "No scores yet! Be the first to post an image!"
+        else:
+            embed.description = "No active streaks! Start a streak by posting an image!"
+        await interaction.response.send_message(embed=embed)
+    else:
+        await interaction.response.send_message(embed=embed, view=LeaderboardView(ranking, page))
+
 @bot.tree.command(name="leaderboard", description="Show the top score leaders")
 @not_image_channel()
 async def leaderboard_slash(interaction: discord.Interaction):
     """Show the top score leaders"""
     try:
-        conn = sqlite3.connect('streaks.db')
-        c = conn.cursor()
-        
-        c.execute('''
-            SELECT username, score, streak_days, last_post_date 
-            FROM user_streaks 
-            WHERE score > 0 
-            ORDER BY score DESC 
-            LIMIT 10
-        ''')
-        
-        leaders = c.fetchall()
-        conn.close()
-        
-        embed = discord.Embed(
-            title="🏆 Score Leaderboard",
-            description="Top 10 users by total score",
-            color=0xFFD700
-        )
-        
-        if leaders:
-            for i, (username, score, streak_days, last_post_date) in enumerate(leaders, 1):
-                medal = "🥇" if i == 1 else "🥈" if i == 2 else "🥉" if i == 3 else f"{i}."
-                embed.add_field(
-                    name=f"{medal} {username}",
-                    value=f"**{score} points** | {streak_days} day streak",
-                    inline=False
-                )
-        else:
-            embed.description = "No scores yet! Be the first to post an image!"
-        
-        await interaction.response.send_message(embed=embed)
+        await send_leaderboard(interaction, 'score')
     except Exception as e:
         await interaction.response.send_message("Error retrieving leaderboard.")
 
@@ -534,49 +1344,48 @@ async def leaderboard_slash(interaction: discord.Interaction):
 async def streak_leaderboard_slash(interaction: discord.Interaction):
     """Show the top streak leaders"""
     try:
-        conn = sqlite3.connect('streaks.db')
-        c = conn.cursor()
-        
-        c.execute('''
-            SELECT username, streak_days, score, last_post_date 
-            FROM user_streaks 
-            WHERE streak_days > 0 
-            ORDER BY streak_days DESC 
-            LIMIT 10
-        ''')
-        
-        leaders = c.fetchall()
-        conn.close()
-        
-        embed = discord.Embed(
-            title="🔥 Streak Leaderboard",
-            description="Top 10 users by current streak",
-            color=0xFF6B6B
-        )
+        await send_leaderboard(interaction, 'streak')
+    except Exception as e:
+        await interaction.response.send_message("Error retrieving streak leaderboard.")
+
+@bot.tree.command(name="rank", description="Show your leaderboard position and the users around you")
+@discord.app_commands.describe(user="Whose rank to show (defaults to you)", ranking="Which leaderboard to look at")
+@discord.app_commands.choices(ranking=[
+    discord.app_commands.Choice(name="Score", value="score"),
+    discord.app_commands.Choice(name="Streak", value="streak"),
+])
+@not_image_channel()
+async def rank_slash(interaction: discord.Interaction, user: discord.Member = None,
+                     ranking: discord.app_commands.Choice[str] = None):
+    """Show a user's leaderboard position and their neighbours"""
+    try:
+        user = user or interaction.user
+        ranking = ranking.value if ranking else 'score'
+        what = "total score" if ranking == 'score' else "current streak"
+        result = await streak_bot.store.rank(ranking, user.id, neighbours=RANK_NEIGHBOURS)
         
-        if leaders:
-            for i, (username, streak_days, score, last_post_date) in enumerate(leaders, 1):
-                medal = "🥇" if i == 1 else "🥈" if i == 2 else "🥉" if i == 3 else f"{i}."
-                
-                # Different fire emojis based on streak length
-                if streak_days >= 7:
-                    fire = "🔥🔥🔥"
-                elif streak_days >= 3:
-                    fire = "🔥🔥"
-                else:
-                    fire = "🔥"
-                    
-                embed.add_field(
-                    name=f"{medal} {username}",
-                    value=f"**{streak_days} days** {fire} | {score} points",
-                    inline=False
-                )
+        if result is None:
+            embed = discord.Embed(
+                title=f"📍 {user.display_name}'s Rank",
+                description=f"Not on the {what} leaderboard yet! Post an image to get ranked.",
+                color=0xFFA500
+            )
         else:
-            embed.description = "No active streaks! Start a streak by posting an image!"
+            rank, total, start, rows = result
+            embed = discord.Embed(
+                title=f"📍 {user.display_name}'s Rank",
+                description=f"**#{rank}** of {total} by {what}",
+                color=0x7289DA
+            )
+            for position, (_, user_id, username, score, streak_days, _) in enumerate(rows, start):
+                name, value = leaderboard_field(ranking, position, username, score, streak_days)
+                if user_id == user.id:
+                    name = f"➡️ {name}"
+                embed.add_field(name=name, value=value, inline=False)
         
         await interaction.response.send_message(embed=embed)
     except Exception as e:
-        await interaction.response.send_message("Error retrieving streak leaderboard.")
+        await interaction.response.send_message("Error retrieving rank.")
 
 @bot.tree.command(name="user_stats", description="Check another user's stats")
 @discord.app_commands.describe(user="The user to check stats for")
@@ -584,10 +1393,10 @@ async def streak_leaderboard_slash(interaction: discord.Interaction):
 async def user_stats_slash(interaction: discord.Interaction, user: discord.Member):
     """Check another user's stats"""
     try:
-        user_data = streak_bot.get_user_data(user.id)
+        user_data = await streak_bot.get_user_data(user.id)
         
         if user_data:
-            streak_days, last_post_date, score = user_data
+            streak_days, last_post_date, score, last_post_day = user_data
             embed = discord.Embed(
                 title=f"📊 {user.display_name}'s Stats",
                 color=0x7289DA
@@ -620,6 +1429,96 @@ async def user_stats_slash(interaction: discord.Interaction, user: discord.Membe
     except Exception as e:
         await interaction.response.send_message("Error retrieving user stats.")
 
+def sparkline(counts):
+    """One bar character per value, scaled to the largest"""
+    bars = "·▁▂▃▄▅▆▇█"
+    peak = max(counts) or 1
+    return "".join(bars[0 if not count else max(1, round(count / peak * 8))] for count in counts)
+
+def daily_counts(rows, first_day, days):
+    """Posts per day from rollup rows, with 0 for days without any"""
+    posts = {row[0]: row[1] for row in rows}
+    return [posts.get(first_day + offset, 0) for offset in range(days)]
+
+@bot.tree.command(name="history", description="Show how many images you posted each day")
+@discord.app_commands.describe(user="Whose history to show (defaults to you)", days="How many days to look back (default 30)")
+@not_image_channel()
+async def history_slash(interaction: discord.Interaction, user: discord.Member = None,
+                        days: discord.app_commands.Range[int, 1, HISTORY_MAX_DAYS] = 30):
+    """Show a user's posts per day"""
+    try:
+        user = user or interaction.user
+        today = datetime.date.today()
+        rows = await streak_bot.store.posts.user_history(user.id, days, today)
+        
+        if not rows:
+            embed = discord.Embed(
+                title=f"📅 {user.display_name}'s History",
+                description=f"No posts in the last {days} days!",
+                color=0xFFA500
+            )
+        else:
+            first_day = day_number(today) - days + 1
+            embed = discord.Embed(
+                title=f"📅 {user.display_name}'s History",
+                description=f"`{sparkline(daily_counts(rows, first_day, days))}`\n"
+                            f"{day_date(first_day):%b %d} → {today:%b %d}",
+                color=0x7289DA
+            )
+            best_day = max(rows, key=lambda row: row[1])
+            embed.add_field(name="Posts", value=f"{sum(row[1] for row in rows)} 📸", inline=True)
+            embed.add_field(name="Active Days", value=f"{len(rows)} of {days}", inline=True)
+            embed.add_field(name="Points Earned", value=f"{sum(row[3] for row in rows)} 🏆", inline=True)
+            embed.add_field(name="Best Day", value=f"{day_date(best_day[0]):%b %d} ({best_day[1]} posts)", inline=True)
+        
+        await interaction.response.send_message(embed=embed)
+    except Exception as e:
+        await interaction.response.send_message("Error retrieving history.")
+
+@bot.tree.command(name="guild_activity", description="Show how active this server has been")
+@discord.app_commands.describe(days="How many days to look back (default 7)")
+@not_image_channel()
+async def guild_activity_slash(interaction: discord.Interaction,
+                               days: discord.app_commands.Range[int, 1, HISTORY_MAX_DAYS] = 7):
+    """Show the server's posts per day and top posters"""
+    try:
+        today = datetime.date.today()
+        rows, active_users, top_posters = await streak_bot.store.posts.guild_activity(interaction.guild.id, days, today)
+        
+        if not rows:
+            embed = discord.Embed(
+                title=f"📈 {interaction.guild.name} Activity",
+                description=f"No posts in the last {days} days!",
+                color=0xFFA500
+            )
+        else:
+            first_day = day_number(today) - days + 1
+            embed = discord.Embed(
+                title=f"📈 {interaction.guild.name} Activity",
+                description=f"`{sparkline(daily_counts(rows, first_day, days))}`\n"
+                            f"{day_date(first_day):%b %d} → {today:%b %d}",
+                color=0x7289DA
+            )
+            busiest_day = max(rows, key=lambda row: row[1])
+            embed.add_field(name="Posts", value=f"{sum(row[1] for row in rows)} 📸", inline=True)
+            embed.add_field(name="Images", value=str(sum(row[2] for row in rows)), inline=True)
+            embed.add_field(name="Active Users", value=str(active_users), inline=True)
+            embed.add_field(
+                name="Busiest Day",
+                value=f"{day_date(busiest_day[0]):%b %d} ({busiest_day[1]} posts by {busiest_day[4]} users)",
+                inline=False
+            )
+            embed.add_field(
+                name="Top Posters",
+                value="\n".join(f"{position}. <@{user_id}> — {posts} posts"
+                                for position, (user_id, posts) in enumerate(top_posters, 1)),
+                inline=False
+            )
+        
+        await interaction.response.send_message(embed=embed)
+    except Exception as e:
+        await interaction.response.send_message("Error retrieving server activity.")
+
 # Admin commands - also blocked in image channels
 @bot.tree.command(name="add_score", description="Add points to a user (Admin only)")
 @discord.app_commands.describe(user="The user to add points to", points="Number of points to add")
@@ -631,27 +1530,8 @@ async def add_score_slash(interaction: discord.Interaction, user: discord.Member
         return
     
     try:
-        conn = sqlite3.connect('streaks.db')
-        c = conn.cursor()
-        
-        # Get current score
-        c.execute('SELECT score FROM user_streaks WHERE user_id = ?', (user.id,))
-        result = c.fetchone()
-        
-        if result:
-            current_score = result[0]
-            new_score = current_score + points
-        else:
-            new_score = points
-        
-        # Update score
-        c.execute('''
-            INSERT OR REPLACE INTO user_streaks (user_id, streak_days, last_post_date, username, score)
-            VALUES (?, ?, ?, ?, ?)
-        ''', (user.id, 0, datetime.datetime.now().strftime('%Y-%m-%d'), user.display_name, new_score))
-        
-        conn.commit()
-        conn.close()
+        today = datetime.datetime.now().strftime('%Y-%m-%d')
+        new_score = await streak_bot.store.add_score(user.id, user.display_name, points, today)
         
         await interaction.response.send_message(f"✅ Added {points} points to {user.mention}! New score: {new_score} 🏆", ephemeral=True)
         
@@ -668,17 +1548,9 @@ async def set_score_slash(interaction: discord.Interaction, user: discord.Member
         return
     
     try:
-        conn = sqlite3.connect('streaks.db')
-        c = conn.cursor()
-        
         # Set score
-        c.execute('''
-            INSERT OR REPLACE INTO user_streaks (user_id, streak_days, last_post_date, username, score)
-            VALUES (?, ?, ?, ?, ?)
-        ''', (user.id, 0, datetime.datetime.now().strftime('%Y-%m-%d'), user.display_name, points))
-        
-        conn.commit()
-        conn.close()
+        today = datetime.datetime.now().strftime('%Y-%m-%d')
+        await streak_bot.store.set_score(user.id, user.display_name, points, today)
         
         await interaction.response.send_message(f"✅ Set {user.mention}'s score to {points} points! 🏆", ephemeral=True)
         
@@ -695,78 +1567,188 @@ async def reset_streak_slash(interaction: discord.Interaction, user: discord.Mem
         return
     
     try:
-        conn = sqlite3.connect('streaks.db')
-        c = conn.cursor()
-        
         # Reset streak (keep score)
-        c.execute('UPDATE user_streaks SET streak_days = 0 WHERE user_id = ?', (user.id,))
-        
-        conn.commit()
-        conn.close()
+        await streak_bot.store.reset_streak(user.id)
         
         await interaction.response.send_message(f"✅ Reset {user.mention}'s streak to 0 days!", ephemeral=True)
         
     except Exception as e:
         await interaction.response.send_message(f"❌ Error resetting streak: {e}", ephemeral=True)
 
-@tasks.loop(hours=24)
-async def reset_streaks():
-    """Reset streaks for users who didn't post in the last 24 hours"""
+async def expire_lapsed_streaks():
+    """Write back streaks that lapsed because the user missed a day"""
     try:
-        conn = sqlite3.connect('streaks.db')
-        c = conn.cursor()
-        
-        today = datetime.datetime.now().strftime('%Y-%m-%d')
-        yesterday = (datetime.datetime.now() - datetime.timedelta(days=1)).strftime('%Y-%m-%d')
-        
-        # Get users to reset
-        c.execute('SELECT user_id, username FROM user_streaks WHERE last_post_date < ? AND streak_days > 0', (yesterday,))
-        users_to_reset = c.fetchall()
-        
         # Reset streaks (but keep scores!)
-        c.execute('UPDATE user_streaks SET streak_days = 0 WHERE last_post_date < ?', (yesterday,))
+        users_reset = await streak_bot.store.expire_streaks(streak_cutoff(), batch_size=STREAK_EXPIRY_BATCH)
         
-        conn.commit()
-        conn.close()
-        
-        if users_to_reset:
-            print(f"Reset streaks for {len(users_to_reset)} users at {datetime.datetime.now()}")
-        else:
-            print(f"No streaks to reset at {datetime.datetime.now()}")
+        log.info("Reset streaks for %d users", users_reset, extra={'event': 'streaks.expired', 'users': users_reset})
             
     except Exception as e:
-        print(f"Error resetting streaks: {e}")
+        log.exception("Error resetting streaks", extra={'event': 'streaks.expire_failed'})
+
+def next_streak_expiry():
+    """STREAK_EXPIRY_TIME at the UTC offset local time will have at the coming midnight"""
+    tomorrow = datetime.datetime.combine(datetime.date.today() + datetime.timedelta(days=1), STREAK_EXPIRY_TIME)
+    return STREAK_EXPIRY_TIME.replace(tzinfo=tomorrow.astimezone().tzinfo)
+
+@tasks.loop(time=next_streak_expiry())
+async def reset_streaks():
+    """Reset streaks for users who didn't post yesterday, just after midnight"""
+    await expire_lapsed_streaks()
+    # The offset changes with daylight saving time, so work out the next run again each day
+    reset_streaks.change_interval(time=next_streak_expiry())
+
+@tasks.loop(seconds=CHANNEL_REFRESH_SECONDS)
+async def refresh_image_channels():
+    """Pick up image channel changes made by other bot processes"""
+    try:
+        if await streak_bot.image_channels.refresh():
+            log.info("Image channels reloaded: %s", sorted(streak_bot.image_channels.channels),
+                     extra={'event': 'channels.reloaded'})
+    except Exception as e:
+        log.warning("Error refreshing image channels: %s", e, extra={'event': 'channels.refresh_failed'})
+
+@tasks.loop(hours=6)
+async def prune_image_hashes():
+    """Forget image hashes that are older than the duplicate window"""
+    try:
+        removed = await streak_bot.duplicates.prune()
+        log.info("Pruned %d old image hashes", removed, extra={'event': 'hashes.pruned'})
+    except Exception as e:
+        log.warning("Error pruning image hashes: %s", e, extra={'event': 'hashes.prune_failed'})
+
+@tasks.loop(minutes=10)
+async def take_snapshots():
+    """Snapshot the database once the newest snapshot is SNAPSHOT_HOURS old"""
+    try:
+        age = await asyncio.to_thread(streak_bot.snapshots.age)
+        if age is None or age >= SNAPSHOT_HOURS * 3600:
+            await streak_bot.store.flush()
+            await streak_bot.snapshots.create()
+    except Exception as e:
+        log.warning("Error taking a snapshot: %s", e, extra={'event': 'snapshot.failed'})
+
+@tasks.loop(seconds=CLUSTER_HEARTBEAT_SECONDS)
+async def report_shards():
+    """Update the per-shard gauges, and send the launcher a heartbeat from a cluster worker"""
+    guilds = collections.Counter(guild.shard_id for guild in bot.guilds)
+    shards = {}
+    for shard_id, shard in bot.shards.items():
+        connected = not shard.is_closed()
+        # Infinite until the first heartbeat is acknowledged
+        latency = shard.latency if math.isfinite(shard.latency) else None
+        SHARD_CONNECTED.set(int(connected), shard_id)
+        SHARD_GUILDS.set(guilds[shard_id], shard_id)
+        if latency is not None:
+            SHARD_LATENCY.set(latency, shard_id)
+        shards[shard_id] = {'connected': connected, 'latency': latency, 'guilds': guilds[shard_id]}
+    if streak_bot.backend is not None:
+        try:
+            await streak_bot.backend.call('cluster.heartbeat', CLUSTER_WORKER, shards)
+        except Exception as e:
+            log.warning("Error sending heartbeat: %s", e, extra={'event': 'cluster.heartbeat_failed'})
 
 @reset_streaks.before_loop
 async def before_reset_streaks():
-    await bot.wait_until_ready()
+    # The cluster launcher never connects, so there is nothing for it to wait for
+    if not CLUSTER_LAUNCHER:
+        await bot.wait_until_ready()
+    reset_streaks.change_interval(time=next_streak_expiry())
+    # Catch up on any midnight we missed while the bot was offline
+    await expire_lapsed_streaks()
 
 # Error handler for channel restrictions
+def observe_command(interaction, status):
+    started = interaction.extras.get('started')
+    if started is not None and interaction.command is not None:
+        COMMAND_SECONDS.observe(time.perf_counter() - started, interaction.command.qualified_name, status)
+
+@bot.event
+async def on_app_command_completion(interaction, command):
+    observe_command(interaction, 'ok')
+
 @bot.tree.error
 async def on_app_command_error(interaction: discord.Interaction, error: discord.app_commands.AppCommandError):
+    observe_command(interaction, 'rejected' if isinstance(error, discord.app_commands.CheckFailure) else 'error')
     if isinstance(error, discord.app_commands.CheckFailure):
         await interaction.response.send_message(
             "❌ Slash commands are not allowed in image channels! Please use commands in other channels.",
             ephemeral=True
         )
     else:
-        print(f"Slash command error: {error}")
+        log.error("Slash command error: %s", error, extra={'event': 'command.failed'})
+
+async def run_cluster(token):
+    """Hold the database and run the shards in CLUSTER_WORKERS worker processes until stopped"""
+    shard_count, max_concurrency = await gateway_info(token)
+    cluster = Cluster(
+        [sys.executable, os.path.abspath(__file__)],
+        SHARD_COUNT or shard_count,
+        CLUSTER_WORKERS,
+        max_concurrency=max_concurrency,
+        heartbeat_timeout=CLUSTER_HEARTBEAT_TIMEOUT,
+        restarts=WORKER_RESTARTS,
+    )
+    metrics.gauge('sfbot_workers_healthy', 'Cluster workers running and sending heartbeats',
+                  function=lambda: sum(map(cluster.healthy, cluster.workers)))
+    await streak_bot.open_storage()
+    server = BackendServer(
+        {'db': streak_bot.db, 'store': streak_bot.store, 'snapshots': streak_bot.snapshots, 'cluster': cluster},
+        CLUSTER_SOCKET,
+    )
+    server.observe = lambda call, seconds: BACKEND_CALL_SECONDS.observe(seconds, call)
+    await server.start()
+    metrics_server = None
+    if METRICS_PORT:
+        metrics_server = MetricsServer(metrics, METRICS_HOST, METRICS_PORT, health=cluster.health)
+        await metrics_server.start()
+    # Jobs over the whole database run here rather than in any one worker
+    reset_streaks.start()
+    if SNAPSHOT_HOURS:
+        take_snapshots.start()
+
+    stopping = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for signum in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(signum, stopping.set)
+    await cluster.start()
+    log.info("Running %d shards in %d workers", cluster.shard_count, len(cluster.workers),
+             extra={'event': 'cluster.started', 'shards': cluster.shard_count, 'workers': len(cluster.workers)})
+    try:
+        await stopping.wait()
+    finally:
+        log.info("Stopping the cluster", extra={'event': 'cluster.stopping'})
+        await cluster.stop()
+        reset_streaks.cancel()
+        take_snapshots.cancel()
+        await server.close()
+        if metrics_server:
+            await metrics_server.stop()
+        await streak_bot.close_storage()
 
 # Run the bot
 # Run the bot
 if __name__ == "__main__":
+    log_listener = setup_logging(LOG_LEVEL, LOG_FORMAT, LOG_SAMPLE_RATES)
     # Get token from environment variable
     bot_token = os.getenv('DISCORD_TOKEN')
     if not bot_token:
-        print("❌ ERROR: DISCORD_TOKEN environment variable not set!")
-        print("Please set the DISCORD_BOT_TOKEN environment variable in Railway.")
+        log.critical("❌ ERROR: DISCORD_TOKEN environment variable not set! "
+                     "Please set the DISCORD_BOT_TOKEN environment variable in Railway.")
+        log_listener.stop()
         exit(1)
     
-    print("✅ Starting bot...")
     try:
-        bot.run(bot_token)
+        if CLUSTER_LAUNCHER:
+            log.info("✅ Starting cluster...")
+            asyncio.run(run_cluster(bot_token))
+        else:
+            log.info("✅ Starting bot...")
+            # discord.py logs through the root logger set up above
+            bot.run(bot_token, log_handler=None)
     except Exception as e:
-        print(f"❌ Bot crashed: {e}")
+        log.exception("❌ Bot crashed: %s", e)
         # Wait and exit (Railway will auto-restart)
-        import time
-        time.sleep(10)
\ No newline at end of file
+        time.sleep(10)
+    finally:
+        log_listener.stop()
@@ -0,0 +1,119 @@
+"""Maintenance commands for the SF-BOT database.
+
+    python SF-CLI.py export user_streaks streaks.csv
+    python SF-CLI.py export post_events posts.jsonl.gz
+    python SF-CLI.py import user_streaks streaks.csv --on-conflict skip
+    python SF-CLI.py snapshot
+    python SF-CLI.py restore snapshots/streaks-20260101-060000.db.gz
+
+Files ending in .gz are compressed. The database defaults to DATABASE_PATH.
+A running bot doesn't see rows imported from here until it restarts; use
+!import in Discord to import into a running bot. Stop the bot before a restore.
+"""
+import argparse
+import asyncio
+import os
+import sys
+import time
+
+from dotenv import load_dotenv
+
+import snapshot
+import transfer
+from storage import Database
+
+load_dotenv()
+
+
+async def export_command(args):
+    db = Database(args.database)
+    await db.open()
+    try:
+        fmt = transfer.detect_format(args.file)
+        start = time.perf_counter()
+        with transfer.open_text(args.file, 'w') as out:
+            count = await db.read(transfer.export_table, args.table, out, fmt)
+        print(f"Exported {count} rows from {args.table} to {args.file} in {time.perf_counter() - start:.1f}s")
+    finally:
+        await db.close()
+
+
+async def import_command(args):
+    db = Database(args.database)
+    await db.open()
+    try:
+        fmt = transfer.detect_format(args.file)
+        start = time.perf_counter()
+
+        def progress(rows):
+            print(f"  {rows} rows...", file=sys.stderr)
+
+        with transfer.open_text(args.file, 'r') as source:
+            read, written = await transfer.import_table(
+                db, args.table, source, fmt, args.on_conflict, args.chunk_size, progress
+            )
+        print(f"Imported {written} of {read} rows into {args.table} in {time.perf_counter() - start:.1f}s")
+    finally:
+        await db.close()
+
+
+def snapshots(args):
+    return snapshot.Snapshots(args.database, args.snapshot_dir,
+                              keep=int(os.getenv('SNAPSHOT_KEEP', '8')),
+                              keep_days=int(os.getenv('SNAPSHOT_KEEP_DAYS', '7')))
+
+
+async def snapshot_command(args):
+    last = await snapshots(args).create()
+    print(f"Saved {last['path']} in {last['seconds']:.1f}s ({last['raw_bytes']} bytes, {last['bytes']} compressed)")
+
+
+async def restore_command(args):
+    if os.path.exists(args.database) and not args.no_backup:
+        # Keep what is being replaced, in case the wrong snapshot was picked
+        last = await snapshots(args).create()
+        print(f"Saved the current database to {last['path']}")
+    start = time.perf_counter()
+    await asyncio.to_thread(snapshot.restore, args.file, args.database)
+    print(f"Restored {args.database} from {args.file} in {time.perf_counter() - start:.1f}s")
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--database', default=os.getenv('DATABASE_PATH', 'streaks.db'),
+                        help='database file (default: DATABASE_PATH or streaks.db)')
+    parser.add_argument('--snapshot-dir', default=os.getenv('SNAPSHOT_DIR', 'snapshots'),
+                        help='where snapshots are kept (default: SNAPSHOT_DIR or snapshots)')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    export = commands.add_parser('export', help='write a table to a CSV or JSONL file')
+    export.add_argument('table', choices=transfer.TABLES)
+    export.add_argument('file', help='.csv, .jsonl, .csv.gz or .jsonl.gz')
+    export.set_defaults(handler=export_command)
+
+    load = commands.add_parser('import', help='load a CSV or JSONL file into a table')
+    load.add_argument('table', choices=transfer.TABLES)
+    load.add_argument('file', help='.csv, .jsonl, .csv.gz or .jsonl.gz')
+    load.add_argument('--on-conflict', choices=transfer.CONFLICT_MODES, default='replace',
+                      help='what to do with rows whose key already exists (default replace)')
+    load.add_argument('--chunk-size', type=int, default=50000, help='rows per transaction (default 50000)')
+    load.set_defaults(handler=import_command)
+
+    take = commands.add_parser('snapshot', help='take a compressed snapshot of the database, even while the bot runs')
+    take.set_defaults(handler=snapshot_command)
+
+    restore = commands.add_parser('restore', help='replace the database with a snapshot; stop the bot first')
+    restore.add_argument('file', help='a .db.gz snapshot')
+    restore.add_argument('--no-backup', action='store_true',
+                         help="don't snapshot the current database before replacing it")
+    restore.set_defaults(handler=restore_command)
+
+    return parser.parse_args(argv)
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    try:
+        asyncio.run(args.handler(args))
+    except (OSError, ValueError) as e:
+        sys.exit(f"❌ {e}")
@@ -0,0 +1,304 @@
+"""Microbenchmarks for the streak storage layer.
+
+Generates synthetic streaks.db files (1k, 100k and 1M users by default), then
+times the operations StreakBot relies on, each cold and warm:
+
+    startup            Database.open + StreakStore.start (loads the leaderboard)
+    get_user_data      StreakStore.get_user_stats
+    record_post        StreakStore.record_post, as used by update_user_streak_and_score
+    record_post_commit record_post plus waiting for the batched commit (a checkpoint for the memory engine)
+    leaderboard_*      first page and a page halfway down, in memory and via SQL
+    rank_*             /rank lookups, in memory and via SQL
+    reset_streaks      StreakStore.expire_streaks over the whole table
+
+"Cold" runs start from a freshly opened database with empty in-process caches,
+after asking the kernel to drop the file from its page cache. "Warm" runs repeat
+the same work on the same store straight afterwards. Results are printed as JSON.
+
+    python bench_storage.py
+    python bench_storage.py --sizes 1000,100000 --iterations 500 --output bench.json
+    python bench_storage.py --engine memory
+"""
+import argparse
+import asyncio
+import datetime
+import json
+import os
+import platform
+import random
+import resource
+import shutil
+import sqlite3
+import sys
+import tempfile
+import time
+
+from storage import SCHEMA, Database, MemoryStreakStore, StreakStore, streak_cutoff
+
+
+def dataset_path(data_dir, rows, seed, today):
+    return os.path.join(data_dir, f'streaks-{rows}-{seed}-{today}.db')
+
+
+def generate_dataset(path, rows, seed, today):
+    """Write a streaks.db with `rows` users whose streaks and scores look like real ones.
+
+    About a third of users have no streak, most of the rest posted today or
+    yesterday, and the others have lapsed streaks for the sweep to reset.
+    Scores follow a long-tailed distribution. Dates are relative to today, so
+    datasets are cached per day.
+    """
+    rng = random.Random(seed)
+    today = datetime.date.fromisoformat(today)
+    conn = sqlite3.connect(path, isolation_level=None)
+    conn.executescript(SCHEMA)
+    conn.execute('BEGIN')
+
+    def users():
+        for i in range(rows):
+            # Snowflake-sized IDs, spread out like real ones
+            user_id = 10 ** 17 + i * 7919 + rng.randrange(7919)
+            roll = rng.random()
+            if roll < 0.35:
+                streak_days, days_ago = 0, rng.randrange(2, 60)
+            elif roll < 0.85:
+                streak_days, days_ago = 1 + int(rng.expovariate(1 / 6)), rng.randrange(2)
+            else:
+                streak_days, days_ago = 1 + int(rng.expovariate(1 / 6)), rng.randrange(2, 30)
+            score = int(rng.paretovariate(1.3) * 3)
+            last_post_date = (today - datetime.timedelta(days=days_ago)).isoformat()
+            yield user_id, streak_days, last_post_date, f'user{i}', score
+
+    conn.executemany('INSERT INTO user_streaks VALUES (?, ?, ?, ?, ?)', users())
+    conn.execute('COMMIT')
+    conn.close()
+
+
+def drop_page_cache(path):
+    """Ask the kernel to forget the cached pages of the database files; False if it can't"""
+    if not hasattr(os, 'posix_fadvise'):
+        return False
+    for name in (path, path + '-wal', path + '-shm'):
+        if os.path.exists(name):
+            fd = os.open(name, os.O_RDONLY)
+            try:
+                os.fsync(fd)
+                os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+            finally:
+                os.close(fd)
+    return True
+
+
+def summarize(samples):
+    samples = sorted(samples)
+    count = len(samples)
+
+    def percentile(fraction):
+        return samples[min(count - 1, int(fraction * count))] * 1e6
+
+    total = sum(samples)
+    return {
+        'n': count,
+        'mean_us': total / count * 1e6,
+        'p50_us': percentile(0.50),
+        'p95_us': percentile(0.95),
+        'p99_us': percentile(0.99),
+        'max_us': samples[-1] * 1e6,
+        'ops_per_s': count / total if total else None,
+    }
+
+
+async def timed(samples, coro):
+    start = time.perf_counter()
+    result = await coro
+    samples.append(time.perf_counter() - start)
+    return result
+
+
+class Bench:
+    def __init__(self, args, rows, path):
+        self.args = args
+        self.rows = rows
+        self.path = path
+        self.rng = random.Random(args.seed)
+        self.results = []
+
+    def record(self, operation, phase, samples, **extra):
+        result = {'rows': self.rows, 'operation': operation, 'phase': phase, **summarize(samples), **extra}
+        self.results.append(result)
+        print(f"  {operation:28} {phase:4} p50 {result['p50_us']:>10.1f} us  p99 {result['p99_us']:>10.1f} us",
+              file=sys.stderr)
+
+    async def open(self):
+        db = Database(self.path, readers=self.args.readers)
+        if self.args.engine == 'memory':
+            # Checkpoints only happen when the benchmark flushes
+            store = MemoryStreakStore(db, checkpoint_interval=0)
+        else:
+            store = StreakStore(db, cache_size=self.args.cache_size)
+        start = time.perf_counter()
+        await db.open()
+        await store.start()
+        return db, store, time.perf_counter() - start
+
+    async def close(self, db, store):
+        await store.close()
+        await db.close()
+
+    async def sample_users(self, db, count):
+        rows = await db.fetchall('SELECT user_id FROM user_streaks')
+        return [row[0] for row in self.rng.sample(rows, min(count, len(rows)))]
+
+    async def run(self):
+        iterations = self.args.iterations
+        work = self.path + '.work'
+        shutil.copyfile(self.path, work)
+        self.path, source = work, self.path
+        try:
+            dropped = drop_page_cache(self.path)
+            db, store, startup = await self.open()
+            self.record('startup', 'cold', [startup], page_cache_dropped=dropped,
+                        rss_mb=resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024)
+            users = await self.sample_users(db, iterations)
+            drop_page_cache(self.path)
+            # The second pass reuses the stats cache, leaderboard and page cache the first one filled
+            for phase in ('cold', 'warm'):
+                await self.run_reads(store, users, phase)
+                await self.run_writes(store, users, phase)
+            await self.close(db, store)
+
+            db, store, startup = await self.open()
+            self.record('startup', 'warm', [startup])
+            await self.close(db, store)
+
+            # The sweep changes the data, so each run gets a fresh copy
+            for phase in ('cold', 'warm'):
+                shutil.copyfile(source, self.path)
+                for suffix in ('-wal', '-shm'):
+                    if os.path.exists(self.path + suffix):
+                        os.remove(self.path + suffix)
+                db, store, _ = await self.open()
+                if phase == 'cold':
+                    drop_page_cache(self.path)
+                else:
+                    await db.fetchone('SELECT COUNT(*), SUM(score) FROM user_streaks')
+                samples = []
+                reset = await timed(samples, store.expire_streaks(
+                    streak_cutoff(), batch_size=self.args.sweep_batch, pause=self.args.sweep_pause
+                ))
+                self.record('reset_streaks', phase, samples, streaks_reset=reset)
+                await self.close(db, store)
+        finally:
+            for suffix in ('', '-wal', '-shm'):
+                if os.path.exists(work + suffix):
+                    os.remove(work + suffix)
+
+    async def run_reads(self, store, users, phase):
+        samples = []
+        for user_id in users:
+            await timed(samples, store.get_user_stats(user_id))
+        self.record('get_user_data', phase, samples)
+
+        # The memory engine has no SQL fallback
+        sources = ('memory',) if self.args.engine == 'memory' else ('memory', 'sql')
+        for ranking in ('score', 'streak'):
+            for source in sources:
+                # Switching off the in-memory leaderboard sends queries down the SQL path
+                store.leaderboard.loaded = source == 'memory'
+                top, deep, ranks = [], [], []
+                total = store.leaderboard.total(ranking)
+                _, middle = store.leaderboard.around(ranking, max(1, total // 2), 0)
+                for user_id in users[:self.args.leaderboard_iterations]:
+                    await timed(top, store.leaderboard_page(ranking))
+                    if middle:
+                        await timed(deep, store.leaderboard_page(ranking, after=middle[0][0]))
+                    await timed(ranks, store.rank(ranking, user_id))
+                self.record(f'leaderboard_{ranking}_top_{source}', phase, top)
+                if deep:
+                    self.record(f'leaderboard_{ranking}_deep_{source}', phase, deep)
+                self.record(f'rank_{ranking}_{source}', phase, ranks)
+            store.leaderboard.loaded = True
+
+    async def run_writes(self, store, users, phase):
+        today = datetime.date.today().isoformat()
+        samples = []
+        for user_id in users:
+            await timed(samples, store.record_post(user_id, 'bench', today))
+        start = time.perf_counter()
+        await store.flush()
+        flush = time.perf_counter() - start
+        self.record('record_post', phase, samples)
+
+        committed = []
+        for user_id in users[:self.args.leaderboard_iterations]:
+            start = time.perf_counter()
+            await store.record_post(user_id, 'bench', today)
+            await store.flush()
+            committed.append(time.perf_counter() - start)
+        self.record('record_post_commit', phase, committed,
+                    batched_ops_per_s=len(samples) / (sum(samples) + flush))
+
+
+async def main(args):
+    os.makedirs(args.data_dir, exist_ok=True)
+    today = datetime.date.today().isoformat()
+    results = []
+    for rows in args.sizes:
+        path = dataset_path(args.data_dir, rows, args.seed, today)
+        if not os.path.exists(path):
+            print(f"Generating {rows} users into {path}...", file=sys.stderr)
+            start = time.perf_counter()
+            generate_dataset(path, rows, args.seed, today)
+            # Opening once builds the indexes, which aren't part of the measurements
+            db = Database(path)
+            await db.open()
+            await db.close()
+            print(f"  done in {time.perf_counter() - start:.1f}s", file=sys.stderr)
+        print(f"Benchmarking {rows} users", file=sys.stderr)
+        bench = Bench(args, rows, path)
+        await bench.run()
+        results.extend(bench.results)
+
+    report = {
+        'environment': {
+            'python': platform.python_version(),
+            'sqlite': sqlite3.sqlite_version,
+            'platform': platform.platform(),
+            'processor': platform.processor() or platform.machine(),
+            'date': today,
+        },
+        'config': {key: value for key, value in vars(args).items() if key != 'output'},
+        'results': results,
+    }
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output + '\n')
+    else:
+        print(output)
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--sizes', type=lambda value: [int(size) for size in value.split(',')],
+                        default=[1_000, 100_000, 1_000_000], help='comma-separated user counts')
+    parser.add_argument('--iterations', type=int, default=1000,
+                        help='users sampled for per-user operations (default 1000)')
+    parser.add_argument('--leaderboard-iterations', type=int, default=200,
+                        help='repetitions of leaderboard, rank and committed-write operations (default 200)')
+    parser.add_argument('--engine', choices=('sqlite', 'memory'), default='sqlite', help='storage engine (default sqlite)')
+    parser.add_argument('--readers', type=int, default=2, help='reader connections (default 2)')
+    parser.add_argument('--cache-size', type=int, default=10000, help='stats cache entries (default 10000)')
+    parser.add_argument('--sweep-batch', type=int, default=500, help='rows reset per sweep batch (default 500)')
+    parser.add_argument('--sweep-pause', type=float, default=0.0,
+                        help='seconds between sweep batches; the bot uses 0.05 (default 0)')
+    parser.add_argument('--seed', type=int, default=1)
+    # Datasets run to gigabytes, so they are kept out of the checkout and reused between runs
+    parser.add_argument('--data-dir', default=os.path.join(tempfile.gettempdir(), 'sfbot-bench'),
+                        help='where generated datasets are kept (default: sfbot-bench in the temp directory)')
+    parser.add_argument('--output', help='write the JSON report here instead of stdout')
+    return parser.parse_args(argv)
+
+
+if __name__ == '__main__':
+    asyncio.run(main(parse_args()))
@@ -0,0 +1,133 @@
+import contextvars
+import copy
+import json
+import logging
+import logging.handlers
+import queue
+import random
+import sys
+import uuid
+
+
+# Set per message (or interaction) so every log line of one post can be traced
+correlation_id = contextvars.ContextVar('correlation_id', default='-')
+
+# Attributes every LogRecord has; anything else was passed with extra={...}
+_STANDARD_ATTRS = set(vars(logging.LogRecord('', 0, '', 0, '', None, None))) | {
+    'message', 'asctime', 'correlation_id', 'event', 'taskName',
+}
+
+
+def new_correlation_id(value=None):
+    """Start a new trace in the current task and return its ID"""
+    value = str(value) if value is not None else uuid.uuid4().hex[:12]
+    correlation_id.set(value)
+    return value
+
+
+def _fields(record):
+    return {key: value for key, value in vars(record).items() if key not in _STANDARD_ATTRS}
+
+
+class ContextFilter(logging.Filter):
+    """Stamp records with the current correlation ID and a default event name"""
+
+    def filter(self, record):
+        record.correlation_id = correlation_id.get()
+        if not hasattr(record, 'event'):
+            record.event = record.name
+        return True
+
+
+class SamplingFilter(logging.Filter):
+    """Keep only a fraction of records, by event name or else by level.
+
+    Rates are between 0 and 1. Anything without a rate is always kept, so
+    warnings and errors are never dropped unless asked for explicitly.
+    """
+
+    def __init__(self, level_rates=None, event_rates=None):
+        super().__init__()
+        self.level_rates = level_rates or {}
+        self.event_rates = event_rates or {}
+
+    def filter(self, record):
+        rate = self.event_rates.get(getattr(record, 'event', None))
+        if rate is None:
+            rate = self.level_rates.get(record.levelno, 1.0)
+        return rate >= 1.0 or random.random() < rate
+
+
+class TextFormatter(logging.Formatter):
+    def __init__(self):
+        super().__init__('%(asctime)s %(levelname)s [%(correlation_id)s] %(name)s: %(message)s')
+
+    def format(self, record):
+        line = super().format(record)
+        fields = _fields(record)
+        if fields:
+            line += ' | ' + ' '.join(f'{key}={value}' for key, value in fields.items())
+        return line
+
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {
+            'ts': self.formatTime(record),
+            'level': record.levelname,
+            'logger': record.name,
+            'event': getattr(record, 'event', record.name),
+            'cid': getattr(record, 'correlation_id', '-'),
+            'msg': record.getMessage(),
+        }
+        entry.update(_fields(record))
+        if record.exc_text:
+            entry['exc'] = record.exc_text
+        return json.dumps(entry, default=str, ensure_ascii=False)
+
+
+class _QueueHandler(logging.handlers.QueueHandler):
+    def prepare(self, record):
+        # Like the base class, but keep the traceback out of the message so the
+        # JSON formatter can put it in its own field
+        record = copy.copy(record)
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+        record.message = record.getMessage()
+        record.msg, record.args, record.exc_info = record.message, None, None
+        return record
+
+
+def parse_rates(spec):
+    """Parse 'debug=0.1,image.received=0.01' into (level_rates, event_rates)"""
+    level_rates, event_rates = {}, {}
+    for item in filter(None, (part.strip() for part in (spec or '').split(','))):
+        name, _, rate = item.partition('=')
+        level = logging.getLevelName(name.strip().upper())
+        if isinstance(level, int):
+            level_rates[level] = float(rate)
+        else:
+            event_rates[name.strip()] = float(rate)
+    return level_rates, event_rates
+
+
+def setup_logging(level='INFO', fmt='text', sample_rates=''):
+    """Send all logging through a queue to a background writer thread.
+
+    Returns the QueueListener; call stop() on it at exit to flush what's left.
+    """
+    handler = logging.StreamHandler(sys.stdout)
+    handler.setFormatter(JsonFormatter() if fmt == 'json' else TextFormatter())
+
+    log_queue = queue.SimpleQueue()
+    queue_handler = _QueueHandler(log_queue)
+    queue_handler.addFilter(ContextFilter())
+    queue_handler.addFilter(SamplingFilter(*parse_rates(sample_rates)))
+
+    root = logging.getLogger()
+    root.handlers[:] = [queue_handler]
+    root.setLevel(level.upper())
+
+    listener = logging.handlers.QueueListener(log_queue, handler, respect_handler_level=True)
+    listener.start()
+    return listener
@@ -0,0 +1,193 @@
+import asyncio
+import logging
+import os
+import time
+
+import discord
+
+
+log = logging.getLogger(__name__)
+
+# Discord allows one IDENTIFY per max_concurrency bucket every 5 seconds
+IDENTIFY_INTERVAL = 5.0
+# A worker that ran this long before exiting is restarted without waiting
+STABLE_SECONDS = 600
+
+
+def shard_ranges(shard_count, workers):
+    """Split shard IDs 0..shard_count-1 into contiguous runs, one per worker"""
+    workers = max(1, min(workers, shard_count))
+    size, extra = divmod(shard_count, workers)
+    ranges = []
+    start = 0
+    for index in range(workers):
+        end = start + size + (1 if index < extra else 0)
+        ranges.append(list(range(start, end)))
+        start = end
+    return ranges
+
+
+async def gateway_info(token):
+    """Return (recommended shard count, IDENTIFY max_concurrency) for the bot"""
+    http = discord.http.HTTPClient(asyncio.get_running_loop())
+    try:
+        await http.static_login(token)
+        shards, _, session_start_limit = await http.get_bot_gateway()
+    finally:
+        await http.close()
+    return shards, session_start_limit['max_concurrency']
+
+
+class Worker:
+    def __init__(self, index, shard_ids):
+        self.index = index
+        self.shard_ids = shard_ids
+        self.process = None
+        self.started = None
+        self.restarts = 0
+        self.last_heartbeat = None
+        # shard_id -> status from the last heartbeat
+        self.shards = {}
+
+    @property
+    def running(self):
+        return self.process is not None and self.process.returncode is None
+
+    def heartbeat_age(self):
+        """Seconds since the last heartbeat, or since starting if there hasn't been one"""
+        last = self.last_heartbeat or self.started
+        return time.monotonic() - last if last else None
+
+
+class Cluster:
+    """Run the bot's shards in worker processes and keep them running.
+
+    Each worker runs command with SHARD_COUNT, SHARD_IDS (a contiguous run of
+    shards) and CLUSTER_WORKER set in its environment, and sends heartbeat()
+    every few seconds through the launcher's BackendServer. A worker that
+    exits is started again after a delay that doubles up to max_backoff, and
+    one that misses heartbeats for heartbeat_timeout seconds, such as one
+    whose event loop is stuck, is killed and started again.
+
+    Shards in every worker IDENTIFY through identify(), which spaces them out
+    across processes the way a single AutoShardedBot does for its own shards.
+    """
+
+    def __init__(self, command, shard_count, workers, max_concurrency=1, heartbeat_timeout=60,
+                 max_backoff=60, restarts=None):
+        self.command = command
+        self.shard_count = shard_count
+        self.max_concurrency = max(1, max_concurrency)
+        self.heartbeat_timeout = heartbeat_timeout
+        self.max_backoff = max_backoff
+        self.workers = [Worker(index, shard_ids) for index, shard_ids in enumerate(shard_ranges(shard_count, workers))]
+        # Optional counter of restarts, labelled by worker
+        self.restart_counter = restarts
+        self._identify_locks = [asyncio.Lock() for _ in range(self.max_concurrency)]
+        self._last_identify = [0.0] * self.max_concurrency
+        self._tasks = []
+        self._stopping = False
+
+    async def start(self):
+        self._tasks = [asyncio.create_task(self._supervise(worker)) for worker in self.workers]
+
+    async def stop(self, timeout=30):
+        """Ask every worker to shut down, killing any still running after timeout"""
+        self._stopping = True
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        running = [worker.process for worker in self.workers if worker.running]
+        for process in running:
+            process.terminate()
+        try:
+            await asyncio.wait_for(asyncio.gather(*(process.wait() for process in running)), timeout)
+        except asyncio.TimeoutError:
+            for process in running:
+                if process.returncode is None:
+                    process.kill()
+            await asyncio.gather(*(process.wait() for process in running))
+
+    def heartbeat(self, index, shards):
+        """Record that a worker is alive, with the status of each of its shards"""
+        worker = self.workers[index]
+        worker.last_heartbeat = time.monotonic()
+        worker.shards = shards
+
+    async def identify(self, shard_id):
+        """Wait until shard_id may IDENTIFY without going over Discord's limit"""
+        bucket = shard_id % self.max_concurrency
+        async with self._identify_locks[bucket]:
+            wait = self._last_identify[bucket] + IDENTIFY_INTERVAL - time.monotonic()
+            if wait > 0:
+                await asyncio.sleep(wait)
+            self._last_identify[bucket] = time.monotonic()
+
+    def healthy(self, worker):
+        age = worker.heartbeat_age()
+        return worker.running and age is not None and age < self.heartbeat_timeout
+
+    def health(self):
+        """Whether every worker is up and sending heartbeats, with details for each"""
+        workers = []
+        for worker in self.workers:
+            age = worker.heartbeat_age()
+            workers.append({
+                'worker': worker.index,
+                'pid': worker.process.pid if worker.running else None,
+                'healthy': self.healthy(worker),
+                'shard_ids': worker.shard_ids,
+                'heartbeat_age': round(age, 1) if age is not None else None,
+                'restarts': worker.restarts,
+                'shards': worker.shards,
+            })
+        return {
+            'healthy': all(worker['healthy'] for worker in workers),
+            'shard_count': self.shard_count,
+            'workers': workers,
+        }
+
+    async def _spawn(self, worker):
+        env = dict(
+            os.environ,
+            SHARD_COUNT=str(self.shard_count),
+            SHARD_IDS=','.join(map(str, worker.shard_ids)),
+            CLUSTER_WORKER=str(worker.index),
+        )
+        worker.process = await asyncio.create_subprocess_exec(*self.command, env=env)
+        worker.started = time.monotonic()
+        worker.last_heartbeat = None
+        worker.shards = {}
+        log.info("Started worker %d (pid %d) for shards %s", worker.index, worker.process.pid, worker.shard_ids,
+                 extra={'event': 'cluster.worker_started', 'worker': worker.index, 'pid': worker.process.pid})
+
+    async def _watch(self, worker):
+        """Kill the worker once its heartbeats stop; return when it exits"""
+        while True:
+            try:
+                await asyncio.wait_for(asyncio.shield(worker.process.wait()), self.heartbeat_timeout / 4)
+                return
+            except asyncio.TimeoutError:
+                pass
+            if not self.healthy(worker):
+                log.error("Worker %d sent no heartbeat for %.0fs, killing it", worker.index, worker.heartbeat_age(),
+                          extra={'event': 'cluster.worker_hung', 'worker': worker.index})
+                worker.process.kill()
+
+    async def _supervise(self, worker):
+        backoff = 0.5
+        while not self._stopping:
+            await self._spawn(worker)
+            await self._watch(worker)
+            if self._stopping:
+                return
+            ran = time.monotonic() - worker.started
+            backoff = 1 if ran >= STABLE_SECONDS else min(backoff * 2, self.max_backoff)
+            worker.restarts += 1
+            if self.restart_counter is not None:
+                self.restart_counter.inc(worker.index)
+            log.error("Worker %d exited with code %s after %.0fs, restarting in %.0fs", worker.index,
+                      worker.process.returncode, ran, backoff,
+                      extra={'event': 'cluster.worker_exited', 'worker': worker.index,
+                             'returncode': worker.process.returncode})
+            await asyncio.sleep(backoff)
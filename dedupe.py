@@ -0,0 +1,169 @@
+import logging
+import time
+
+
+log = logging.getLogger(__name__)
+
+
+def hamming(a, b):
+    return (a ^ b).bit_count()
+
+
+class HashIndex:
+    """Multi-index hashing over 64-bit hashes for Hamming-distance range searches.
+
+    Each hash is split into threshold + 1 chunks with one lookup table per
+    chunk. Two hashes that differ in at most threshold bits must agree exactly
+    on at least one chunk, so a search only checks the hashes that share a
+    chunk with the query instead of the whole index.
+    """
+
+    def __init__(self, threshold):
+        self.threshold = threshold
+        count = threshold + 1
+        widths = [64 // count + (1 if i < 64 % count else 0) for i in range(count)]
+        self.chunks = []
+        shift = 0
+        for width in widths:
+            self.chunks.append((shift, (1 << width) - 1))
+            shift += width
+        self.tables = [{} for _ in self.chunks]
+        # hash -> latest (user_id, posted_at) seen for it
+        self.entries = {}
+
+    def __len__(self):
+        return len(self.entries)
+
+    def add(self, image_hash, payload):
+        if image_hash not in self.entries:
+            for table, (shift, mask) in zip(self.tables, self.chunks):
+                table.setdefault((image_hash >> shift) & mask, set()).add(image_hash)
+        self.entries[image_hash] = payload
+
+    def remove(self, image_hash):
+        del self.entries[image_hash]
+        for table, (shift, mask) in zip(self.tables, self.chunks):
+            key = (image_hash >> shift) & mask
+            bucket = table[key]
+            bucket.discard(image_hash)
+            if not bucket:
+                del table[key]
+
+    def search(self, image_hash):
+        """Return [(distance, hash, payload)] for every hash within the threshold"""
+        candidates = set()
+        for table, (shift, mask) in zip(self.tables, self.chunks):
+            bucket = table.get((image_hash >> shift) & mask)
+            if bucket:
+                candidates |= bucket
+        matches = []
+        for candidate in candidates:
+            distance = hamming(image_hash, candidate)
+            if distance <= self.threshold:
+                matches.append((distance, candidate, self.entries[candidate]))
+        return matches
+
+
+def _to_signed(value):
+    # SQLite integers are signed 64-bit
+    return value - (1 << 64) if value >= (1 << 63) else value
+
+
+def _to_unsigned(value):
+    return value + (1 << 64) if value < 0 else value
+
+
+class DuplicateIndex:
+    """Perceptual hashes of recent posts, one HashIndex per guild.
+
+    Hashes are kept for window_days and an image counts as a duplicate when it
+    is within threshold bits of one of them. New hashes are held in memory
+    until the post they came from has gone out, then saved through the store's
+    write queue. With owns(guild_id), only the guilds it accepts are loaded,
+    e.g. those on a cluster worker's shards.
+    """
+
+    LOAD = 'SELECT guild_id, hash, user_id, posted_at FROM image_hashes WHERE posted_at >= ?'
+    INSERT = 'INSERT INTO image_hashes (guild_id, hash, user_id, posted_at) VALUES (?, ?, ?, ?)'
+    PRUNE = 'DELETE FROM image_hashes WHERE posted_at < ?'
+
+    def __init__(self, db, writes, threshold=6, window_days=30, owns=None):
+        self.db = db
+        self.writes = writes
+        self.threshold = threshold
+        self.window = window_days * 86400
+        self.owns = owns
+        self.indexes = {}
+
+    async def load(self):
+        rows = await self.db.fetchall(self.LOAD, (int(time.time()) - self.window,))
+        self.indexes = {}
+        for guild_id, image_hash, user_id, posted_at in sorted(rows, key=lambda row: row[3]):
+            if self.owns is not None and not self.owns(guild_id):
+                continue
+            self._index(guild_id).add(_to_unsigned(image_hash), (user_id, posted_at))
+
+    def _index(self, guild_id):
+        index = self.indexes.get(guild_id)
+        if index is None:
+            index = self.indexes[guild_id] = HashIndex(self.threshold)
+        return index
+
+    def check_and_add(self, guild_id, image_hash, user_id):
+        """Return (distance, user_id, posted_at) of a recent near-duplicate, or
+        hold the hash and return None. Checking and holding happen without
+        yielding, so two copies posted at once can't both get through.
+
+        A held hash must then be passed to save() once the image is re-posted,
+        or to discard() if posting it failed, so the user can try again."""
+        now = int(time.time())
+        index = self._index(guild_id)
+        recent = [
+            (distance, payload) for distance, _, payload in index.search(image_hash)
+            if payload[1] >= now - self.window
+        ]
+        if recent:
+            distance, (original_user, posted_at) = min(recent, key=lambda match: match[0])
+            return distance, original_user, posted_at
+
+        index.add(image_hash, (user_id, now))
+        return None
+
+    def save(self, guild_id, image_hash):
+        """Write a hash held by check_and_add to the database"""
+        user_id, posted_at = self.indexes[guild_id].entries[image_hash]
+        future = self.writes.submit(self._insert, guild_id, _to_signed(image_hash), user_id, posted_at)
+        future.add_done_callback(self._saved)
+
+    def discard(self, guild_id, image_hash):
+        """Forget a hash held by check_and_add"""
+        index = self.indexes.get(guild_id)
+        if index is not None and image_hash in index.entries:
+            index.remove(image_hash)
+            if not index:
+                del self.indexes[guild_id]
+
+    @staticmethod
+    def _saved(future):
+        if not future.cancelled() and future.exception():
+            # The hash stays in memory, so it is only forgotten after a restart
+            log.error("Failed to save image hash: %s", future.exception(), extra={'event': 'db.write_failed'})
+
+    @classmethod
+    def _insert(cls, conn, guild_id, image_hash, user_id, posted_at):
+        conn.execute(cls.INSERT, (guild_id, image_hash, user_id, posted_at))
+
+    async def prune(self):
+        """Drop hashes older than the window from memory and the database"""
+        cutoff = int(time.time()) - self.window
+        for guild_id, index in list(self.indexes.items()):
+            for image_hash, (_, posted_at) in list(index.entries.items()):
+                if posted_at < cutoff:
+                    index.remove(image_hash)
+            if not index:
+                del self.indexes[guild_id]
+        return await self.writes.submit(self._prune, cutoff)
+
+    @classmethod
+    def _prune(cls, conn, cutoff):
+        return conn.execute(cls.PRUNE, (cutoff,)).rowcount
@@ -0,0 +1,121 @@
+import io
+import time
+
+from PIL import Image, ImageOps
+
+
+# Pillow format name and file extension for each supported output format
+FORMATS = {
+    'webp': ('WEBP', 'webp'),
+    'jpeg': ('JPEG', 'jpg'),
+}
+
+# Chunks holding EXIF, XMP or text metadata, any of which can carry a GPS location
+WEBP_METADATA = {b'EXIF', b'XMP '}
+PNG_METADATA = {b'eXIf', b'tEXt', b'zTXt', b'iTXt'}
+
+
+def recompress(data, max_dimension=2048, image_format='webp', quality=85):
+    """Downscale and re-encode an image without its EXIF data.
+
+    Runs in a worker process. Returns (image_bytes, extension, timings), where
+    timings holds the seconds spent decoding, resizing and encoding. Animated
+    images keep their frames as they are, since re-encoding would keep only
+    one, and only have their metadata cut out.
+    """
+    pil_format, extension = FORMATS[image_format]
+    timings = {}
+
+    start = time.perf_counter()
+    image = Image.open(io.BytesIO(data))
+    # MPO photos from phones are JPEGs with extra preview frames, so they are re-encoded
+    if getattr(image, 'is_animated', False) and image.format != 'MPO':
+        data = strip_metadata(data, image.format)
+        timings['strip'] = time.perf_counter() - start
+        return data, image.format.lower(), timings
+    # Let JPEG decode straight at a reduced scale when the photo is much bigger than needed
+    image.draft('RGB', (max_dimension, max_dimension))
+    # Apply the EXIF orientation before the EXIF data is thrown away
+    image = ImageOps.exif_transpose(image)
+    image.load()
+    timings['decode'] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    if max(image.size) > max_dimension:
+        image.thumbnail((max_dimension, max_dimension), Image.Resampling.LANCZOS)
+    if pil_format == 'JPEG' and image.mode not in ('RGB', 'L'):
+        image = flatten(image)
+    elif image.mode not in ('RGB', 'RGBA', 'L', 'LA'):
+        image = image.convert('RGBA' if 'transparency' in image.info else 'RGB')
+    timings['resize'] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    output = io.BytesIO()
+    # No exif= argument, so the metadata (GPS location included) is dropped
+    image.save(output, format=pil_format, quality=quality, optimize=pil_format == 'JPEG')
+    timings['encode'] = time.perf_counter() - start
+
+    return output.getvalue(), extension, timings
+
+
+def flatten(image):
+    """Convert to RGB, putting transparent areas on white rather than black"""
+    if image.mode in ('RGBA', 'LA', 'PA') or 'transparency' in image.info:
+        image = image.convert('RGBA')
+        background = Image.new('RGB', image.size, (255, 255, 255))
+        background.paste(image, mask=image.getchannel('A'))
+        return background
+    return image.convert('RGB')
+
+
+def strip_metadata(data, pil_format):
+    """Remove the metadata chunks from a WebP or PNG file without decoding it.
+
+    Other formats are returned unchanged; GIF has no place for EXIF.
+    """
+    if pil_format == 'WEBP':
+        chunks = []
+        offset = 12
+        while offset + 8 <= len(data):
+            fourcc = data[offset:offset + 4]
+            size = int.from_bytes(data[offset + 4:offset + 8], 'little')
+            end = offset + 8 + size + (size & 1)
+            chunk = data[offset:end]
+            if fourcc == b'VP8X':
+                # Clear the flags announcing EXIF (0x08) and XMP (0x04) chunks
+                chunk = chunk[:8] + bytes([chunk[8] & ~0x0C]) + chunk[9:]
+            if fourcc not in WEBP_METADATA:
+                chunks.append(chunk)
+            offset = end
+        body = b'WEBP' + b''.join(chunks)
+        return b'RIFF' + len(body).to_bytes(4, 'little') + body
+    if pil_format == 'PNG':
+        chunks = [data[:8]]
+        offset = 8
+        while offset + 8 <= len(data):
+            end = offset + 12 + int.from_bytes(data[offset:offset + 4], 'big')
+            if data[offset + 4:offset + 8] not in PNG_METADATA:
+                chunks.append(data[offset:end])
+            offset = end
+        return b''.join(chunks)
+    return data
+
+
+def dhash(data, hash_size=8):
+    """64-bit difference hash of an image, for spotting near-duplicate reposts.
+
+    Runs in a worker process. Each bit says whether a pixel of a tiny grayscale
+    copy is brighter than its right-hand neighbour, so re-encoding, resizing or
+    small edits only flip a few bits.
+    """
+    image = Image.open(io.BytesIO(data))
+    image.draft('L', (hash_size * 4, hash_size * 4))
+    image = image.convert('L').resize((hash_size + 1, hash_size), Image.Resampling.LANCZOS)
+    pixels = image.tobytes()
+
+    value = 0
+    for row in range(hash_size):
+        offset = row * (hash_size + 1)
+        for col in range(hash_size):
+            value = (value << 1) | (pixels[offset + col] > pixels[offset + col + 1])
+    return value
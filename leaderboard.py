@@ -0,0 +1,255 @@
+import random
+
+
+class _Node:
+    __slots__ = ('key', 'next', 'width')
+
+    def __init__(self, key, level):
+        self.key = key
+        self.next = [None] * level
+        # width[i] is how many rank positions the link next[i] jumps over
+        self.width = [0] * level
+
+
+class SkipList:
+    """Sorted set of keys with O(log n) insert, remove, rank and rank lookup"""
+
+    MAX_LEVEL = 32
+    P = 0.25
+
+    def __init__(self):
+        self.head = _Node(None, self.MAX_LEVEL)
+        self.level = 1
+        self.size = 0
+
+    def __len__(self):
+        return self.size
+
+    def _random_level(self):
+        level = 1
+        while level < self.MAX_LEVEL and random.random() < self.P:
+            level += 1
+        return level
+
+    def insert(self, key):
+        update = [None] * self.MAX_LEVEL
+        rank = [0] * self.MAX_LEVEL
+        x = self.head
+        for i in reversed(range(self.level)):
+            rank[i] = rank[i + 1] if i + 1 < self.level else 0
+            while x.next[i] is not None and x.next[i].key < key:
+                rank[i] += x.width[i]
+                x = x.next[i]
+            update[i] = x
+
+        level = self._random_level()
+        if level > self.level:
+            for i in range(self.level, level):
+                rank[i] = 0
+                update[i] = self.head
+                self.head.width[i] = self.size
+            self.level = level
+
+        node = _Node(key, level)
+        for i in range(level):
+            node.next[i] = update[i].next[i]
+            update[i].next[i] = node
+            node.width[i] = update[i].width[i] - (rank[0] - rank[i])
+            update[i].width[i] = rank[0] - rank[i] + 1
+        for i in range(level, self.level):
+            update[i].width[i] += 1
+        self.size += 1
+
+    def remove(self, key):
+        update = [None] * self.MAX_LEVEL
+        x = self.head
+        for i in reversed(range(self.level)):
+            while x.next[i] is not None and x.next[i].key < key:
+                x = x.next[i]
+            update[i] = x
+
+        x = x.next[0]
+        if x is None or x.key != key:
+            raise KeyError(key)
+        for i in range(self.level):
+            if update[i].next[i] is x:
+                update[i].width[i] += x.width[i] - 1
+                update[i].next[i] = x.next[i]
+            else:
+                update[i].width[i] -= 1
+        while self.level > 1 and self.head.next[self.level - 1] is None:
+            self.level -= 1
+        self.size -= 1
+
+    def count_below(self, key):
+        """Number of keys strictly less than key"""
+        rank = 0
+        x = self.head
+        for i in reversed(range(self.level)):
+            while x.next[i] is not None and x.next[i].key < key:
+                rank += x.width[i]
+                x = x.next[i]
+        return rank
+
+    def rank(self, key):
+        """1-based position of key, or None if it isn't in the list"""
+        rank = 0
+        x = self.head
+        for i in reversed(range(self.level)):
+            while x.next[i] is not None and x.next[i].key <= key:
+                rank += x.width[i]
+                x = x.next[i]
+            if x is not self.head and x.key == key:
+                return rank
+        return None
+
+    def _node_at(self, rank):
+        traversed = 0
+        x = self.head
+        for i in reversed(range(self.level)):
+            while x.next[i] is not None and traversed + x.width[i] <= rank:
+                traversed += x.width[i]
+                x = x.next[i]
+            if traversed == rank:
+                return x
+        return None
+
+    def _iter_from(self, node, count):
+        keys = []
+        while node is not None and len(keys) < count:
+            keys.append(node.key)
+            node = node.next[0]
+        return keys
+
+    def slice(self, start, count):
+        """Up to count keys starting at 0-based position start"""
+        if start >= self.size or count <= 0:
+            return []
+        return self._iter_from(self._node_at(start + 1), count)
+
+    def after(self, key, count):
+        """Up to count keys strictly greater than key"""
+        x = self.head
+        for i in reversed(range(self.level)):
+            while x.next[i] is not None and x.next[i].key <= key:
+                x = x.next[i]
+        return self._iter_from(x.next[0], count)
+
+    def before(self, key, count):
+        """Up to count keys strictly less than key, in ascending order"""
+        end = self.count_below(key)
+        start = max(0, end - count)
+        return self.slice(start, end - start)
+
+
+class UserRecord:
+    """One user's latest state; __slots__ keeps it to 64 bytes against 88 for a list"""
+    __slots__ = ('username', 'score', 'streak_days', 'last_post_date')
+
+    def __init__(self, username, score, streak_days, last_post_date):
+        self.username = username
+        self.score = score
+        self.streak_days = streak_days
+        self.last_post_date = last_post_date
+
+
+class Leaderboard:
+    """Score and streak rankings kept in memory and updated on every change.
+
+    Rankings are keyed by (-value, user_id), so the top of each list comes first
+    and ties are broken by user ID. Users with zero points or no streak are left
+    out of the matching ranking, like the WHERE clauses of the old queries.
+    """
+
+    def __init__(self):
+        # user_id -> UserRecord
+        self.users = {}
+        self.by_score = SkipList()
+        self.by_streak = SkipList()
+        self.loaded = False
+
+    def update(self, user_id, username, score, streak_days, last_post_date):
+        """Record a user's latest state; username=None keeps the known name"""
+        entry = self.users.get(user_id)
+        if entry is not None:
+            old_score, old_streak = entry.score, entry.streak_days
+            if username is not None:
+                entry.username = username
+            if old_score != score:
+                if old_score > 0:
+                    self.by_score.remove((-old_score, user_id))
+                if score > 0:
+                    self.by_score.insert((-score, user_id))
+            if old_streak != streak_days:
+                if old_streak > 0:
+                    self.by_streak.remove((-old_streak, user_id))
+                if streak_days > 0:
+                    self.by_streak.insert((-streak_days, user_id))
+            entry.score = score
+            entry.streak_days = streak_days
+            entry.last_post_date = last_post_date
+        else:
+            if score > 0:
+                self.by_score.insert((-score, user_id))
+            if streak_days > 0:
+                self.by_streak.insert((-streak_days, user_id))
+            self.users[user_id] = UserRecord(username, score, streak_days, last_post_date)
+
+    def expire(self, cutoff):
+        """Zero the streak of everyone whose last post is before cutoff; return their IDs"""
+        expired = []
+        node = self.by_streak.head.next[0]
+        while node is not None:
+            user_id = node.key[1]
+            last_post_date = self.users[user_id].last_post_date
+            if last_post_date and last_post_date < cutoff:
+                expired.append(user_id)
+            node = node.next[0]
+        for user_id in expired:
+            entry = self.users[user_id]
+            self.update(user_id, None, entry.score, 0, entry.last_post_date)
+        return expired
+
+    def _index(self, ranking):
+        return self.by_score if ranking == 'score' else self.by_streak
+
+    def _rows(self, keys):
+        rows = []
+        for key in keys:
+            entry = self.users[key[1]]
+            rows.append((key, key[1], entry.username, entry.score, entry.streak_days, entry.last_post_date))
+        return rows
+
+    def page(self, ranking, after=None, before=None, limit=10):
+        """One page of a ranking ('score' or 'streak') as (start_rank, rows, has_more).
+
+        Pages are addressed by the key of the last row seen (after) or the first
+        row seen (before). Each row is (key, user_id, username, score,
+        streak_days, last_post_date).
+        """
+        index = self._index(ranking)
+        if before is not None:
+            keys = index.before(before, limit)
+        elif after is not None:
+            keys = index.after(after, limit)
+        else:
+            keys = index.slice(0, limit)
+        start = index.count_below(keys[0]) + 1 if keys else 1
+        return start, self._rows(keys), start - 1 + len(keys) < len(index)
+
+    def rank(self, ranking, user_id):
+        """1-based position of a user in a ranking, or None if they aren't on it"""
+        entry = self.users.get(user_id)
+        value = entry and (entry.score if ranking == 'score' else entry.streak_days)
+        if not value or value <= 0:
+            return None
+        return self._index(ranking).rank((-value, user_id))
+
+    def around(self, ranking, rank, neighbours):
+        """Rows from rank-neighbours to rank+neighbours as (start_rank, rows)"""
+        start = max(1, rank - neighbours)
+        keys = self._index(ranking).slice(start - 1, rank + neighbours - start + 1)
+        return start, self._rows(keys)
+
+    def total(self, ranking):
+        return len(self._index(ranking))
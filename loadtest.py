@@ -0,0 +1,498 @@
+"""Offline load test for the image pipeline and slash commands.
+
+Drives SF-BOT's on_message and slash commands with synthetic messages and
+interactions at a fixed arrival rate. Commands run as the command tree runs
+them once it has parsed an interaction's payload: the tree's interaction
+check, the command's checks and argument transforms, then the error handler
+or the completion event. Attachments come from a local aiohttp server standing
+in for Discord's CDN, and channel.send, channel.delete_messages and
+message.delete are stubbed with simulated per-channel and global rate limits.
+Nothing leaves the machine, and the bot's database lives in a temporary
+directory.
+
+    python loadtest.py --rate 20 --duration 30 --users 500
+    python loadtest.py --rate 50 --image-size 4000x3000 --cdn-latency 80 --json
+"""
+import argparse
+import asyncio
+import datetime
+import importlib.util
+import io
+import json
+import os
+import random
+import resource
+import sys
+import tempfile
+import time
+import types
+
+import discord
+from aiohttp import web
+from PIL import Image
+
+
+def load_bot(database_path, merge_ms=0):
+    """Import SF-BOT.py as a module, pointed at a throwaway database"""
+    os.environ['DATABASE_PATH'] = database_path
+    os.environ['OUTBOUND_MERGE_MS'] = str(merge_ms)
+    os.environ.pop('METRICS_PORT', None)
+    path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'SF-BOT.py')
+    spec = importlib.util.spec_from_file_location('sfbot', path)
+    module = importlib.util.module_from_spec(spec)
+    sys.modules['sfbot'] = module
+    spec.loader.exec_module(module)
+    return module
+
+
+def make_images(count, width, height, quality, seed):
+    """JPEG photos with distinct perceptual hashes, so reposts aren't flagged as duplicates"""
+    rng = random.Random(seed)
+    images = []
+    for _ in range(count):
+        # Coarse random blocks give every image its own dhash; the noise on top
+        # makes them compress like a photo rather than a flat graphic
+        blocks = Image.frombytes('RGB', (16, 12), rng.randbytes(16 * 12 * 3))
+        base = blocks.resize((width, height), Image.Resampling.BICUBIC)
+        grain = Image.effect_noise((width, height), 40).convert('RGB')
+        output = io.BytesIO()
+        Image.blend(base, grain, 0.2).save(output, format='JPEG', quality=quality)
+        images.append(output.getvalue())
+    return images
+
+
+class FakeCDN:
+    """Serve the test images at /attachments/<index>/image.jpg with added latency"""
+
+    def __init__(self, images, latency=0.0, jitter=0.0):
+        self.images = images
+        self.latency = latency
+        self.jitter = jitter
+        self.requests = 0
+        self._runner = None
+        self.base_url = None
+
+    async def _handle(self, request):
+        self.requests += 1
+        delay = self.latency + random.uniform(-self.jitter, self.jitter)
+        if delay > 0:
+            await asyncio.sleep(delay)
+        return web.Response(body=self.images[int(request.match_info['index'])], content_type='image/jpeg')
+
+    async def start(self):
+        app = web.Application()
+        app.router.add_get('/attachments/{index}/image.jpg', self._handle)
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, '127.0.0.1', 0)
+        await site.start()
+        host, port = self._runner.addresses[0][:2]
+        self.base_url = f'http://{host}:{port}'
+
+    async def stop(self):
+        await self._runner.cleanup()
+
+    def url(self, index):
+        return f'{self.base_url}/attachments/{index}/image.jpg'
+
+
+class RateLimit:
+    """Token bucket: up to `burst` calls at once, refilled at `rate` per second"""
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+
+    async def acquire(self):
+        """Take a token, sleeping until one is free; return the seconds spent waiting"""
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        self.tokens -= 1
+        if self.tokens >= 0:
+            return 0.0
+        # Negative tokens are calls already queued ahead of this one
+        wait = -self.tokens / self.rate
+        await asyncio.sleep(wait)
+        return wait
+
+
+class FakeDiscord:
+    """Stands in for the REST API: adds latency and enforces rate limits per route"""
+
+    def __init__(self, latency, channel_rate, channel_burst, global_rate):
+        self.latency = latency
+        self.channel_rate = channel_rate
+        self.channel_burst = channel_burst
+        self.global_limit = RateLimit(global_rate, global_rate)
+        self.limits = {}
+        self.calls = {}
+        self.throttled = 0
+        self.throttled_seconds = 0.0
+
+    async def call(self, route, channel_id):
+        self.calls[route] = self.calls.get(route, 0) + 1
+        limit = self.limits.get((route, channel_id))
+        if limit is None:
+            limit = self.limits[(route, channel_id)] = RateLimit(self.channel_rate, self.channel_burst)
+        waited = await limit.acquire() + await self.global_limit.acquire()
+        if waited:
+            self.throttled += 1
+            self.throttled_seconds += waited
+        await asyncio.sleep(self.latency)
+
+
+class FakePermissions:
+    administrator = False
+
+
+class FakeUser(discord.Member):
+    """A Member, so slash command options of that type accept it, with just what the bot reads"""
+
+    # Plain attributes in place of Member's read-only properties
+    id = name = display_name = mention = None
+    bot = False
+    guild_permissions = FakePermissions()
+    display_avatar = types.SimpleNamespace(url='https://cdn.discordapp.com/embed/avatars/0.png')
+
+    def __init__(self, user_id):
+        self.id = user_id
+        self.name = self.display_name = f'user{user_id}'
+        self.mention = f'<@{user_id}>'
+
+
+class FakeGuild:
+    def __init__(self, guild_id):
+        self.id = guild_id
+        self.name = f'guild{guild_id}'
+        self.filesize_limit = discord.utils.DEFAULT_FILE_SIZE_LIMIT_BYTES
+
+
+class FakeChannel:
+    def __init__(self, api, channel_id, guild):
+        self.api = api
+        self.id = channel_id
+        self.name = f'images-{channel_id}'
+        self.guild = guild
+        self.mention = f'<#{channel_id}>'
+        self.sent = 0
+
+    async def send(self, content=None, **kwargs):
+        await self.api.call('send', self.id)
+        self.sent += 1
+        return types.SimpleNamespace(id=discord.utils.time_snowflake(discord.utils.utcnow()))
+
+    async def delete_messages(self, messages):
+        await self.api.call('bulk_delete', self.id)
+
+
+class FakeAttachment:
+    content_type = 'image/jpeg'
+    filename = 'image.jpg'
+
+    def __init__(self, url, size):
+        self.url = url
+        self.size = size
+
+
+class FakeMessage:
+    content = ''
+
+    def __init__(self, api, message_id, author, channel, attachments):
+        self.api = api
+        self.id = message_id
+        self.author = author
+        self.channel = channel
+        self.guild = channel.guild
+        self.attachments = attachments
+        self.created_at = datetime.datetime.now(datetime.timezone.utc)
+
+    async def delete(self):
+        await self.api.call('delete', self.channel.id)
+
+    async def reply(self, content=None, **kwargs):
+        await self.api.call('send', self.channel.id)
+
+
+class FakeResponse:
+    def __init__(self, api, channel_id):
+        self.api = api
+        self.channel_id = channel_id
+        self.done = False
+
+    def is_done(self):
+        return self.done
+
+    async def send_message(self, content=None, **kwargs):
+        # Interaction responses are exempt from channel limits but still a round trip
+        await asyncio.sleep(self.api.latency)
+        self.done = True
+
+    async def defer(self, **kwargs):
+        await self.send_message()
+
+    async def edit_message(self, **kwargs):
+        await self.send_message()
+
+
+class FakeInteraction:
+    def __init__(self, api, interaction_id, user, channel):
+        self.id = interaction_id
+        self.user = user
+        self.channel = channel
+        self.guild = channel.guild
+        self.response = FakeResponse(api, channel.id)
+        self.extras = {}
+        self.command = None
+
+
+def percentile(sorted_values, fraction):
+    """Nearest-rank percentile of an already sorted list"""
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, max(0, round(fraction * len(sorted_values) + 0.5) - 1))
+    return sorted_values[index]
+
+
+def summarize(latencies):
+    latencies = sorted(latencies)
+    return {
+        'count': len(latencies),
+        'p50_ms': percentile(latencies, 0.50) * 1000,
+        'p95_ms': percentile(latencies, 0.95) * 1000,
+        'p99_ms': percentile(latencies, 0.99) * 1000,
+        'max_ms': (latencies[-1] if latencies else 0.0) * 1000,
+    }
+
+
+class LoadTest:
+    COMMANDS = ('streak', 'score', 'leaderboard', 'streak_leaderboard', 'rank', 'user_stats')
+
+    def __init__(self, sfbot, args):
+        self.sfbot = sfbot
+        self.args = args
+        self.rng = random.Random(args.seed)
+        self.api = FakeDiscord(
+            args.api_latency / 1000, args.channel_rate, args.channel_burst, args.global_rate
+        )
+        self.users = [FakeUser(10_000 + i) for i in range(args.users)]
+        self.guilds = [FakeGuild(1_000 + i) for i in range(args.guilds)]
+        self.image_channels = [FakeChannel(self.api, 2_000 + i, guild) for i, guild in enumerate(self.guilds)]
+        self.command_channels = [FakeChannel(self.api, 3_000 + i, guild) for i, guild in enumerate(self.guilds)]
+        self.cdn = None
+        self.next_id = 1
+        self.posts = 0
+        self.message_latencies = []
+        self.command_latencies = {}
+        self.errors = 0
+
+    async def setup(self):
+        images = make_images(
+            self.args.images, *self.args.image_size, self.args.image_quality, self.args.seed
+        )
+        self.image_sizes = [len(image) for image in images]
+        self.cdn = FakeCDN(images, self.args.cdn_latency / 1000, self.args.cdn_jitter / 1000)
+        await self.cdn.start()
+
+        streak_bot = self.sfbot.streak_bot
+        await streak_bot.start()
+        for channel in self.image_channels:
+            await streak_bot.image_channels.add(channel.guild.id, channel.id)
+        # Prefix commands need a logged-in client, and test messages never contain one
+        self.sfbot.bot.process_commands = self._no_commands
+
+    @staticmethod
+    async def _no_commands(message):
+        pass
+
+    async def teardown(self):
+        streak_bot = self.sfbot.streak_bot
+        await streak_bot.store.flush()
+        # Wait for the image workers to exit so their peak RSS shows up in RUSAGE_CHILDREN
+        streak_bot.image_pool.shutdown(wait=True)
+        await streak_bot.close()
+        await self.cdn.stop()
+
+    def _snowflake(self):
+        self.next_id += 1
+        return self.next_id
+
+    def _image_message(self):
+        # Image k is image k % images shown in guild k // images, so every guild
+        # sees each image once before anything is reposted as a duplicate
+        channel = self.image_channels[(self.posts // len(self.cdn.images)) % len(self.image_channels)]
+        attachments = []
+        for _ in range(self.args.images_per_post):
+            index = self.posts % len(self.cdn.images)
+            self.posts += 1
+            attachments.append(FakeAttachment(self.cdn.url(index), self.image_sizes[index]))
+        author = self.rng.choice(self.users)
+        return FakeMessage(self.api, self._snowflake(), author, channel, attachments)
+
+    async def _post_image(self, scheduled):
+        message = self._image_message()
+        try:
+            await self.sfbot.on_message(message)
+        except Exception:
+            self.errors += 1
+        self.message_latencies.append(time.perf_counter() - scheduled)
+
+    async def _run_command(self, scheduled):
+        name = self.rng.choice(self.COMMANDS)
+        user = self.rng.choice(self.users)
+        channel = self.rng.choice(self.command_channels)
+        interaction = FakeInteraction(self.api, self._snowflake(), user, channel)
+        command = self.sfbot.bot.tree.get_command(name)
+        options = {
+            'user_stats': {'user': self.rng.choice(self.users)},
+            'rank': {'ranking': self.rng.choice(('score', 'streak'))},
+        }.get(name, {})
+        try:
+            await self._invoke(command, interaction, options)
+        except Exception:
+            self.errors += 1
+        self.command_latencies.setdefault(name, []).append(time.perf_counter() - scheduled)
+
+    async def _invoke(self, command, interaction, options):
+        """Run a command the way CommandTree._call does after parsing the payload"""
+        tree = self.sfbot.bot.tree
+        if not await tree.interaction_check(interaction):
+            return
+        interaction.command = command
+        # Commands only read the namespace's attributes, keyed by option name
+        namespace = types.SimpleNamespace(**options)
+        try:
+            await command._invoke_with_namespace(interaction, namespace)
+        except discord.app_commands.AppCommandError as e:
+            await command._invoke_error_handlers(interaction, e)
+            await tree.on_error(interaction, e)
+        else:
+            await self.sfbot.on_app_command_completion(interaction, command)
+
+    async def run(self):
+        """Open-loop arrivals: events start on schedule however far behind the bot is"""
+        tasks = []
+        start = time.perf_counter()
+        deadline = start + self.args.duration
+        scheduled = start
+        while True:
+            scheduled += self.rng.expovariate(self.args.rate)
+            if scheduled >= deadline:
+                break
+            delay = scheduled - time.perf_counter()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            if self.rng.random() < self.args.command_ratio:
+                tasks.append(asyncio.create_task(self._run_command(scheduled)))
+            else:
+                tasks.append(asyncio.create_task(self._post_image(scheduled)))
+        await asyncio.gather(*tasks)
+        return time.perf_counter() - start
+
+    def report(self, elapsed):
+        sfbot = self.sfbot
+        all_commands = [latency for latencies in self.command_latencies.values() for latency in latencies]
+        completed = len(self.message_latencies) + len(all_commands)
+        return {
+            'config': {key: value for key, value in vars(self.args).items() if key != 'json'},
+            'elapsed_s': elapsed,
+            'throughput_per_s': completed / elapsed if elapsed else 0.0,
+            'images': {
+                **summarize(self.message_latencies),
+                'processed': sfbot.IMAGES_PROCESSED.value(),
+                'ignored_duplicate': sfbot.IMAGES_IGNORED.value('duplicate'),
+                'failed': sfbot.IMAGES_FAILED.value('download') + sfbot.IMAGES_FAILED.value('error'),
+                'avg_image_bytes': sum(self.image_sizes) / len(self.image_sizes),
+            },
+            'commands': {
+                'all': summarize(all_commands),
+                **{name: summarize(latencies) for name, latencies in sorted(self.command_latencies.items())},
+            },
+            'stages_ms': {
+                stage: {'avg': total / count * 1000, 'max': worst * 1000, 'count': count}
+                for stage, (count, total, worst) in sorted(sfbot.streak_bot.timings.stages.items())
+            },
+            'api': {
+                'calls': dict(self.api.calls),
+                'throttled': self.api.throttled,
+                'throttled_s': self.api.throttled_seconds,
+            },
+            'harness_errors': self.errors,
+            # ru_maxrss is in kilobytes on Linux
+            'peak_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+            'peak_worker_rss_mb': resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024,
+        }
+
+
+def print_report(report):
+    images = report['images']
+    print(f"Ran {report['elapsed_s']:.1f}s: {report['throughput_per_s']:.1f} events/s completed")
+    print(f"Images: {images['count']} posts, {images['processed']} images reposted, "
+          f"{images['ignored_duplicate']} duplicates, {images['failed']} failed "
+          f"(avg {images['avg_image_bytes'] / 1024:.0f} KiB)")
+    print(f"{'':20} {'count':>7} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9} {'max ms':>9}")
+    rows = [('image post', images)] + [(f"/{name}", stats) for name, stats in report['commands'].items()]
+    for name, stats in rows:
+        print(f"{name:20} {stats['count']:>7} {stats['p50_ms']:>9.1f} {stats['p95_ms']:>9.1f} "
+              f"{stats['p99_ms']:>9.1f} {stats['max_ms']:>9.1f}")
+    print("Stages (avg / max ms):")
+    for stage, stats in report['stages_ms'].items():
+        print(f"  {stage:18} {stats['avg']:>8.1f} {stats['max']:>8.1f}  x{stats['count']}")
+    api = report['api']
+    print(f"API calls: {api['calls']}, {api['throttled']} rate limited for {api['throttled_s']:.1f}s in total")
+    print(f"Peak RSS: {report['peak_rss_mb']:.0f} MiB bot, {report['peak_worker_rss_mb']:.0f} MiB largest image worker")
+    if report['harness_errors']:
+        print(f"{report['harness_errors']} events raised out of their handler")
+
+
+def parse_size(value):
+    width, _, height = value.lower().partition('x')
+    return int(width), int(height)
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--rate', type=float, default=20, help='events per second (default 20)')
+    parser.add_argument('--duration', type=float, default=30, help='seconds of arrivals (default 30)')
+    parser.add_argument('--users', type=int, default=500, help='distinct users (default 500)')
+    parser.add_argument('--guilds', type=int, default=10, help='guilds, one image channel each (default 10)')
+    parser.add_argument('--command-ratio', type=float, default=0.3,
+                        help='fraction of events that are slash commands (default 0.3)')
+    parser.add_argument('--images', type=int, default=64, help='distinct test images (default 64)')
+    parser.add_argument('--images-per-post', type=int, default=1, help='attachments per image post (default 1)')
+    parser.add_argument('--image-size', type=parse_size, default=(1600, 1200), help='WxH (default 1600x1200)')
+    parser.add_argument('--image-quality', type=int, default=90, help='JPEG quality of test images (default 90)')
+    parser.add_argument('--cdn-latency', type=float, default=30, help='CDN response delay in ms (default 30)')
+    parser.add_argument('--cdn-jitter', type=float, default=10, help='+/- ms added to the CDN delay (default 10)')
+    parser.add_argument('--api-latency', type=float, default=60, help='Discord API round trip in ms (default 60)')
+    parser.add_argument('--channel-rate', type=float, default=5,
+                        help='send/delete calls per second per channel and route (default 5)')
+    parser.add_argument('--channel-burst', type=int, default=5, help='burst allowed per channel (default 5)')
+    parser.add_argument('--global-rate', type=float, default=50, help='API calls per second overall (default 50)')
+    parser.add_argument('--merge-ms', type=int, default=0,
+                        help="the bot's OUTBOUND_MERGE_MS re-post merge window (default 0)")
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--json', action='store_true', help='print the report as JSON')
+    return parser.parse_args(argv)
+
+
+async def main(args):
+    with tempfile.TemporaryDirectory(prefix='sfbot-loadtest-') as tmp:
+        sfbot = load_bot(os.path.join(tmp, 'streaks.db'), args.merge_ms)
+        test = LoadTest(sfbot, args)
+        await test.setup()
+        try:
+            elapsed = await test.run()
+        finally:
+            await test.teardown()
+        report = test.report(elapsed)
+    if args.json:
+        print(json.dumps(report, indent=2))
+    else:
+        print_report(report)
+
+
+if __name__ == '__main__':
+    asyncio.run(main(parse_args()))
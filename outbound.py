@@ -0,0 +1,232 @@
+import asyncio
+import collections
+import datetime
+import io
+import logging
+
+import discord
+
+
+log = logging.getLogger(__name__)
+
+
+class _ChannelQueue:
+    def __init__(self):
+        self.deletes = []  # (message, future)
+        # user_id -> deque of (content, files, future), in round-robin order
+        self.sends = collections.OrderedDict()
+        self.queued_sends = 0
+        # Requests taken off the queue that the worker is sending now
+        self.in_flight = []
+        self.task = None
+
+
+class OutboundScheduler:
+    """Queue deletes and re-posts per channel and send them from one task each.
+
+    Every channel has a single worker, so requests to a channel go out one at
+    a time and discord.py's rate limit handling waits once for the bucket
+    instead of every caller sleeping on its own 429. Waiting deletes are sent
+    as one bulk delete. Sends are taken round-robin across users, so one user
+    posting a burst of images can't hold up everyone else.
+
+    With merge_window set, the worker waits that long for more sends and posts
+    several users' images together in one message, up to Discord's limits on
+    files, text and the guild's upload size. If a merged message is refused
+    anyway, its parts are sent one at a time so only the faulty one fails.
+    """
+
+    MAX_FILES = 10
+    MAX_CONTENT = 2000
+    BULK_DELETE_MAX = 100
+    # Discord refuses to bulk delete anything older than this
+    BULK_DELETE_AGE = datetime.timedelta(days=14)
+
+    def __init__(self, merge_window=0.0):
+        self.merge_window = merge_window
+        self._channels = {}
+        # Counters for !pipeline_stats
+        self.messages_sent = 0
+        self.merged_sends = 0
+        self.bulk_deletes = 0
+        self.single_deletes = 0
+
+    def _queue(self, channel):
+        queue = self._channels.get(channel.id)
+        if queue is None:
+            queue = self._channels[channel.id] = _ChannelQueue()
+        if queue.task is None:
+            queue.task = asyncio.create_task(self._run(channel, queue))
+        return queue
+
+    def delete(self, message):
+        """Queue a message for deletion; the future resolves once it is gone"""
+        future = asyncio.get_running_loop().create_future()
+        self._queue(message.channel).deletes.append((message, future))
+        return future
+
+    def send(self, channel, user_id, content, files=()):
+        """Queue a message; the future resolves to the sent discord.Message"""
+        future = asyncio.get_running_loop().create_future()
+        queue = self._queue(channel)
+        queue.sends.setdefault(user_id, collections.deque()).append((content, list(files), future))
+        queue.queued_sends += 1
+        return future
+
+    @property
+    def depth(self):
+        return sum(len(queue.deletes) + queue.queued_sends for queue in self._channels.values())
+
+    def stats(self):
+        return {
+            'queue_depth': self.depth,
+            'channels': len(self._channels),
+            'messages_sent': self.messages_sent,
+            'merged_sends': self.merged_sends,
+            'bulk_deletes': self.bulk_deletes,
+            'single_deletes': self.single_deletes,
+        }
+
+    async def close(self):
+        """Let every queued request go out, then stop"""
+        tasks = [queue.task for queue in self._channels.values() if queue.task is not None]
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    async def _run(self, channel, queue):
+        try:
+            while queue.deletes or queue.queued_sends:
+                if queue.deletes:
+                    await self._flush_deletes(channel, queue)
+                else:
+                    await self._send_next(channel, queue)
+        except BaseException as e:
+            # Fail everything taken or still waiting rather than leave the callers hanging
+            pending = queue.in_flight + queue.deletes
+            pending += [entry for entries in queue.sends.values() for entry in entries]
+            queue.in_flight, queue.deletes, queue.queued_sends = [], [], 0
+            queue.sends.clear()
+            self._resolve(pending, exception=e)
+            if isinstance(e, Exception):
+                log.exception("Outbound worker for channel %s failed", channel.id, extra={'event': 'outbound.failed'})
+            else:
+                raise
+        finally:
+            # Nothing was awaited since the loop condition was checked, so no
+            # request can have been queued in between
+            queue.task = None
+            if not queue.deletes and not queue.queued_sends:
+                del self._channels[channel.id]
+
+    async def _flush_deletes(self, channel, queue):
+        batch, queue.deletes = queue.deletes[:self.BULK_DELETE_MAX], queue.deletes[self.BULK_DELETE_MAX:]
+        queue.in_flight = batch
+        oldest = discord.utils.utcnow() - self.BULK_DELETE_AGE
+        bulk = [(message, future) for message, future in batch if message.created_at > oldest]
+        single = [(message, future) for message, future in batch if message.created_at <= oldest]
+        if len(bulk) < 2:
+            single += bulk
+            bulk = []
+
+        if bulk:
+            try:
+                await channel.delete_messages([message for message, _ in bulk])
+                self.bulk_deletes += 1
+                self._resolve(bulk, None)
+            except discord.NotFound:
+                # Bulk delete fails if any message is already gone, so fall back to one at a time
+                single += bulk
+            except Exception as e:
+                self._resolve(bulk, exception=e)
+
+        for message, future in single:
+            try:
+                await message.delete()
+                self.single_deletes += 1
+                self._resolve([(message, future)], None)
+            except discord.NotFound:
+                self._resolve([(message, future)], None)
+            except Exception as e:
+                self._resolve([(message, future)], exception=e)
+
+    async def _send_next(self, channel, queue):
+        if self.merge_window and queue.queued_sends < self.MAX_FILES:
+            await asyncio.sleep(self.merge_window)
+        batch = queue.in_flight = self._take(queue, channel.guild.filesize_limit)
+        if len(batch) > 1:
+            try:
+                message = await self._post(channel, batch)
+            except Exception as e:
+                log.warning("Merged send to channel %s failed, sending separately: %s", channel.id, e,
+                            extra={'event': 'outbound.merge_failed'})
+            else:
+                self.merged_sends += len(batch)
+                self._resolve(batch, message)
+                return
+        for entry in batch:
+            try:
+                message = await self._post(channel, [entry])
+            except Exception as e:
+                log.warning("Failed to send to channel %s: %s", channel.id, e, extra={'event': 'outbound.send_failed'})
+                self._resolve([entry], exception=e)
+            else:
+                self._resolve([entry], message)
+
+    async def _post(self, channel, batch):
+        contents = [content for content, _, _ in batch if content]
+        files = [file for _, batch_files, _ in batch for file in batch_files]
+        for file in files:
+            # A failed merged send leaves its files read to the end
+            file.reset()
+        message = await channel.send(content='\n'.join(contents) or None, files=files or None)
+        self.messages_sent += 1
+        return message
+
+    def _take(self, queue, size_limit):
+        """Pop the next send, plus more from other users if merging and they fit"""
+        batch = []
+        files = 0
+        size = 0
+        length = -1
+        while queue.sends:
+            user_id, pending = next(iter(queue.sends.items()))
+            content, batch_files, _ = pending[0]
+            batch_size = sum(self._size(file) for file in batch_files)
+            if batch and (
+                files + len(batch_files) > self.MAX_FILES
+                or size + batch_size > size_limit
+                or length + 1 + len(content or '') > self.MAX_CONTENT
+            ):
+                break
+            batch.append(pending.popleft())
+            queue.queued_sends -= 1
+            files += len(batch_files)
+            size += batch_size
+            length += 1 + len(content or '')
+            # Move the user to the back of the line, or drop them once they are done
+            del queue.sends[user_id]
+            if pending:
+                queue.sends[user_id] = pending
+            if not self.merge_window:
+                break
+        return batch
+
+    @staticmethod
+    def _size(file):
+        """Bytes a discord.File will upload, from its current position"""
+        position = file.fp.tell()
+        end = file.fp.seek(0, io.SEEK_END)
+        file.fp.seek(position)
+        return end - position
+
+    @staticmethod
+    def _resolve(batch, result=None, exception=None):
+        for entry in batch:
+            future = entry[-1]
+            if future.done():
+                continue
+            if isinstance(exception, asyncio.CancelledError):
+                future.cancel()
+            elif exception is not None:
+                future.set_exception(exception)
+            else:
+                future.set_result(result)
@@ -0,0 +1,251 @@
+import asyncio
+import itertools
+import json
+import logging
+import re
+import time
+
+import discord
+
+from storage import day_date, day_number
+
+
+log = logging.getLogger(__name__)
+
+# The caption the bot puts on every re-post; merged re-posts have one per line
+CAPTION = re.compile(r"📸 <@!?(\d+)>'s streak:")
+POINTS_PER_POST = 3  # as in score_post
+
+
+def score_days(days, today):
+    """Return (streak_days, last_day, score) from a user's (day, posts) pairs sorted by day.
+
+    One pass over the day keys: the streak is the run of consecutive days
+    ending at the last one, and lapses to 0 if that was before yesterday,
+    the same as posting them one by one through score_post would give.
+    """
+    streak = posts = 0
+    previous = None
+    for day, count in days:
+        streak = streak + 1 if previous is not None and day - previous == 1 else 1
+        previous = day
+        posts += count
+    if previous is None or previous < day_number(today) - 1:
+        streak = 0
+    return streak, previous, posts * POINTS_PER_POST
+
+
+class Recompute:
+    """Rebuild user_streaks from the bot's re-posts in the image channels.
+
+    Original posts are deleted once they're re-posted, so the re-post captions
+    are the record of who posted on which day. The scan walks each channel's
+    history oldest first a page at a time, staging (user, day) counts in
+    recompute_posts. Each page is staged in the same transaction as the
+    checkpoint in bot_meta, so an interrupted job resumes where it stopped
+    without counting a page twice.
+
+    Only re-posts from before the job started are scanned. Posts re-posted
+    since are in post_events, which notes each post's re-post ID, so a post
+    made just before the start and re-posted after it is counted from there.
+    Each batch of users is written back in one transaction that merges both,
+    so live posts aren't lost or counted twice.
+    Users who don't appear in the history are left as they are. Scores are
+    rebuilt from posts alone, so /add_score and /set_score changes are lost.
+    """
+
+    PAGE_SIZE = 100  # the most Discord returns per request
+    USER_BATCH = 500
+
+    GET_CHECKPOINT = "SELECT value FROM bot_meta WHERE key = 'recompute'"
+    SAVE_CHECKPOINT = '''
+        INSERT INTO bot_meta (key, value) VALUES ('recompute', ?)
+        ON CONFLICT (key) DO UPDATE SET value = excluded.value
+    '''
+    CLEAR_CHECKPOINT = "DELETE FROM bot_meta WHERE key = 'recompute'"
+    CLEAR_STAGED = 'DELETE FROM recompute_posts'
+    STAGE = '''
+        INSERT INTO recompute_posts (user_id, day, posts, username) VALUES (?, ?, ?, ?)
+        ON CONFLICT (user_id, day) DO UPDATE SET
+            posts = posts + excluded.posts,
+            username = COALESCE(excluded.username, username)
+    '''
+    NEXT_USERS = 'SELECT DISTINCT user_id FROM recompute_posts WHERE user_id > ? ORDER BY user_id LIMIT ?'
+    # Staged days plus live posts whose re-post the scan didn't reach, sorted
+    # for score_days. A post from after the start can't have an earlier
+    # re-post, so it counts with or without a re-post ID.
+    USER_DAYS = '''
+        SELECT user_id, day, SUM(posts), MAX(username) FROM (
+            SELECT user_id, day, posts, username FROM recompute_posts
+            WHERE user_id > ? AND user_id <= ?
+            UNION ALL
+            SELECT user_id, day, 1, NULL FROM post_events
+            WHERE (message_id >= ? OR repost_id >= ?) AND user_id > ? AND user_id <= ?
+        )
+        GROUP BY user_id, day ORDER BY user_id, day
+    '''
+    WRITE_USER = '''
+        INSERT INTO user_streaks (user_id, streak_days, last_post_date, username, score) VALUES (?, ?, ?, ?, ?)
+        ON CONFLICT (user_id) DO UPDATE SET
+            streak_days = excluded.streak_days,
+            last_post_date = excluded.last_post_date,
+            username = COALESCE(user_streaks.username, excluded.username),
+            score = excluded.score
+    '''
+
+    def __init__(self, db, bot_user_id):
+        self.db = db
+        self.bot_user_id = bot_user_id
+        self.checkpoint = None
+        # Progress for !recompute status
+        self.phase = 'idle'
+        self.channel_id = None
+        self.messages_scanned = 0
+        self.posts_found = 0
+        self.users_written = 0
+        self.started = None
+
+    async def load(self):
+        """Load the checkpoint of an unfinished job; return True if there is one"""
+        row = await self.db.fetchone(self.GET_CHECKPOINT)
+        self.checkpoint = json.loads(row[0]) if row else None
+        return self.checkpoint is not None
+
+    async def discard(self):
+        """Forget an unfinished job and everything it staged"""
+        await self.db.transaction(self._clear)
+        self.checkpoint = None
+
+    @classmethod
+    def _clear(cls, conn):
+        conn.execute(cls.CLEAR_STAGED)
+        conn.execute(cls.CLEAR_CHECKPOINT)
+
+    def status(self):
+        checkpoint = self.checkpoint or {}
+        return {
+            'phase': self.phase,
+            'channel_id': self.channel_id,
+            'channels_done': len(checkpoint.get('done', ())),
+            'channels': len(checkpoint.get('channels', ())),
+            'messages_scanned': self.messages_scanned,
+            'posts_found': self.posts_found,
+            'users_written': self.users_written,
+            'elapsed': time.monotonic() - self.started if self.started else 0.0,
+        }
+
+    async def run(self, channels, today, progress=None):
+        """Scan channels, or resume the saved job, then write the results back.
+
+        channels are the discord channels to scan when starting afresh; a
+        resumed job scans the ones it started with, skipping any that are gone.
+        Call discard() first to start afresh when a checkpoint exists.
+        progress() is called after every page. Returns the users written.
+        """
+        self.started = time.monotonic()
+        self.messages_scanned = self.posts_found = self.users_written = 0
+        # Always resume from what was committed, not from a run that failed part way
+        resumed = await self.load()
+        if not resumed:
+            await self.db.transaction(self._clear)
+            self.checkpoint = {
+                'until': discord.utils.time_snowflake(discord.utils.utcnow()),
+                'channels': {str(channel.id): 0 for channel in channels},
+                'done': [],
+                'written_through': 0,
+            }
+            await self.db.execute(self.SAVE_CHECKPOINT, (json.dumps(self.checkpoint),))
+        log.info("Recompute scanning %d channels", len(self.checkpoint['channels']),
+                 extra={'event': 'recompute.started', 'resumed': resumed})
+
+        by_id = {channel.id: channel for channel in channels}
+        try:
+            self.phase = 'scanning'
+            for key in list(self.checkpoint['channels']):
+                if key in self.checkpoint['done']:
+                    continue
+                channel = by_id.get(int(key))
+                if channel is None:
+                    log.warning("Recompute skipping channel %s, which is no longer available", key,
+                                extra={'event': 'recompute.channel_missing'})
+                else:
+                    await self._scan(channel, progress)
+                self.checkpoint['done'].append(key)
+                await self.db.execute(self.SAVE_CHECKPOINT, (json.dumps(self.checkpoint),))
+
+            self.phase = 'writing'
+            await self._write_back(today, progress)
+        finally:
+            self.phase = 'idle'
+            self.channel_id = None
+
+        await self.discard()
+        log.info("Recompute wrote %d users", self.users_written,
+                 extra={'event': 'recompute.finished', 'users': self.users_written,
+                        'messages': self.messages_scanned})
+        return self.users_written
+
+    async def _scan(self, channel, progress):
+        self.channel_id = channel.id
+        key = str(channel.id)
+        until = discord.Object(self.checkpoint['until'])
+        while True:
+            after = discord.Object(self.checkpoint['channels'][key])
+            messages = [
+                message async for message in
+                channel.history(limit=self.PAGE_SIZE, after=after, before=until, oldest_first=True)
+            ]
+            if not messages:
+                return
+            counts = {}
+            for message in messages:
+                if message.author.id != self.bot_user_id:
+                    continue
+                names = {user.id: user.display_name for user in message.mentions}
+                # The bot uses local dates for streaks
+                day = day_number(message.created_at.astimezone().date())
+                for user_id in map(int, CAPTION.findall(message.content)):
+                    entry = counts.setdefault((user_id, day), [0, names.get(user_id)])
+                    entry[0] += 1
+            self.checkpoint['channels'][key] = messages[-1].id
+            rows = [(user_id, day, posts, name) for (user_id, day), (posts, name) in counts.items()]
+            await self.db.transaction(self._stage, rows, json.dumps(self.checkpoint), name='recompute stage')
+            self.messages_scanned += len(messages)
+            self.posts_found += sum(row[2] for row in rows)
+            if progress:
+                progress(self.status())
+
+    @classmethod
+    def _stage(cls, conn, rows, checkpoint):
+        conn.executemany(cls.STAGE, rows)
+        conn.execute(cls.SAVE_CHECKPOINT, (checkpoint,))
+
+    async def _write_back(self, today, progress):
+        while True:
+            after = self.checkpoint['written_through']
+            users = await self.db.fetchall(self.NEXT_USERS, (after, self.USER_BATCH))
+            if not users:
+                return
+            through = users[-1][0]
+            self.checkpoint['written_through'] = through
+            self.users_written += await self.db.transaction(
+                self._write_users, after, through, self.checkpoint['until'], today, json.dumps(self.checkpoint),
+                name='recompute write'
+            )
+            if progress:
+                progress(self.status())
+            # Let the write queue in between batches
+            await asyncio.sleep(0)
+
+    @classmethod
+    def _write_users(cls, conn, after, through, until, today, checkpoint):
+        rows = conn.execute(cls.USER_DAYS, (after, through, until, until, after, through)).fetchall()
+        writes = []
+        for user_id, days in itertools.groupby(rows, key=lambda row: row[0]):
+            days = list(days)
+            username = next((row[3] for row in reversed(days) if row[3]), None)
+            streak_days, last_day, score = score_days([(row[1], row[2]) for row in days], today)
+            writes.append((user_id, streak_days, day_date(last_day).isoformat(), username, score))
+        conn.executemany(cls.WRITE_USER, writes)
+        conn.execute(cls.SAVE_CHECKPOINT, (checkpoint,))
+        return len(writes)
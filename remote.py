@@ -0,0 +1,295 @@
+import asyncio
+import inspect
+import itertools
+import logging
+import os
+import pickle
+import socket
+import stat
+import struct
+import time
+
+
+log = logging.getLogger(__name__)
+
+# Every message is a 4-byte big-endian length followed by a pickle
+HEADER = struct.Struct('>I')
+
+
+def _frame(message):
+    payload = pickle.dumps(message, pickle.HIGHEST_PROTOCOL)
+    return HEADER.pack(len(payload)) + payload
+
+
+async def _read_frame(reader):
+    header = await reader.readexactly(HEADER.size)
+    return pickle.loads(await reader.readexactly(HEADER.unpack(header)[0]))
+
+
+async def awaited(value):
+    """Return value, or its result if it's awaitable.
+
+    Methods that are plain functions locally return a future through a
+    RemoteObject, so call sites that serve both await through this.
+    """
+    if inspect.isawaitable(value):
+        return await value
+    return value
+
+
+class RemoteError(Exception):
+    """An exception raised in the backend that couldn't be sent back as itself"""
+
+
+class BackendServer:
+    """Serve method calls on named objects to other processes over a Unix socket.
+
+    A call names a path like 'store.posts.user_history'; the first part picks
+    one of the objects and the rest are looked up as attributes, never ones
+    starting with an underscore. Plain results are sent back straight away and
+    awaitable ones once they finish, so calls from one connection run
+    concurrently, and each call starts in the order it arrived.
+
+    Arguments and results are pickled. Functions go by reference, so a worker
+    can pass a module-level function or a classmethod to Database.transaction
+    and have it run on the database here. Pickles can run code, so the socket
+    is only accessible to the user running the bot.
+
+    publish() pushes a notification to every connected process.
+    """
+
+    def __init__(self, objects, path):
+        self.objects = objects
+        self.path = path
+        self._server = None
+        self._writers = set()
+        # Optional observe(call, seconds) hook for call timings
+        self.observe = None
+        # Counters for the launcher's /health
+        self.calls = 0
+        self.failures = 0
+
+    async def start(self):
+        if os.path.exists(self.path) and stat.S_ISSOCK(os.stat(self.path).st_mode):
+            os.remove(self.path)  # left by a launcher that didn't shut down cleanly
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        # Created owner-only, rather than chmod-ed after it is already accepting connections
+        umask = os.umask(0o177)
+        try:
+            sock.bind(self.path)
+        except OSError:
+            sock.close()
+            raise
+        finally:
+            os.umask(umask)
+        self._server = await asyncio.start_unix_server(self._serve, sock=sock)
+
+    async def close(self):
+        if self._server is None:
+            return
+        self._server.close()
+        for writer in list(self._writers):
+            writer.close()
+        await self._server.wait_closed()
+        self._server = None
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+    @property
+    def connections(self):
+        return len(self._writers)
+
+    def publish(self, topic, *args, sender=None):
+        """Send a notification to every connected process but the sender"""
+        frame = _frame(('push', topic, args))
+        for writer in self._writers:
+            if writer is not sender and not writer.is_closing():
+                writer.write(frame)
+
+    def _resolve(self, path):
+        name, *attributes = path.split('.')
+        target = self.objects[name]
+        for attribute in attributes:
+            if attribute.startswith('_'):
+                raise AttributeError(f"{path} is private")
+            target = getattr(target, attribute)
+        return target
+
+    async def _serve(self, reader, writer):
+        self._writers.add(writer)
+        try:
+            while True:
+                try:
+                    message = await _read_frame(reader)
+                except (asyncio.IncompleteReadError, ConnectionError):
+                    return
+                if message[0] == 'publish':
+                    _, topic, args = message
+                    self.publish(topic, *args, sender=writer)
+                    continue
+                _, call_id, path, args, kwargs = message
+                self.calls += 1
+                start = time.perf_counter()
+                try:
+                    result = self._resolve(path)(*args, **kwargs)
+                except Exception as e:
+                    self._reply(writer, call_id, path, start, error=e)
+                    continue
+                if inspect.isawaitable(result):
+                    asyncio.ensure_future(self._finish(writer, call_id, path, start, result))
+                else:
+                    self._reply(writer, call_id, path, start, result)
+        finally:
+            self._writers.discard(writer)
+            writer.close()
+
+    async def _finish(self, writer, call_id, path, start, awaitable):
+        try:
+            result = await awaitable
+        except Exception as e:
+            self._reply(writer, call_id, path, start, error=e)
+        else:
+            self._reply(writer, call_id, path, start, result)
+
+    def _reply(self, writer, call_id, path, start, result=None, error=None):
+        if self.observe is not None:
+            self.observe(path, time.perf_counter() - start)
+        if error is not None:
+            self.failures += 1
+            log.debug("Backend call %s failed: %r", path, error, exc_info=error,
+                      extra={'event': 'backend.call_failed', 'call': path})
+        if writer.is_closing():
+            return
+        try:
+            frame = _frame(('result', call_id, error, result))
+        except Exception as e:
+            # Unpicklable results or exceptions still get an answer
+            frame = _frame(('result', call_id, RemoteError(f"{path}: {error or e!r}"), None))
+        writer.write(frame)
+
+
+class RemoteObject:
+    """Stands in for an object served by a BackendServer.
+
+    Attributes are RemoteObjects for the same attribute there. Calling one
+    sends the call at once, whether or not anyone awaits the returned future,
+    and the future resolves to the result, whether or not the method is async.
+    """
+
+    def __init__(self, backend, path):
+        self._backend = backend
+        self._path = path
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+        return RemoteObject(self._backend, f"{self._path}.{name}")
+
+    def __call__(self, *args, **kwargs):
+        return self._backend.call(self._path, *args, **kwargs)
+
+    def __repr__(self):
+        return f"<RemoteObject {self._path}>"
+
+
+class RemoteBackend:
+    """A connection to a BackendServer, for calls and notifications.
+
+    on_disconnect() is called if the connection drops other than through
+    close(); calls still waiting then fail with ConnectionError.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.on_disconnect = None
+        self._reader = None
+        self._writer = None
+        self._task = None
+        self._pending = {}
+        self._ids = itertools.count()
+        self._subscribers = {}
+        self._closing = False
+
+    async def connect(self, attempts=20, delay=0.5):
+        """Connect, retrying while the server starts up"""
+        for attempt in range(attempts):
+            try:
+                self._reader, self._writer = await asyncio.open_unix_connection(self.path)
+                break
+            except (FileNotFoundError, ConnectionError):
+                if attempt == attempts - 1:
+                    raise
+                await asyncio.sleep(delay)
+        self._task = asyncio.create_task(self._run())
+
+    async def close(self):
+        self._closing = True
+        if self._writer is not None:
+            self._writer.close()
+        if self._task is not None:
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+    def proxy(self, name):
+        return RemoteObject(self, name)
+
+    def call(self, path, *args, **kwargs):
+        """Send a call and return a future for its result"""
+        future = asyncio.get_running_loop().create_future()
+        if self._writer is None or self._writer.is_closing():
+            future.set_exception(ConnectionError(f"Not connected to the backend at {self.path}"))
+            return future
+        call_id = next(self._ids)
+        self._pending[call_id] = future
+        try:
+            self._writer.write(_frame(('call', call_id, path, args, kwargs)))
+        except Exception:
+            del self._pending[call_id]
+            raise
+        return future
+
+    def publish(self, topic, *args):
+        """Notify every other connected process; subscribers get args"""
+        if self._writer is not None and not self._writer.is_closing():
+            self._writer.write(_frame(('publish', topic, args)))
+
+    def subscribe(self, topic, callback):
+        """Run the coroutine function callback(*args) for each notification on topic"""
+        self._subscribers.setdefault(topic, []).append(callback)
+
+    async def _run(self):
+        try:
+            while True:
+                message = await _read_frame(self._reader)
+                if message[0] == 'push':
+                    _, topic, args = message
+                    for callback in self._subscribers.get(topic, ()):
+                        asyncio.create_task(self._notify(callback, topic, args))
+                    continue
+                _, call_id, error, result = message
+                future = self._pending.pop(call_id, None)
+                if future is None or future.done():
+                    continue
+                if error is not None:
+                    future.set_exception(error)
+                else:
+                    future.set_result(result)
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            # So later calls fail at once rather than wait on a dead socket
+            self._writer.close()
+            for future in self._pending.values():
+                if not future.done():
+                    future.set_exception(ConnectionError(f"Lost the connection to the backend at {self.path}"))
+            self._pending.clear()
+            if not self._closing:
+                log.error("Lost the connection to the backend at %s", self.path, extra={'event': 'backend.disconnected'})
+                if self.on_disconnect is not None:
+                    self.on_disconnect()
+
+    async def _notify(self, callback, topic, args):
+        try:
+            await callback(*args)
+        except Exception:
+            log.exception("Handling %s notification failed", topic, extra={'event': 'backend.notify_failed'})
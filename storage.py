@@ -0,0 +1,1303 @@
+import asyncio
+import collections
+import datetime
+import logging
+import re
+import sqlite3
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from leaderboard import Leaderboard
+
+
+log = logging.getLogger(__name__)
+
+
+# Database schema. Migrations for older databases live in Database._migrate
+SCHEMA = '''
+    CREATE TABLE IF NOT EXISTS user_streaks (
+        user_id INTEGER PRIMARY KEY,
+        streak_days INTEGER DEFAULT 0,
+        last_post_date TEXT,
+        username TEXT,
+        score INTEGER DEFAULT 0
+    );
+    CREATE TABLE IF NOT EXISTS image_channels (
+        channel_id INTEGER PRIMARY KEY,
+        guild_id INTEGER NOT NULL
+    );
+    CREATE TABLE IF NOT EXISTS image_hashes (
+        guild_id INTEGER NOT NULL,
+        hash INTEGER NOT NULL,
+        user_id INTEGER NOT NULL,
+        posted_at INTEGER NOT NULL
+    );
+    CREATE TABLE IF NOT EXISTS bot_meta (
+        key TEXT PRIMARY KEY,
+        value
+    );
+    CREATE TABLE IF NOT EXISTS command_syncs (
+        guild_id INTEGER PRIMARY KEY,
+        tree_hash TEXT NOT NULL,
+        synced_at INTEGER NOT NULL
+    );
+    CREATE TABLE IF NOT EXISTS post_events (
+        message_id INTEGER PRIMARY KEY,
+        guild_id INTEGER NOT NULL,
+        user_id INTEGER NOT NULL,
+        day INTEGER NOT NULL,
+        images INTEGER NOT NULL,
+        points INTEGER NOT NULL,
+        repost_id INTEGER
+    );
+    CREATE TABLE IF NOT EXISTS daily_user_posts (
+        user_id INTEGER NOT NULL,
+        day INTEGER NOT NULL,
+        guild_id INTEGER NOT NULL,
+        posts INTEGER NOT NULL,
+        images INTEGER NOT NULL,
+        points INTEGER NOT NULL,
+        PRIMARY KEY (user_id, day, guild_id)
+    ) WITHOUT ROWID;
+    CREATE TABLE IF NOT EXISTS daily_guild_posts (
+        guild_id INTEGER NOT NULL,
+        day INTEGER NOT NULL,
+        posts INTEGER NOT NULL,
+        images INTEGER NOT NULL,
+        points INTEGER NOT NULL,
+        users INTEGER NOT NULL,
+        PRIMARY KEY (guild_id, day)
+    ) WITHOUT ROWID;
+    CREATE TABLE IF NOT EXISTS recompute_posts (
+        user_id INTEGER NOT NULL,
+        day INTEGER NOT NULL,
+        posts INTEGER NOT NULL,
+        username TEXT,
+        PRIMARY KEY (user_id, day)
+    ) WITHOUT ROWID;
+'''
+
+# Created after migrations, since older databases may be missing indexed columns
+INDEXES = '''
+    CREATE INDEX IF NOT EXISTS idx_user_streaks_score ON user_streaks (score DESC, user_id);
+    CREATE INDEX IF NOT EXISTS idx_user_streaks_streak ON user_streaks (streak_days DESC, user_id);
+    CREATE INDEX IF NOT EXISTS idx_user_streaks_active ON user_streaks (last_post_date) WHERE streak_days > 0;
+    CREATE INDEX IF NOT EXISTS idx_image_channels_guild ON image_channels (guild_id);
+    CREATE INDEX IF NOT EXISTS idx_image_hashes_posted ON image_hashes (posted_at);
+    CREATE INDEX IF NOT EXISTS idx_daily_user_posts_guild ON daily_user_posts (guild_id, day);
+    CREATE INDEX IF NOT EXISTS idx_post_events_repost ON post_events (repost_id) WHERE repost_id IS NOT NULL;
+'''
+
+
+class Database:
+    """Long-lived SQLite connections that run statements off the event loop.
+
+    Writes go through a single writer connection on its own thread, so they are
+    naturally serialized. Reads use a small pool of reader connections, which
+    WAL mode lets run alongside the writer. Every connection keeps a cache of
+    prepared statements, so the constant SQL strings below are only compiled once.
+    """
+
+    def __init__(self, path, readers=2, statement_cache=128):
+        self.path = path
+        self.readers = max(1, readers)
+        self.statement_cache = statement_cache
+        self._writer = None
+        self._write_executor = None
+        self._read_executor = None
+        self._local = threading.local()
+        self._reader_conns = []
+        self._reader_lock = threading.Lock()
+        # Optional observe(statement, seconds) hook for statement timings,
+        # called from the database threads
+        self.observe = None
+
+    def _connect(self, read_only=False):
+        conn = sqlite3.connect(
+            self.path,
+            check_same_thread=False,
+            isolation_level=None,  # we issue BEGIN/COMMIT ourselves
+            cached_statements=self.statement_cache,
+        )
+        conn.execute('PRAGMA busy_timeout = 5000')
+        conn.execute('PRAGMA journal_mode = WAL')
+        # NORMAL is durable in WAL mode except for power loss mid-checkpoint
+        conn.execute('PRAGMA synchronous = NORMAL')
+        if read_only:
+            conn.execute('PRAGMA query_only = 1')
+        return conn
+
+    async def open(self):
+        """Open the writer connection and run schema migrations"""
+        self._write_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='db-writer')
+        self._read_executor = ThreadPoolExecutor(max_workers=self.readers, thread_name_prefix='db-reader')
+        loop = asyncio.get_running_loop()
+        self._writer = await loop.run_in_executor(self._write_executor, self._connect)
+        await loop.run_in_executor(self._write_executor, self._migrate, self._writer)
+
+    async def close(self):
+        """Close every connection and stop the worker threads"""
+        if self._writer is None:
+            return
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(self._write_executor, self._writer.close)
+        self._write_executor.shutdown(wait=True)
+        self._read_executor.shutdown(wait=True)
+        with self._reader_lock:
+            for conn in self._reader_conns:
+                conn.close()
+            self._reader_conns.clear()
+        self._writer = None
+
+    @staticmethod
+    def _migrate(conn):
+        conn.executescript(SCHEMA)
+
+        # Check if score column exists, if not add it
+        try:
+            conn.execute('SELECT score FROM user_streaks LIMIT 1')
+        except sqlite3.OperationalError:
+            log.info("Adding score column to database...", extra={'event': 'db.migrate'})
+            conn.execute('ALTER TABLE user_streaks ADD COLUMN score INTEGER DEFAULT 0')
+            log.info("Score column added successfully!", extra={'event': 'db.migrate'})
+
+        try:
+            conn.execute('SELECT repost_id FROM post_events LIMIT 1')
+        except sqlite3.OperationalError:
+            log.info("Adding repost_id column to post_events", extra={'event': 'db.migrate'})
+            conn.execute('ALTER TABLE post_events ADD COLUMN repost_id INTEGER')
+
+        conn.executescript(INDEXES)
+
+    def _reader(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = self._connect(read_only=True)
+            self._local.conn = conn
+            with self._reader_lock:
+                self._reader_conns.append(conn)
+        return conn
+
+    def timed(self, name, fn, conn, *args):
+        """Call fn(conn, *args), reporting how long it took to the observe hook"""
+        observe = self.observe
+        if observe is None:
+            return fn(conn, *args)
+        start = time.perf_counter()
+        try:
+            return fn(conn, *args)
+        finally:
+            observe(name, time.perf_counter() - start)
+
+    async def read(self, fn, *args, name=None):
+        """Run fn(conn, *args) on a reader connection"""
+        loop = asyncio.get_running_loop()
+        name = name or fn.__name__.lstrip('_')
+        return await loop.run_in_executor(self._read_executor, lambda: self.timed(name, fn, self._reader(), *args))
+
+    async def fetchone(self, sql, params=()):
+        return await self.read(lambda conn: conn.execute(sql, params).fetchone(), name=statement_name(sql))
+
+    async def fetchall(self, sql, params=()):
+        return await self.read(lambda conn: conn.execute(sql, params).fetchall(), name=statement_name(sql))
+
+    def _run_transaction(self, fn, args, name):
+        conn = self._writer
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            result = self.timed(name, fn, conn, *args)
+        except BaseException:
+            conn.execute('ROLLBACK')
+            raise
+        self.timed('commit', lambda conn: conn.execute('COMMIT'), conn)
+        return result
+
+    async def transaction(self, fn, *args, name=None):
+        """Run fn(conn, *args) inside one write transaction on the writer thread"""
+        loop = asyncio.get_running_loop()
+        name = name or fn.__name__.lstrip('_')
+        return await loop.run_in_executor(self._write_executor, self._run_transaction, fn, args, name)
+
+    async def execute(self, sql, params=()):
+        """Run a single write statement and return its rowcount"""
+        return await self.transaction(lambda conn: conn.execute(sql, params).rowcount, name=statement_name(sql))
+
+
+_STATEMENT_TABLE = re.compile(r'\b(?:FROM|INTO|UPDATE)\s+(\w+)', re.IGNORECASE)
+
+
+def statement_name(sql):
+    """Short label for a SQL string, like 'select user_streaks'"""
+    verb = sql.split(None, 1)[0].lower()
+    table = _STATEMENT_TABLE.search(sql)
+    return f"{verb} {table.group(1)}" if table else verb
+
+
+class WriteBehind:
+    """Apply queued writes in batched transactions from a single task.
+
+    A batch is committed once max_batch writes are waiting or max_delay seconds
+    after the first one arrived, whichever comes first. Each write runs under
+    its own savepoint, so one failing write doesn't take the batch down with it.
+    """
+
+    def __init__(self, db, max_batch=200, max_delay=0.05):
+        self.db = db
+        self.max_batch = max(1, max_batch)
+        self.max_delay = max_delay
+        self.queue = asyncio.Queue()
+        self._full = asyncio.Event()
+        self._task = None
+        # Counters for !db_stats
+        self.batches = 0
+        self.writes = 0
+        self.failures = 0
+        self.last_batch = 0
+        self.largest_batch = 0
+
+    def start(self):
+        self._task = asyncio.create_task(self._run())
+
+    def submit(self, fn, *args):
+        """Queue fn(conn, *args); the returned future resolves once it has committed"""
+        future = asyncio.get_running_loop().create_future()
+        self.queue.put_nowait((fn, args, future))
+        if self.queue.qsize() >= self.max_batch:
+            self._full.set()
+        return future
+
+    async def flush(self):
+        """Wait until every queued write has been committed"""
+        await self.queue.join()
+
+    async def close(self):
+        if self._task is None:
+            return
+        await self.flush()
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        self._task = None
+
+    @property
+    def depth(self):
+        return self.queue.qsize()
+
+    def stats(self):
+        return {
+            'queue_depth': self.depth,
+            'batches': self.batches,
+            'writes': self.writes,
+            'failures': self.failures,
+            'last_batch': self.last_batch,
+            'largest_batch': self.largest_batch,
+            'avg_batch': self.writes / self.batches if self.batches else 0.0,
+        }
+
+    async def _run(self):
+        while True:
+            batch = [await self.queue.get()]
+
+            # Give other writes a moment to join this transaction
+            if self.queue.qsize() < self.max_batch - 1:
+                self._full.clear()
+                try:
+                    await asyncio.wait_for(self._full.wait(), self.max_delay)
+                except asyncio.TimeoutError:
+                    pass
+            while len(batch) < self.max_batch and not self.queue.empty():
+                batch.append(self.queue.get_nowait())
+
+            try:
+                results = await self.db.transaction(self._apply, batch, name='write_batch')
+            except Exception as e:
+                log.error("Write batch of %d failed: %s", len(batch), e, extra={'event': 'db.batch_failed'})
+                results = [e] * len(batch)
+
+            for (_, _, future), result in zip(batch, results):
+                if isinstance(result, Exception):
+                    self.failures += 1
+                    if not future.done():
+                        future.set_exception(result)
+                elif not future.done():
+                    future.set_result(result)
+                self.queue.task_done()
+
+            self.batches += 1
+            self.writes += len(batch)
+            self.last_batch = len(batch)
+            self.largest_batch = max(self.largest_batch, len(batch))
+
+    def _apply(self, conn, batch):
+        results = []
+        for fn, args, _ in batch:
+            conn.execute('SAVEPOINT write')
+            try:
+                results.append(self.db.timed(fn.__name__.lstrip('_'), fn, conn, *args))
+            except Exception as e:
+                conn.execute('ROLLBACK TO write')
+                results.append(e)
+            conn.execute('RELEASE write')
+        return results
+
+
+class ChannelRegistry:
+    """Image channels per guild, persisted in the database.
+
+    The channel IDs are also held in a frozenset so the on_message check is a
+    single O(1) lookup. Every change bumps a version number in bot_meta, which
+    refresh() polls so other bot processes pick the change up without a restart.
+    on_change() is called after this process changes it, to tell them sooner.
+    """
+
+    LOAD = 'SELECT channel_id, guild_id FROM image_channels'
+    GET_VERSION = "SELECT value FROM bot_meta WHERE key = 'image_channels_version'"
+    BUMP_VERSION = '''
+        INSERT INTO bot_meta (key, value) VALUES ('image_channels_version', 1)
+        ON CONFLICT (key) DO UPDATE SET value = value + 1
+    '''
+    ADD = 'INSERT OR IGNORE INTO image_channels (channel_id, guild_id) VALUES (?, ?)'
+    REMOVE = 'DELETE FROM image_channels WHERE channel_id = ?'
+
+    def __init__(self, db):
+        self.db = db
+        self.channels = frozenset()
+        self.by_guild = {}
+        self.version = None
+        self.on_change = None
+
+    def __contains__(self, channel_id):
+        return channel_id in self.channels
+
+    def for_guild(self, guild_id):
+        return self.by_guild.get(guild_id, frozenset())
+
+    async def load(self):
+        self.version, rows = await self.db.read(self._load)
+        by_guild = {}
+        for channel_id, guild_id in rows:
+            by_guild.setdefault(guild_id, set()).add(channel_id)
+        self.by_guild = {guild_id: frozenset(ids) for guild_id, ids in by_guild.items()}
+        self.channels = frozenset(channel_id for channel_id, _ in rows)
+
+    @classmethod
+    def _load(cls, conn):
+        version = conn.execute(cls.GET_VERSION).fetchone()
+        return (version[0] if version else 0), conn.execute(cls.LOAD).fetchall()
+
+    async def refresh(self):
+        """Reload if another process has changed the registry; return True if it did"""
+        row = await self.db.fetchone(self.GET_VERSION)
+        if (row[0] if row else 0) == self.version:
+            return False
+        await self.load()
+        return True
+
+    async def add(self, guild_id, channel_id):
+        """Register a channel; return False if it already was one"""
+        added = await self.db.transaction(self._change, self.ADD, (channel_id, guild_id))
+        await self._changed(added)
+        return added
+
+    async def remove(self, channel_id):
+        """Unregister a channel; return False if it wasn't one"""
+        removed = await self.db.transaction(self._change, self.REMOVE, (channel_id,))
+        await self._changed(removed)
+        return removed
+
+    async def _changed(self, changed):
+        await self.load()
+        if changed and self.on_change is not None:
+            self.on_change()
+
+    @classmethod
+    def _change(cls, conn, sql, params):
+        if conn.execute(sql, params).rowcount == 0:
+            return False
+        conn.execute(cls.BUMP_VERSION)
+        return True
+
+
+class CommandSyncs:
+    """Hash of the slash command tree last synced to each guild.
+
+    Syncing is heavily rate limited, so the bot only syncs a guild when the
+    hash of its command tree differs from the one recorded here.
+    """
+
+    LOAD = 'SELECT guild_id, tree_hash FROM command_syncs'
+    SAVE = '''
+        INSERT INTO command_syncs (guild_id, tree_hash, synced_at) VALUES (?, ?, ?)
+        ON CONFLICT (guild_id) DO UPDATE SET tree_hash = excluded.tree_hash, synced_at = excluded.synced_at
+    '''
+
+    def __init__(self, db):
+        self.db = db
+
+    async def load(self):
+        """Return {guild_id: tree_hash}"""
+        return dict(await self.db.fetchall(self.LOAD))
+
+    async def save(self, guild_id, tree_hash):
+        await self.db.execute(self.SAVE, (guild_id, tree_hash, int(time.time())))
+
+
+# Post log days are stored as days since the Unix epoch
+EPOCH_ORDINAL = datetime.date(1970, 1, 1).toordinal()
+
+
+def day_number(date):
+    """Day key of a date or YYYY-MM-DD string"""
+    if isinstance(date, str):
+        date = datetime.date.fromisoformat(date)
+    return date.toordinal() - EPOCH_ORDINAL
+
+
+def day_date(day):
+    return datetime.date.fromordinal(day + EPOCH_ORDINAL)
+
+
+class PostLog:
+    """Append-only log of image posts, with daily totals per user and per guild.
+
+    Each event is one row of integers keyed by message ID. The rollups are
+    bumped in the same savepoint as the event they count, so they never drift
+    from the log, and history queries read only the rollups. Once the bot's
+    re-post has gone out its ID is added too, which !recompute needs to tell
+    which posts its history scan has already counted.
+    """
+
+    INSERT_EVENT = '''
+        INSERT OR IGNORE INTO post_events (message_id, guild_id, user_id, day, images, points)
+        VALUES (?, ?, ?, ?, ?, ?)
+    '''
+    SET_REPOST = 'UPDATE post_events SET repost_id = ? WHERE message_id = ?'
+    ROLLUP_USER = '''
+        INSERT INTO daily_user_posts (user_id, day, guild_id, posts, images, points) VALUES (?, ?, ?, 1, ?, ?)
+        ON CONFLICT (user_id, day, guild_id) DO UPDATE SET
+            posts = posts + 1,
+            images = images + excluded.images,
+            points = points + excluded.points
+        RETURNING posts
+    '''
+    ROLLUP_GUILD = '''
+        INSERT INTO daily_guild_posts (guild_id, day, posts, images, points, users) VALUES (?, ?, 1, ?, ?, ?)
+        ON CONFLICT (guild_id, day) DO UPDATE SET
+            posts = posts + 1,
+            images = images + excluded.images,
+            points = points + excluded.points,
+            users = users + excluded.users
+    '''
+    USER_HISTORY = '''
+        SELECT day, SUM(posts), SUM(images), SUM(points) FROM daily_user_posts
+        WHERE user_id = ? AND day >= ?
+        GROUP BY day ORDER BY day
+    '''
+    GUILD_DAYS = '''
+        SELECT day, posts, images, points, users FROM daily_guild_posts
+        WHERE guild_id = ? AND day >= ?
+        ORDER BY day
+    '''
+    GUILD_USERS = '''
+        SELECT user_id, SUM(posts) AS posts FROM daily_user_posts
+        WHERE guild_id = ? AND day >= ?
+        GROUP BY user_id ORDER BY posts DESC, user_id
+    '''
+
+    REBUILD = '''
+        DELETE FROM daily_user_posts;
+        DELETE FROM daily_guild_posts;
+        INSERT INTO daily_user_posts (user_id, day, guild_id, posts, images, points)
+            SELECT user_id, day, guild_id, COUNT(*), SUM(images), SUM(points)
+            FROM post_events GROUP BY user_id, day, guild_id;
+        INSERT INTO daily_guild_posts (guild_id, day, posts, images, points, users)
+            SELECT guild_id, day, COUNT(*), SUM(images), SUM(points), COUNT(DISTINCT user_id)
+            FROM post_events GROUP BY guild_id, day;
+    '''
+
+    def __init__(self, db):
+        self.db = db
+
+    @classmethod
+    def rebuild(cls, conn):
+        """Recompute both rollups from the log, after events were loaded in bulk"""
+        for statement in filter(str.strip, cls.REBUILD.split(';')):
+            conn.execute(statement)
+
+    @classmethod
+    def record(cls, conn, message_id, guild_id, user_id, day, images, points):
+        """Log a post and update the rollups; return False if it was already logged"""
+        if conn.execute(cls.INSERT_EVENT, (message_id, guild_id, user_id, day, images, points)).rowcount == 0:
+            return False
+        posts = conn.execute(cls.ROLLUP_USER, (user_id, day, guild_id, images, points)).fetchone()[0]
+        # The user's first post of the day in this guild makes them one more active user
+        conn.execute(cls.ROLLUP_GUILD, (guild_id, day, images, points, 1 if posts == 1 else 0))
+        return True
+
+    @classmethod
+    def set_repost(cls, conn, reposts):
+        """Add re-post IDs to logged posts from (message_id, repost_id) pairs"""
+        conn.executemany(cls.SET_REPOST, [(repost_id, message_id) for message_id, repost_id in reposts])
+
+    async def user_history(self, user_id, days, today=None):
+        """[(day, posts, images, points)] for the user's active days among the last `days`"""
+        since = day_number(today or datetime.date.today()) - days + 1
+        return await self.db.fetchall(self.USER_HISTORY, (user_id, since))
+
+    async def guild_activity(self, guild_id, days, today=None, top=5):
+        """Return ([(day, posts, images, points, users)], active_users, [(user_id, posts)] of the top posters)"""
+        since = day_number(today or datetime.date.today()) - days + 1
+        return await self.db.read(self._guild_activity, guild_id, since, top)
+
+    def _guild_activity(self, conn, guild_id, since, top):
+        rows = conn.execute(self.GUILD_DAYS, (guild_id, since)).fetchall()
+        users = conn.execute(self.GUILD_USERS, (guild_id, since)).fetchall()
+        return rows, len(users), users[:top]
+
+
+# A user's record as shown by /streak, /score and /user_stats, with the
+# last post date also parsed into a date
+UserStats = collections.namedtuple('UserStats', 'streak_days last_post_date score last_post_day')
+
+
+def make_stats(record):
+    if not record:
+        return None
+    streak_days, last_post_date, score = record
+    last_post_day = datetime.datetime.strptime(last_post_date, '%Y-%m-%d').date() if last_post_date else None
+    return UserStats(streak_days, last_post_date, score, last_post_day)
+
+
+class StatsCache:
+    """Bounded LRU cache of UserStats with a time-to-live.
+
+    The store writes every change through to it, so entries only go stale
+    through changes made by another process, which the TTL bounds.
+    """
+
+    def __init__(self, max_size=10000, ttl=300):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._entries = collections.OrderedDict()  # user_id -> (expires_at, stats)
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, user_id):
+        """Return (found, stats); stats may be None for a user with no record"""
+        entry = self._entries.get(user_id)
+        if entry is None or entry[0] < time.monotonic():
+            self.misses += 1
+            return False, None
+        self._entries.move_to_end(user_id)
+        self.hits += 1
+        return True, entry[1]
+
+    def put(self, user_id, stats):
+        self._entries[user_id] = (time.monotonic() + self.ttl, stats)
+        self._entries.move_to_end(user_id)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    def put_if_absent(self, user_id, stats):
+        if user_id not in self._entries:
+            self.put(user_id, stats)
+
+    def invalidate(self, user_id):
+        self._entries.pop(user_id, None)
+
+    def clear(self):
+        self._entries.clear()
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            'size': len(self._entries),
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'hit_rate': self.hits / lookups if lookups else 0.0,
+        }
+
+
+def streak_cutoff(today=None):
+    """Posts before this day (YYYY-MM-DD) no longer keep a streak alive"""
+    today = today or datetime.date.today()
+    return (today - datetime.timedelta(days=1)).strftime('%Y-%m-%d')
+
+
+def effective_record(record, cutoff):
+    """A user record with the streak zeroed if it lapsed before cutoff.
+
+    Expired streaks are only written back to the database in batches, so
+    anything read from it has to go through here first.
+    """
+    if record and record[0] and (not record[1] or record[1] < cutoff):
+        return (0,) + tuple(record[1:])
+    return record
+
+
+def effective_stats(stats, cutoff):
+    """effective_record for a UserStats"""
+    if stats and stats.streak_days and (not stats.last_post_date or stats.last_post_date < cutoff):
+        return stats._replace(streak_days=0)
+    return stats
+
+
+def score_post(record, today):
+    """Return the (streak_days, score) a user has after posting an image on `today`.
+
+    This mirrors StreakStore.RECORD_POST and is used to answer straight away
+    while the real update waits in the write queue.
+    """
+    if not record:
+        return 1, 3  # Start with 3 points for first image
+
+    streak_days, last_post_date, current_score = record
+    if last_post_date:
+        last_date = datetime.datetime.strptime(last_post_date, '%Y-%m-%d').date()
+        current_date = datetime.datetime.strptime(today, '%Y-%m-%d').date()
+
+        # Check if user posted yesterday (maintains streak)
+        if (current_date - last_date).days == 1:
+            streak_days += 1
+        elif (current_date - last_date).days > 1:
+            streak_days = 1  # Reset streak if missed a day
+        # If same day, don't increase streak
+    else:
+        streak_days = 1
+
+    # Update score by +3
+    return streak_days, current_score + 3
+
+
+def _repost_saved(future):
+    if not future.cancelled() and future.exception():
+        # Only !recompute reads these; without one it can miss a post re-posted as it started
+        log.error("Failed to save re-post ID: %s", future.exception(), extra={'event': 'db.write_failed'})
+
+
+class StreakStore:
+    """The one place the bot reads and writes streak data: the SQLite engine.
+
+    Writes are computed from the latest known state of the user and handed to
+    a WriteBehind queue. Until a user's queued writes have committed, that state
+    is kept in memory so reads (and captions) see them straight away.
+
+    MemoryStreakStore is the other engine. Both offer start, close, flush,
+    begin_bulk, reload, get_user, get_user_stats, record_post, add_score, set_score,
+    reset_streak, leaderboard_page, rank, expire_streaks and stats, plus the
+    posts log, the leaderboard and the writes queue.
+    """
+
+    GET_USER = 'SELECT streak_days, last_post_date, score FROM user_streaks WHERE user_id = ?'
+    # Streak and score mutations are single UPSERT statements, so each one is
+    # atomic and updates the row in place instead of deleting and re-inserting it
+    RECORD_POST = '''
+        INSERT INTO user_streaks (user_id, streak_days, last_post_date, username, score)
+        VALUES (:user_id, 1, :today, :username, 3)
+        ON CONFLICT (user_id) DO UPDATE SET
+            streak_days = CASE
+                WHEN user_streaks.last_post_date IS NULL THEN 1
+                WHEN julianday(excluded.last_post_date) - julianday(user_streaks.last_post_date) = 1
+                    THEN user_streaks.streak_days + 1
+                WHEN julianday(excluded.last_post_date) - julianday(user_streaks.last_post_date) > 1
+                    THEN 1
+                ELSE user_streaks.streak_days
+            END,
+            last_post_date = excluded.last_post_date,
+            username = excluded.username,
+            score = user_streaks.score + 3
+        RETURNING streak_days, score
+    '''
+    ADD_SCORE = '''
+        INSERT INTO user_streaks (user_id, streak_days, last_post_date, username, score)
+        VALUES (:user_id, 0, :today, :username, :points)
+        ON CONFLICT (user_id) DO UPDATE SET
+            username = excluded.username,
+            score = user_streaks.score + excluded.score
+        RETURNING score
+    '''
+    SET_SCORE = '''
+        INSERT INTO user_streaks (user_id, streak_days, last_post_date, username, score)
+        VALUES (:user_id, 0, :today, :username, :points)
+        ON CONFLICT (user_id) DO UPDATE SET
+            username = excluded.username,
+            score = excluded.score
+        RETURNING score
+    '''
+    RESET_STREAK = 'UPDATE user_streaks SET streak_days = 0 WHERE user_id = ?'
+    # Walks the partial index on active streaks, so each batch only touches the rows it resets
+    EXPIRE_BATCH = '''
+        UPDATE user_streaks SET streak_days = 0
+        WHERE rowid IN (
+            SELECT rowid FROM user_streaks
+            WHERE last_post_date < ? AND streak_days > 0
+            LIMIT ?
+        )
+    '''
+    LOAD_LEADERBOARD = '''
+        SELECT user_id, username, COALESCE(score, 0), COALESCE(streak_days, 0), last_post_date
+        FROM user_streaks
+    '''
+    GET_LEADERBOARD_ENTRY = '''
+        SELECT username, COALESCE(score, 0), COALESCE(streak_days, 0), last_post_date
+        FROM user_streaks WHERE user_id = ?
+    '''
+
+    def __init__(self, db, batch_size=200, batch_delay=0.05, cache_size=10000, cache_ttl=300):
+        self.db = db
+        self.stats_cache = StatsCache(max_size=cache_size, ttl=cache_ttl)
+        self.writes = WriteBehind(db, max_batch=batch_size, max_delay=batch_delay)
+        # Image posts logged by record_post, with daily rollups for /history
+        self.posts = PostLog(db)
+        # user_id -> [(streak_days, last_post_date, score), queued writes]
+        self._pending = {}
+        self.leaderboard = Leaderboard()
+        # Cutoff the in-memory leaderboard has already been expired for
+        self._expired_cutoff = None
+
+    async def start(self):
+        """Load the in-memory leaderboard and start the writer"""
+        self.leaderboard = await self.db.read(self._load_leaderboard)
+        log.info("Loaded leaderboard with %d users", len(self.leaderboard.users), extra={'event': 'leaderboard.loaded'})
+        self.writes.start()
+
+    def _load_leaderboard(self, conn):
+        leaderboard = Leaderboard()
+        for user_id, username, score, streak_days, last_post_date in conn.execute(self.LOAD_LEADERBOARD):
+            leaderboard.update(user_id, username, score, streak_days, last_post_date)
+        leaderboard.loaded = True
+        return leaderboard
+
+    async def close(self):
+        """Commit everything still queued"""
+        await self.writes.close()
+
+    async def flush(self):
+        """Wait until every change so far is in the database"""
+        await self.writes.flush()
+
+    def stats(self):
+        return {'engine': 'sqlite', 'users': len(self.leaderboard.users), 'cache': self.stats_cache.stats()}
+
+    async def begin_bulk(self):
+        """Get ready for a bulk change to user_streaks; call reload() once it's done"""
+        await self.flush()
+
+    async def reload(self):
+        """Drop everything held in memory and reload it, after a bulk change to user_streaks"""
+        await self.writes.flush()
+        self.stats_cache.clear()
+        self.leaderboard = await self.db.read(self._load_leaderboard)
+        self._expired_cutoff = None
+
+    async def get_user(self, user_id):
+        """Return (streak_days, last_post_date, score) or None, with lapsed streaks as 0"""
+        pending = self._pending.get(user_id)
+        if pending:
+            record = pending[0]
+        else:
+            record = await self.db.fetchone(self.GET_USER, (user_id,))
+        return effective_record(record, streak_cutoff())
+
+    async def get_user_stats(self, user_id):
+        """Return the user's UserStats or None, from the cache when possible"""
+        pending = self._pending.get(user_id)
+        if pending:
+            return effective_stats(make_stats(pending[0]), streak_cutoff())
+
+        found, stats = self.stats_cache.get(user_id)
+        if not found:
+            stats = make_stats(await self.db.fetchone(self.GET_USER, (user_id,)))
+            # A write may have gone through the cache while we were reading; it wins
+            self.stats_cache.put_if_absent(user_id, stats)
+        return effective_stats(stats, streak_cutoff())
+
+    def _expire_in_memory(self, cutoff):
+        """Zero lapsed streaks in the leaderboard and pending writes, once per cutoff"""
+        if self._expired_cutoff == cutoff:
+            return
+        for pending in self._pending.values():
+            pending[0] = effective_record(pending[0], cutoff)
+        self._expired_cutoff = cutoff
+        self.leaderboard.expire(cutoff)
+
+    async def _current(self, user_id):
+        if user_id in self._pending:
+            return self._pending[user_id][0]
+        record = await self.db.fetchone(self.GET_USER, (user_id,))
+        # Another write for this user may have been queued while we were reading
+        pending = self._pending.get(user_id)
+        return pending[0] if pending else record
+
+    def _queue(self, user_id, username, record, fn, *args):
+        pending = self._pending.setdefault(user_id, [record, 0])
+        pending[0] = record
+        pending[1] += 1
+        streak_days, last_post_date, score = record
+        self.leaderboard.update(user_id, username, score, streak_days, last_post_date)
+        self.stats_cache.put(user_id, make_stats(record))
+        future = self.writes.submit(fn, *args)
+        future.add_done_callback(lambda f: self._settle(user_id, f))
+        return future
+
+    def _settle(self, user_id, future):
+        pending = self._pending.get(user_id)
+        if pending:
+            pending[1] -= 1
+            if pending[1] <= 0:
+                del self._pending[user_id]
+        if not future.cancelled() and future.exception():
+            log.error("Failed to save streak data for user %s: %s", user_id, future.exception(),
+                      extra={'event': 'db.write_failed'})
+            self.stats_cache.invalidate(user_id)
+            # The leaderboard already has the change that failed, so reload the user
+            asyncio.ensure_future(self._refresh_leaderboard(user_id))
+
+    async def _refresh_leaderboard(self, user_id):
+        row = await self.db.fetchone(self.GET_LEADERBOARD_ENTRY, (user_id,))
+        if user_id in self._pending:
+            return  # a newer write has already updated the leaderboard
+        if row:
+            self.leaderboard.update(user_id, *row)
+        else:
+            self.leaderboard.update(user_id, None, 0, 0, None)
+
+    async def record_post(self, user_id, username, today, message_id=None, guild_id=None, images=1):
+        """Count an image post and return the new (streak_days, score) without waiting for the commit.
+
+        With a message_id the post is also added to the post log.
+        """
+        record = await self._current(user_id)
+        streak_days, new_score = score_post(record, today)
+        self._queue(user_id, username, (streak_days, today, new_score), self._record_post,
+                    user_id, username, today, message_id, guild_id, images)
+        return streak_days, new_score
+
+    async def record_repost(self, message_id, repost_id):
+        """Note the message that re-posted a logged post, without waiting for the commit"""
+        future = self.writes.submit(PostLog.set_repost, [(message_id, repost_id)])
+        future.add_done_callback(_repost_saved)
+
+    async def add_score(self, user_id, username, points, today):
+        """Add points to a user and return the new score once it is saved"""
+        record = await self._current(user_id)
+        if record:
+            predicted = (record[0], record[1], record[2] + points)
+        else:
+            predicted = (0, today, points)
+        return await self._queue(user_id, username, predicted, self._add_score, user_id, username, points, today)
+
+    async def set_score(self, user_id, username, points, today):
+        record = await self._current(user_id)
+        predicted = (record[0], record[1], points) if record else (0, today, points)
+        await self._queue(user_id, username, predicted, self._set_score, user_id, username, points, today)
+
+    async def reset_streak(self, user_id):
+        record = await self._current(user_id)
+        if record:
+            await self._queue(user_id, None, (0, record[1], record[2]), self._reset_streak, user_id)
+
+    async def leaderboard_page(self, ranking, after=None, before=None, limit=10):
+        """One page of the 'score' or 'streak' ranking as (start_rank, rows, has_more).
+
+        See Leaderboard.page for the row layout. Falls back to keyset queries on
+        the score/streak indexes if the in-memory leaderboard isn't loaded yet.
+        """
+        if self.leaderboard.loaded:
+            self._expire_in_memory(streak_cutoff())
+            return self.leaderboard.page(ranking, after=after, before=before, limit=limit)
+        return await self.db.read(self._leaderboard_page, ranking, after, before, limit)
+
+    async def rank(self, ranking, user_id, neighbours=2):
+        """Return (rank, total, start_rank, rows) for a user, or None if they are unranked"""
+        if self.leaderboard.loaded:
+            self._expire_in_memory(streak_cutoff())
+            rank = self.leaderboard.rank(ranking, user_id)
+            if rank is None:
+                return None
+            start, rows = self.leaderboard.around(ranking, rank, neighbours)
+            return rank, self.leaderboard.total(ranking), start, rows
+        return await self.db.read(self._rank, ranking, user_id, neighbours)
+
+    # Keyset queries for the SQL fallback. Rankings sort by value descending and
+    # then by user ID, matching the (-value, user_id) keys of the Leaderboard.
+    RANKED_COLUMNS = {'score': 'score', 'streak': 'streak_days'}
+    RANKED_SELECT = '''
+        SELECT user_id, username, score, streak_days, last_post_date
+        FROM user_streaks WHERE {column} > 0
+    '''
+
+    def _ranked_rows(self, column, rows):
+        value_index = 2 if column == 'score' else 3
+        return [((-row[value_index], row[0]),) + tuple(row) for row in rows]
+
+    def _count_ahead(self, conn, column, value, user_id):
+        return conn.execute(
+            f'SELECT COUNT(*) FROM user_streaks WHERE {column} > ? OR ({column} = ? AND user_id < ?)',
+            (value, value, user_id),
+        ).fetchone()[0]
+
+    def _leaderboard_page(self, conn, ranking, after, before, limit):
+        column = self.RANKED_COLUMNS[ranking]
+        select = self.RANKED_SELECT.format(column=column)
+        if before is not None:
+            value, user_id = -before[0], before[1]
+            rows = conn.execute(
+                select + f' AND ({column} > ? OR ({column} = ? AND user_id < ?))'
+                f' ORDER BY {column} ASC, user_id DESC LIMIT ?',
+                (value, value, user_id, limit),
+            ).fetchall()
+            rows.reverse()
+        elif after is not None:
+            value, user_id = -after[0], after[1]
+            rows = conn.execute(
+                select + f' AND ({column} < ? OR ({column} = ? AND user_id > ?))'
+                f' ORDER BY {column} DESC, user_id LIMIT ?',
+                (value, value, user_id, limit),
+            ).fetchall()
+        else:
+            rows = conn.execute(select + f' ORDER BY {column} DESC, user_id LIMIT ?', (limit,)).fetchall()
+
+        rows = self._ranked_rows(column, rows)
+        if not rows:
+            return 1, rows, False
+        first_key, last_key = rows[0][0], rows[-1][0]
+        start = self._count_ahead(conn, column, -first_key[0], first_key[1]) + 1
+        has_more = conn.execute(
+            select + f' AND ({column} < ? OR ({column} = ? AND user_id > ?)) LIMIT 1',
+            (-last_key[0], -last_key[0], last_key[1]),
+        ).fetchone() is not None
+        return start, rows, has_more
+
+    def _rank(self, conn, ranking, user_id, neighbours):
+        column = self.RANKED_COLUMNS[ranking]
+        row = conn.execute(f'SELECT {column} FROM user_streaks WHERE user_id = ?', (user_id,)).fetchone()
+        if not row or not row[0] or row[0] <= 0:
+            return None
+        key = (-row[0], user_id)
+        rank = self._count_ahead(conn, column, row[0], user_id) + 1
+        total = conn.execute(f'SELECT COUNT(*) FROM user_streaks WHERE {column} > 0').fetchone()[0]
+        _, above, _ = self._leaderboard_page(conn, ranking, None, key, neighbours)
+        me = self._ranked_rows(column, conn.execute(
+            self.RANKED_SELECT.format(column=column) + ' AND user_id = ?', (user_id,)).fetchall())
+        _, below, _ = self._leaderboard_page(conn, ranking, key, None, neighbours)
+        return rank, total, rank - len(above), above + me + below
+
+    async def expire_streaks(self, cutoff, batch_size=500, pause=0.05):
+        """Write lapsed streaks back as 0 in small batches; return how many were reset.
+
+        Reads already treat these streaks as 0, so this only keeps the stored
+        values (and the streak index) tidy. Each batch is its own short write,
+        so live posts are never stuck behind a full-table update.
+        """
+        self._expire_in_memory(cutoff)
+        total = 0
+        while True:
+            reset = await self.writes.submit(self._expire_batch, cutoff, batch_size)
+            total += reset
+            if reset < batch_size:
+                return total
+            await asyncio.sleep(pause)
+
+    def _record_post(self, conn, user_id, username, today, message_id=None, guild_id=None, images=1):
+        params = {'user_id': user_id, 'username': username, 'today': today}
+        result = conn.execute(self.RECORD_POST, params).fetchone()
+        if message_id is not None:
+            PostLog.record(conn, message_id, guild_id or 0, user_id, day_number(today), images, 3)
+        return result
+
+    def _add_score(self, conn, user_id, username, points, today):
+        params = {'user_id': user_id, 'username': username, 'points': points, 'today': today}
+        return conn.execute(self.ADD_SCORE, params).fetchone()[0]
+
+    def _set_score(self, conn, user_id, username, points, today):
+        params = {'user_id': user_id, 'username': username, 'points': points, 'today': today}
+        return conn.execute(self.SET_SCORE, params).fetchone()[0]
+
+    def _reset_streak(self, conn, user_id):
+        conn.execute(self.RESET_STREAK, (user_id,))
+
+    def _expire_batch(self, conn, cutoff, batch_size):
+        return conn.execute(self.EXPIRE_BATCH, (cutoff, batch_size)).rowcount
+
+
+class MemoryStreakStore:
+    """The in-memory engine: every user lives in the leaderboard's UserRecords.
+
+    Reads and writes never touch the database, so a post is counted in
+    microseconds. Changed users and logged posts are written to the database
+    in one transaction every checkpoint_interval seconds, on flush() and on
+    close(). A crash loses what changed since the last checkpoint, and /history
+    runs up to one checkpoint behind.
+
+    Bulk changes made straight to the database, like !import and !recompute,
+    go between begin_bulk() and reload(). Checkpoints are held back in between,
+    since they would write users' old totals over the new rows, and the
+    changes made in memory meanwhile are made again on top of the new rows by
+    reload(). The writes queue is still used by the duplicate index.
+    """
+
+    LOAD_USERS = StreakStore.LOAD_LEADERBOARD
+    SAVE_USER = '''
+        INSERT INTO user_streaks (user_id, streak_days, last_post_date, username, score) VALUES (?, ?, ?, ?, ?)
+        ON CONFLICT (user_id) DO UPDATE SET
+            streak_days = excluded.streak_days,
+            last_post_date = excluded.last_post_date,
+            username = COALESCE(excluded.username, user_streaks.username),
+            score = excluded.score
+    '''
+
+    def __init__(self, db, batch_size=200, batch_delay=0.05, checkpoint_interval=30):
+        self.db = db
+        self.writes = WriteBehind(db, max_batch=batch_size, max_delay=batch_delay)
+        self.posts = PostLog(db)
+        self.leaderboard = Leaderboard()
+        self.checkpoint_interval = checkpoint_interval
+        # Users changed, posts logged and re-posts noted since the last checkpoint
+        self._dirty = set()
+        self._posts = []
+        self._reposts = []
+        self._checkpoint_lock = asyncio.Lock()
+        # Bulk changes under way, and the changes made since the first began
+        self._bulk = 0
+        self._changes = None
+        self._task = None
+        self._expired_cutoff = None
+        # Counters for !db_stats
+        self.checkpoints = 0
+        self.checkpoint_failures = 0
+        self.last_checkpoint = None  # (rows, seconds)
+
+    async def start(self):
+        """Load every user and start checkpointing"""
+        self.leaderboard = await self.db.read(self._load)
+        log.info("Loaded %d users into memory", len(self.leaderboard.users), extra={'event': 'leaderboard.loaded'})
+        self.writes.start()
+        if self.checkpoint_interval:
+            self._task = asyncio.create_task(self._run())
+
+    def _load(self, conn):
+        leaderboard = Leaderboard()
+        for user_id, username, score, streak_days, last_post_date in conn.execute(self.LOAD_USERS):
+            leaderboard.update(user_id, username, score, streak_days, last_post_date)
+        leaderboard.loaded = True
+        return leaderboard
+
+    async def close(self):
+        """Stop checkpointing and write out everything still in memory"""
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+        if self._bulk:
+            self._bulk = 1
+            await self.reload()
+        await self.flush()
+        await self.writes.close()
+
+    async def flush(self):
+        """Checkpoint now and wait until every change so far is in the database"""
+        await self.checkpoint()
+        await self.writes.flush()
+
+    async def begin_bulk(self):
+        """Checkpoint, then hold back checkpoints until reload()"""
+        async with self._checkpoint_lock:
+            self._bulk += 1
+            if self._bulk > 1:
+                return
+            # Every change from here on is either in this checkpoint or noted
+            self._changes = []
+            try:
+                await self._checkpoint()
+            except Exception:
+                self._bulk = 0
+                self._changes = None
+                raise
+
+    async def reload(self):
+        """Reload every user after a bulk change, then make the changes noted since begin_bulk() again.
+
+        While another bulk change is still under way, the changes stay noted
+        and checkpoints stay held back until it ends too.
+        """
+        async with self._checkpoint_lock:
+            if not self._bulk:
+                await self._checkpoint()
+            leaderboard = await self.db.read(self._load)
+            # Nothing is awaited from here on, so no change can come between the load and the replay
+            changes = self._changes or []
+            self._bulk = max(0, self._bulk - 1)
+            if not self._bulk:
+                self._changes = None
+            self.leaderboard = leaderboard
+            self._expired_cutoff = None
+            self._dirty = set()
+            for change, args in changes:
+                change(*args)
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.checkpoint_interval)
+            try:
+                await self.checkpoint()
+            except Exception as e:
+                log.error("Checkpoint failed: %s", e, extra={'event': 'db.checkpoint_failed'})
+
+    async def checkpoint(self):
+        """Write changed users and logged posts in one transaction; return the rows written.
+
+        Does nothing during a bulk change.
+        """
+        async with self._checkpoint_lock:
+            if self._bulk:
+                return 0
+            return await self._checkpoint()
+
+    async def _checkpoint(self):
+        if not self._dirty and not self._posts and not self._reposts:
+            return 0
+        dirty, self._dirty = self._dirty, set()
+        posts, self._posts = self._posts, []
+        reposts, self._reposts = self._reposts, []
+        rows = []
+        for user_id in dirty:
+            entry = self.leaderboard.users.get(user_id)
+            if entry is None:
+                continue  # dropped by a reload in the meantime
+            rows.append((user_id, entry.streak_days, entry.last_post_date, entry.username, entry.score))
+        start = time.perf_counter()
+        try:
+            await self.db.transaction(self._save, rows, posts, reposts, name='checkpoint')
+        except Exception:
+            # Keep them for the next try, behind anything changed in the meantime
+            self._dirty |= dirty
+            self._posts[:0] = posts
+            self._reposts[:0] = reposts
+            self.checkpoint_failures += 1
+            raise
+        written = len(rows) + len(posts) + len(reposts)
+        self.checkpoints += 1
+        self.last_checkpoint = (written, time.perf_counter() - start)
+        return written
+
+    def _save(self, conn, rows, posts, reposts):
+        conn.executemany(self.SAVE_USER, rows)
+        for post in posts:
+            PostLog.record(conn, *post)
+        PostLog.set_repost(conn, reposts)
+
+    def stats(self):
+        rows, seconds = self.last_checkpoint or (0, 0.0)
+        return {
+            'engine': 'memory',
+            'users': len(self.leaderboard.users),
+            'dirty': len(self._dirty) + len(self._posts) + len(self._reposts),
+            'checkpoints': self.checkpoints,
+            'checkpoint_failures': self.checkpoint_failures,
+            'last_checkpoint_rows': rows,
+            'last_checkpoint_seconds': seconds,
+        }
+
+    def _record(self, user_id):
+        entry = self.leaderboard.users.get(user_id)
+        return entry and (entry.streak_days, entry.last_post_date, entry.score)
+
+    def _update(self, user_id, username, streak_days, last_post_date, score):
+        self.leaderboard.update(user_id, username, score, streak_days, last_post_date)
+        self._dirty.add(user_id)
+
+    def _change(self, change, *args):
+        """Make a change to a user, noting it during a bulk change so reload() can make it again"""
+        if self._changes is not None:
+            self._changes.append((change, args))
+        return change(*args)
+
+    async def get_user(self, user_id):
+        """Return (streak_days, last_post_date, score) or None, with lapsed streaks as 0"""
+        return effective_record(self._record(user_id), streak_cutoff())
+
+    async def get_user_stats(self, user_id):
+        return effective_stats(make_stats(self._record(user_id)), streak_cutoff())
+
+    async def record_post(self, user_id, username, today, message_id=None, guild_id=None, images=1):
+        """Count an image post and return the new (streak_days, score)"""
+        streak_days, score = self._change(self._record_post, user_id, username, today)
+        if message_id is not None:
+            self._posts.append((message_id, guild_id or 0, user_id, day_number(today), images, 3))
+        return streak_days, score
+
+    async def record_repost(self, message_id, repost_id):
+        """Note the message that re-posted a logged post"""
+        self._reposts.append((message_id, repost_id))
+        if self._bulk:
+            # !recompute reads these before checkpoints resume. Posts logged
+            # since the bulk change began aren't written yet and get theirs then.
+            future = self.writes.submit(PostLog.set_repost, [(message_id, repost_id)])
+            future.add_done_callback(_repost_saved)
+
+    def _record_post(self, user_id, username, today):
+        streak_days, score = score_post(self._record(user_id), today)
+        self._update(user_id, username, streak_days, today, score)
+        return streak_days, score
+
+    async def add_score(self, user_id, username, points, today):
+        return self._change(self._add_score, user_id, username, points, today)
+
+    def _add_score(self, user_id, username, points, today):
+        record = self._record(user_id)
+        if record:
+            score = record[2] + points
+            self._update(user_id, username, record[0], record[1], score)
+        else:
+            score = points
+            self._update(user_id, username, 0, today, score)
+        return score
+
+    async def set_score(self, user_id, username, points, today):
+        self._change(self._set_score, user_id, username, points, today)
+
+    def _set_score(self, user_id, username, points, today):
+        record = self._record(user_id)
+        self._update(user_id, username, record[0] if record else 0, record[1] if record else today, points)
+
+    async def reset_streak(self, user_id):
+        self._change(self._reset_streak, user_id)
+
+    def _reset_streak(self, user_id):
+        record = self._record(user_id)
+        if record:
+            self._update(user_id, None, 0, record[1], record[2])
+
+    def _expire_in_memory(self, cutoff):
+        if self._expired_cutoff != cutoff:
+            self._expired_cutoff = cutoff
+            self._dirty.update(self.leaderboard.expire(cutoff))
+
+    async def leaderboard_page(self, ranking, after=None, before=None, limit=10):
+        self._expire_in_memory(streak_cutoff())
+        return self.leaderboard.page(ranking, after=after, before=before, limit=limit)
+
+    async def rank(self, ranking, user_id, neighbours=2):
+        self._expire_in_memory(streak_cutoff())
+        rank = self.leaderboard.rank(ranking, user_id)
+        if rank is None:
+            return None
+        start, rows = self.leaderboard.around(ranking, rank, neighbours)
+        return rank, self.leaderboard.total(ranking), start, rows
+
+    async def expire_streaks(self, cutoff, batch_size=500, pause=0.05):
+        """Zero lapsed streaks; they reach the database with the next checkpoint"""
+        self._expired_cutoff = cutoff
+        expired = self.leaderboard.expire(cutoff)
+        self._dirty.update(expired)
+        return len(expired)
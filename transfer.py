@@ -0,0 +1,216 @@
+import asyncio
+import csv
+import datetime
+import gzip
+import io
+import json
+
+from storage import PostLog
+
+
+def _text(value):
+    return None if value is None or value == '' else str(value)
+
+
+def _date(value):
+    # Streaks compare and parse these as YYYY-MM-DD strings, so normalise them
+    # and refuse anything that isn't a date
+    if value is None or value == '':
+        return None
+    return datetime.date.fromisoformat(str(value)).isoformat()
+
+
+def _integer(value):
+    # Every integer column is a key or a count: a NULL key would get a fresh
+    # rowid, and a NULL count breaks scoring later
+    if value is None or value == '':
+        raise ValueError("a value is required")
+    return int(value)
+
+
+# Tables that can be exported and imported: primary key, then (column, parser)
+TABLES = {
+    'user_streaks': ('user_id', (
+        ('user_id', _integer),
+        ('streak_days', _integer),
+        ('last_post_date', _date),
+        ('username', _text),
+        ('score', _integer),
+    )),
+    'post_events': ('message_id', (
+        ('message_id', _integer),
+        ('guild_id', _integer),
+        ('user_id', _integer),
+        ('day', _integer),
+        ('images', _integer),
+        ('points', _integer),
+    )),
+}
+FORMATS = ('csv', 'jsonl')
+CONFLICT_MODES = ('replace', 'skip')
+# gzip's default of 9 takes three times as long for a few percent smaller files
+GZIP_LEVEL = 6
+
+
+def detect_format(path):
+    """'csv' or 'jsonl' from a file name, ignoring a trailing .gz"""
+    name = path.lower()
+    if name.endswith('.gz'):
+        name = name[:-3]
+    for fmt in FORMATS:
+        if name.endswith('.' + fmt):
+            return fmt
+    raise ValueError(f"Can't tell the format of {path}; use a .csv or .jsonl name")
+
+
+def open_text(path, mode):
+    """Open a file for text reading ('r') or writing ('w'), gzipped if it ends in .gz"""
+    if path.lower().endswith('.gz'):
+        return gzip.open(path, mode + 't', compresslevel=GZIP_LEVEL, encoding='utf-8', newline='')
+    return open(path, mode, encoding='utf-8', newline='')
+
+
+def _columns(table):
+    if table not in TABLES:
+        raise ValueError(f"Unknown table {table!r}; choose from {', '.join(TABLES)}")
+    return TABLES[table]
+
+
+def export_table(conn, table, out, fmt, chunk_size=10000):
+    """Stream a table to a text file object in primary key order; return the row count.
+
+    Rows are fetched chunk_size at a time, so memory use doesn't grow with the
+    table. Meant to run on a database thread, e.g. through Database.read.
+    """
+    key, columns = _columns(table)
+    names = [name for name, _ in columns]
+    # Old rows can have NULL counts, which the bot reads as 0 and import refuses
+    values = [f"COALESCE({name}, 0)" if parse is _integer else name for name, parse in columns]
+    if fmt == 'csv':
+        cursor = conn.execute(f"SELECT {', '.join(values)} FROM {table} ORDER BY {key}")
+        writer = csv.writer(out)
+        writer.writerow(names)
+        write = writer.writerows
+    else:
+        # SQLite builds each JSON line much faster than json.dumps would
+        fields = ', '.join(f"'{name}', {value}" for name, value in zip(names, values))
+        cursor = conn.execute(f"SELECT json_object({fields}) || char(10) FROM {table} ORDER BY {key}")
+
+        def write(rows):
+            out.writelines(line for line, in rows)
+    count = 0
+    while True:
+        rows = cursor.fetchmany(chunk_size)
+        if not rows:
+            return count
+        write(rows)
+        count += len(rows)
+
+
+def _convert(values, columns):
+    row = []
+    for value, (name, parse) in zip(values, columns):
+        try:
+            row.append(parse(value))
+        except ValueError as e:
+            raise ValueError(f"{name}: {e}") from None
+    return tuple(row)
+
+
+def _read_rows(source, fmt, columns):
+    """Yield rows as tuples in table column order, converting each value"""
+    names = [name for name, _ in columns]
+    if fmt == 'csv':
+        reader = csv.reader(source)
+        header = next(reader, None)
+        if header is None:
+            return
+        missing = set(names) - set(header)
+        if missing:
+            raise ValueError(f"Missing columns: {', '.join(sorted(missing))}")
+        positions = [header.index(name) for name, _ in columns]
+        for line, record in enumerate(reader, 2):
+            try:
+                yield _convert([record[position] for position in positions], columns)
+            except (ValueError, IndexError) as e:
+                raise ValueError(f"Line {line}: {e}") from None
+    else:
+        for line, text in enumerate(source, 1):
+            if not text.strip():
+                continue
+            try:
+                record = json.loads(text)
+                yield _convert([record.get(name) for name, _ in columns], columns)
+            except (ValueError, AttributeError) as e:
+                raise ValueError(f"Line {line}: {e}") from None
+
+
+def insert_statement(table, on_conflict):
+    key, columns = _columns(table)
+    names = [name for name, _ in columns]
+    placeholders = ', '.join('?' * len(names))
+    sql = f"INSERT INTO {table} ({', '.join(names)}) VALUES ({placeholders}) ON CONFLICT ({key}) DO "
+    if on_conflict == 'skip':
+        return sql + 'NOTHING'
+    if on_conflict == 'replace':
+        return sql + 'UPDATE SET ' + ', '.join(f'{name} = excluded.{name}' for name in names if name != key)
+    raise ValueError(f"on_conflict must be one of {', '.join(CONFLICT_MODES)}")
+
+
+def _insert_chunk(conn, sql, rows):
+    before = conn.total_changes
+    conn.executemany(sql, rows)
+    return conn.total_changes - before
+
+
+async def import_table(db, table, source, fmt, on_conflict='replace', chunk_size=50000, progress=None):
+    """Load rows from a text file object into a table; return (rows read, rows written).
+
+    The file is parsed chunk_size rows at a time in a worker thread, and each
+    chunk is written with executemany in its own transaction on the writer
+    thread, so the bot's own writes can still get in between chunks. A bad
+    row stops the import with ValueError; chunks before it stay committed.
+    Existing rows are overwritten ('replace') or left alone ('skip').
+    Importing post_events rebuilds the daily rollups afterwards.
+    """
+    _, columns = _columns(table)
+    sql = insert_statement(table, on_conflict)
+    rows = _read_rows(source, fmt, columns)
+
+    def next_chunk():
+        chunk = []
+        for row in rows:
+            chunk.append(row)
+            if len(chunk) >= chunk_size:
+                break
+        return chunk
+
+    read = written = 0
+    while True:
+        chunk = await asyncio.to_thread(next_chunk)
+        if not chunk:
+            break
+        written += await db.transaction(_insert_chunk, sql, chunk, name=f'import {table}')
+        read += len(chunk)
+        if progress:
+            progress(read)
+
+    if table == 'post_events' and written:
+        await db.transaction(PostLog.rebuild)
+    return read, written
+
+
+def export_gzip(conn, table, fmt, target):
+    """Export a table gzipped into a binary file object; return the row count"""
+    with gzip.GzipFile(fileobj=target, mode='wb', compresslevel=GZIP_LEVEL) as raw, io.TextIOWrapper(raw, encoding='utf-8', newline='') as out:
+        return export_table(conn, table, out, fmt)
+
+
+def export_file(conn, table, fmt, path):
+    """Export a table gzipped into the file at path; return the row count.
+
+    Takes a path rather than a file object so a cluster worker can have the
+    export run in the process that holds the database.
+    """
+    with open(path, 'wb') as target:
+        return export_gzip(conn, table, fmt, target)